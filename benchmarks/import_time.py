@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+""" Cold import time benchmark for stecosystems modules
+
+Every module is imported in a fresh interpreter several times;
+the median import time is compared against a fixed budget.
+Besides timing, it checks that importing does not pull heavy dependencies
+and does not create directories on disk.
+
+Usage:
+    python benchmarks/import_time.py [budget_ms]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BUDGET_MS = 150
+RUNS = 5
+MODULES = ('stecosystems.pypi', 'stecosystems.npm')
+# these should only be imported when actually used
+HEAVY_MODULES = ('pandas', 'requests', 'stscraper', 'stutils.decorators')
+
+PROBE = """
+import json, sys, time
+start = time.time()
+import %(module)s
+duration = time.time() - start
+print(json.dumps({
+    'ms': duration * 1000,
+    'heavy': [m for m in %(heavy)r if m in sys.modules]}))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def probe(module, env):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE % {'module': module,
+                                        'heavy': HEAVY_MODULES}],
+        cwd=ROOT, env=env)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def main(budget_ms=BUDGET_MS):
+    failed = False
+    save_path = os.path.join(tempfile.mkdtemp(), 'pypi')
+    env = dict(os.environ, PYPI_SAVE_PATH=save_path)
+    for module in MODULES:
+        results = [probe(module, env) for _ in range(RUNS)]
+        median = sorted(r['ms'] for r in results)[RUNS // 2]
+        heavy = sorted(set().union(*(r['heavy'] for r in results)))
+        status = 'OK' if median <= budget_ms and not heavy else 'FAIL'
+        failed |= status == 'FAIL'
+        print("%-20s %7.1f ms (budget %d ms) %s" % (
+            module, median, budget_ms, status))
+        if heavy:
+            print("    heavy modules imported: %s" % ", ".join(heavy))
+    if os.path.exists(save_path):
+        print("PYPI_SAVE_PATH was created at import time")
+        failed = True
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:2])))
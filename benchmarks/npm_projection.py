@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+""" Parse time and memory of `npm.Package.all()` with and without fields
+
+The dump is read twice: with whole documents and with `npm.TABLE_FIELDS`
+only. For each, it reports parse time and memory taken by documents of all
+packages, measured in a separate run under tracemalloc. Without a dump
+path, a synthetic one is generated: packages with a few dozen releases
+and READMEs, which take most of the space in real documents.
+
+Usage:
+    python benchmarks/npm_projection.py [dump.json] [--packages N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from stecosystems import npm
+
+README = ("# Title\n\nSome text with \"quotes\", {braces} and "
+          "[links](https://example.com). ")
+
+
+def generate(path, packages, seed=0):
+    """ Write a synthetic `_all_docs?include_docs=true` dump """
+    rnd = random.Random(seed)
+    with open(path, 'w') as fh:
+        fh.write('{"total_rows":%d,"offset":0,"rows":[\r\n' % packages)
+        for i in range(packages):
+            name = 'package%d' % i
+            versions = {}
+            for j in range(rnd.randint(1, 30)):
+                version = '1.0.%d' % j
+                versions[version] = {
+                    'name': name, 'version': version,
+                    'readme': README * rnd.randint(20, 400),
+                    'dependencies': {'dep%d' % k: '^1.%d' % k
+                                     for k in range(rnd.randint(0, 8))},
+                    'maintainers': [{'name': 'user', 'email': 'u@x.com'}],
+                    'dist': {'tarball': 'https://registry.npmjs.org/%s/-/'
+                                        '%s-%s.tgz' % (name, name, version),
+                             'shasum': 'ab' * 20}}
+            doc = {'_id': name, '_rev': '1-a', 'name': name,
+                   'versions': versions, 'readme': README * 200,
+                   'time': {v: '2019-01-01T00:00:00.000Z' for v in versions},
+                   'repository': {'type': 'git',
+                                  'url': 'git+https://github.com/u/%s' % name},
+                   'license': 'MIT', 'author': {'name': 'user'},
+                   'bugs': {'url': 'https://github.com/u/%s/issues' % name},
+                   'homepage': 'https://github.com/u/%s' % name}
+            fh.write(json.dumps({'id': name, 'key': name,
+                                 'value': {'rev': '1-a'}, 'doc': doc}))
+            fh.write(',\r\n' if i < packages - 1 else '\r\n')
+        fh.write(']}\n')
+
+
+def parse(path, fields):
+    return [package.info for package in
+            npm.Package.all(cache_file=path, fields=fields)]
+
+
+def measure(path, fields):
+    """ Get (parse time, memory taken by the documents) """
+    gc.collect()
+    start = time.time()
+    parse(path, fields)
+    elapsed = time.time() - start
+
+    gc.collect()
+    tracemalloc.start()
+    docs = parse(path, fields)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('dump', nargs='?', help="npm _all_docs dump")
+    parser.add_argument('--packages', type=int, default=1000,
+                        help="number of packages in the synthetic dump")
+    args = parser.parse_args()
+
+    path = args.dump
+    if not path:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        generate(path, args.packages)
+    try:
+        print("dump: %s, %.0f MB" % (path, os.path.getsize(path) / 1e6))
+        print("%-12s %10s %12s" % ("fields", "time, s", "memory, MB"))
+        for label, fields in (("all", None), ("TABLE_FIELDS",
+                                              npm.TABLE_FIELDS)):
+            elapsed, size = measure(path, fields)
+            print("%-12s %10.2f %12.1f" % (label, elapsed, size / 1e6))
+    finally:
+        if not args.dump:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+""" Memory used by a package metadata in full and compact modes
+
+For every package, the registry document is fetched once and then loaded
+twice under tracemalloc: as full JSON (what `Package` keeps by default)
+and as compact records (`Package(name, compact=True)`).
+
+Usage:
+    python benchmarks/package_memory.py [--npm] package [package ...]
+"""
+
+from __future__ import print_function
+
+import gc
+import json
+import sys
+import tracemalloc
+
+from stecosystems import compact, npm, pypi
+
+
+def measure(func, *args):
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def pypi_full(text):
+    return json.loads(text)
+
+
+def pypi_compact(text):
+    info = json.loads(text)
+    return (compact.PypiMeta.from_json(info['info']),
+            compact.ReleaseTable.from_json(info['releases']))
+
+
+def npm_full(text):
+    return json.loads(text)
+
+
+def npm_compact(text):
+    return compact.NpmDoc.from_json(json.loads(text))
+
+
+def main(args):
+    if args and args[0] == '--npm':
+        args = args[1:]
+        fetch = npm.Package._request
+        full, small = npm_full, npm_compact
+    else:
+        def fetch(name):
+            return pypi.Package._request("pypi", name, "json")
+        full, small = pypi_full, pypi_compact
+
+    print("%-30s %12s %12s %7s" % ("package", "full, B", "compact, B", "ratio"))
+    total_full = total_compact = 0
+    for name in args:
+        text = fetch(name).text
+        full_size = measure(full, text)
+        compact_size = measure(small, text)
+        total_full += full_size
+        total_compact += compact_size
+        print("%-30s %12d %12d %7.1f" % (
+            name, full_size, compact_size, full_size / compact_size))
+    if args:
+        print("%-30s %12d %12d %7.1f" % (
+            "average", total_full // len(args), total_compact // len(args),
+            total_full / total_compact))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -39,6 +39,9 @@ setup(
     platforms=["Linux", "Solaris", "Mac OS-X", "Unix", "Windows"],
     python_requires='>2.6, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, <4',
     packages=[package],
+    entry_points={
+        'console_scripts': ['stecosystems = stecosystems.__main__:main'],
+    },
     url='https://github.com/cmustrudel/strudel.ecosystems',
     install_requires=requirements,
     **kwargs
@@ -0,0 +1,443 @@
+
+""" Command line entry point for ecosystem crawls
+
+    python -m stecosystems <command> <ecosystem> [options]
+
+Commands output one row per package or per release:
+
+    enumerate  package names
+    metadata   latest version, number of releases, license, repository
+    deps       dependencies of every release
+    size       LOC of every release
+    repos      repository URLs
+
+For example, to get dependencies of packages starting with `a` in
+8 threads, resuming an interrupted run:
+
+    python -m stecosystems deps pypi --start a --stop b -w 8 \\
+        -o deps.csv --resume deps.done
+
+Rows are written in the order of package names, so runs with the same
+arguments are reproducible. Packages which failed are logged and skipped.
+
+To get quick estimates instead of a full pass, process a reproducible
+sample of packages, optionally stratified (see `sampling`):
+
+    python -m stecosystems deps pypi --sample 0.01 --seed 1 --strata year
+
+Estimates with confidence intervals of per-package values, like
+the number of dependencies of the latest release, are printed to stderr.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import functools
+import io
+import json
+import logging
+import os
+import re
+import sys
+
+import six
+
+from .base import PackageDoesNotExist
+from . import pipeline
+from . import sampling
+from . import trace
+
+ECOSYSTEMS = ('pypi', 'npm')
+FORMATS = ('csv', 'jsonl')
+# output columns by command
+COLUMNS = {
+    'enumerate': ('name',),
+    'metadata': ('name', 'version', 'releases', 'license', 'repository'),
+    'deps': ('name', 'version', 'date', 'deps', 'raw_dependencies'),
+    'size': ('name', 'version', 'date', 'loc'),
+    'repos': ('name', 'repository'),
+}
+
+logger = logging.getLogger('stecosystems')
+
+
+def _module(ecosystem):
+    # ecosystem modules are imported only when needed
+    if ecosystem == 'npm':
+        from . import npm
+        return npm
+    from . import pypi
+    return pypi
+
+
+def configure(args):
+    """ Apply cache and mirror options to the ecosystem module """
+    module = _module(args.ecosystem)
+    if args.mirror:
+        from . import mirror
+        cls = mirror.NpmMirror if args.ecosystem == 'npm' \
+            else mirror.PypiMirror
+        module.Package.mirror = cls(args.mirror)
+    if args.ecosystem == 'npm' and args.dump:
+        from .dumpindex import DumpIndex
+        index = DumpIndex(args.dump)
+        if os.path.isfile(index.path):
+            module.Package.dump = index
+    if args.cache_dir and args.ecosystem == 'pypi':
+        from .fingerprints import FingerprintStore
+        from .negcache import NegativeCache
+        from .setupcache import SetupCache
+        module.PYPI_SAVE_PATH = os.path.join(args.cache_dir, 'packages')
+        module._setup_cache = SetupCache(
+            os.path.join(args.cache_dir, 'setup'))
+        module._loc_store = FingerprintStore(
+            os.path.join(args.cache_dir, 'loc.sqlite'))
+        module._negative_cache = NegativeCache(
+            os.path.join(args.cache_dir, 'negative.sqlite'))
+    if args.trace:
+        trace.enable(args.trace)
+
+
+def _stratum(ecosystem, stratum):
+    """ Stratum function of (name, package or None) items """
+    def func(item):
+        name, package = item
+        try:
+            package = package or _module(ecosystem).Package.get(name)
+        except PackageDoesNotExist:
+            return 'missing'
+        return stratum(package)
+    return func
+
+
+def packages(args, done=(), sample=None):
+    # type: (argparse.Namespace, Container[str], Optional[sampling.StratifiedSample]) -> Iterator[tuple]
+    """ Iterate (name, package or None) to process, applying name filter,
+    range, resume checkpoint and sample. Package objects are only created
+    by enumeration if the registry lists packages with their metadata.
+
+    Done packages are skipped before sampling, so that the sample only
+    counts packages of this run; see `restore_sample()` for the rest. """
+    module = _module(args.ecosystem)
+    start, stop = args.start, args.stop
+    ordered = False  # whether names are sorted
+    if args.ecosystem == 'npm':
+        # the dump lists documents, so packages are cheaper to create here
+        from . import npm
+        items = ((package.name, package) for package in npm.Package.all(
+            cache_file=args.dump, compact=True, fields=npm.TABLE_FIELDS))
+    else:
+        # pypi names are normalized as per PEP 503
+        start = start and module.canonical_name(start)
+        stop = stop and module.canonical_name(stop)
+        cache_file = args.cache_dir and os.path.join(
+            args.cache_dir, 'pypi-names.txt')
+        ordered = bool(cache_file) and os.path.isfile(cache_file)
+        items = ((name, None) for name in
+                 module.Package.names(start, cache_file))
+
+    pattern = args.filter and re.compile(args.filter)
+
+    def filtered():
+        for name, package in items:
+            if start and name < start:
+                continue
+            if stop and name >= stop:
+                if ordered:
+                    break
+                continue
+            if pattern and not pattern.search(name):
+                continue
+            if name in done:
+                continue
+            yield name, package
+
+    selected = filtered()
+    if sample is not None:
+        # strata take metadata requests, so they are computed by workers,
+        # see `sampled_rows()`
+        selected = sample.select(selected, name=lambda item: item[0],
+                                 defer_strata=bool(sample.stratum))
+    count = 0
+    for name, package in selected:
+        yield name, package
+        count += 1
+        if args.limit and count >= args.limit:
+            break
+
+
+def rows(ecosystem, command, item):
+    # type: (str, str, tuple) -> Tuple[str, List[dict]]
+    """ Get output rows of a single package; runs in pipeline workers """
+    name, package = item
+    if command == 'enumerate':
+        return name, [{'name': name}]
+    try:
+        package = package or _module(ecosystem).Package.get(name)
+    except PackageDoesNotExist:
+        logger.info("Package %s does not exist", name)
+        return name, []
+
+    if command == 'metadata':
+        releases = package.releases(True, True)
+        return name, [{
+            'name': name,
+            'version': releases[-1][0] if releases else None,
+            'releases': len(releases),
+            'license': package.meta.get('license'),
+            'repository': package.repository,
+        }]
+    if command == 'repos':
+        return name, [{'name': name, 'repository': package.repository}]
+
+    res = []
+    for version, date in package.releases(True, True):
+        row = {'name': name, 'version': version, 'date': date}
+        try:
+            if command == 'deps':
+                deps = package.dependencies(version) or {}
+                row.update(deps=",".join(sorted(deps)),
+                           raw_dependencies=json.dumps(deps, sort_keys=True))
+            else:  # size
+                row['loc'] = package.loc_size(version)
+        except Exception as e:
+            # a single broken release shouldn't cost the whole package
+            logger.warning("%s %s: %s", name, version, e)
+            continue
+        res.append(row)
+    return name, res
+
+
+def sampled_rows(ecosystem, command, strata, item):
+    # type: (str, str, str, tuple) -> Tuple[str, List[dict], str]
+    """ Get output rows and the stratum of a sampled package; runs in
+    pipeline workers, to keep metadata requests out of the enumeration """
+    name, package_rows = rows(ecosystem, command, item)
+    stratum = _stratum(ecosystem, sampling.STRATA[strata])(item)
+    return name, package_rows, stratum
+
+
+def package_values(command, package_rows):
+    # type: (str, List[dict]) -> Dict[str, float]
+    """ Values to estimate from a sample, per package; release values
+    are taken from the latest release """
+    if not package_rows:
+        return {}
+    last = package_rows[-1]
+    if command == 'metadata':
+        return {'releases': last['releases'],
+                'has_repository': bool(last['repository'])}
+    if command == 'repos':
+        return {'has_repository': bool(last['repository'])}
+    if command == 'deps':
+        return {'dependencies': len(json.loads(last['raw_dependencies'])),
+                'releases': len(package_rows)}
+    if command == 'size':
+        return {'loc': last['loc']}
+    return {}
+
+
+def read_checkpoint(path):
+    # type: (str) -> Dict[str, Optional[str]]
+    """ Read done packages of an interrupted run, {name: stratum}.
+    Strata are only recorded for stratified samples, None otherwise """
+    done = {}
+    with io.open(path, encoding='utf8') as fh:
+        for line in fh:
+            name, _, stratum = line.rstrip("\n").partition("\t")
+            done[name] = stratum or None
+    return done
+
+
+def read_output(path, fmt):
+    # type: (str, str) -> Dict[str, List[dict]]
+    """ Read rows written by an interrupted run, grouped by package """
+    res = collections.OrderedDict()
+    if six.PY2:
+        fh = open(path, 'rb')
+    else:
+        fh = io.open(path, encoding='utf8', newline='')
+    with fh:
+        if fmt == 'csv':
+            # empty CSV cells were None before writing
+            lines = ({key: value if value != '' else None
+                      for key, value in row.items()}
+                     for row in csv.DictReader(fh))
+        else:
+            lines = (json.loads(line) for line in fh if line.strip())
+        for row in lines:
+            res.setdefault(row['name'], []).append(row)
+    return res
+
+
+def restore_sample(args, sample, done, values):
+    # type: (argparse.Namespace, sampling.StratifiedSample, Dict[str, Optional[str]], Dict[str, Dict[str, float]]) -> int
+    """ Register sampled packages processed by an interrupted run, with
+    their strata from the checkpoint and values from the output, so that
+    estimates of a resumed run cover the whole sample.
+    Returns the number of restored packages. """
+    outputs = {}
+    if args.output and os.path.isfile(args.output):
+        outputs = read_output(args.output, args.format)
+    count = 0
+    for name, stratum in done.items():
+        if sampling.sample_key(name, sample.seed) >= sample.fraction:
+            continue  # processed, but not sampled with these parameters
+        if sample.stratum and stratum is None:
+            logger.warning("Stratum of %s is not in the checkpoint, "
+                           "it is left out of estimates", name)
+            continue
+        sample.add(name, stratum or 'all')
+        for column, value in package_values(
+                args.command, outputs.get(name, [])).items():
+            values[column][name] = value
+        count += 1
+    return count
+
+
+class Writer(object):
+    """ Append rows to the output in CSV or JSON lines format """
+    def __init__(self, path, fmt, columns, append=False):
+        self.fmt = fmt
+        self.columns = columns
+        new = not (append and path and os.path.isfile(path) and
+                   os.path.getsize(path))
+        if not path:
+            self.fh = sys.stdout
+        elif six.PY2:  # csv module in Python 2 only supports byte streams
+            self.fh = open(path, 'ab' if append else 'wb')
+        else:
+            self.fh = io.open(path, 'a' if append else 'w',
+                              encoding='utf8', newline='')
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.fh, columns)
+            if new:
+                self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.fmt == 'csv':
+                self.writer.writerow(row)
+            else:
+                self.fh.write(six.text_type(json.dumps(row)) + u"\n")
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+
+
+def run(args):
+    """ Process packages and write the output; returns number of rows """
+    configure(args)
+
+    done = {}  # done[name] = stratum or None
+    checkpoint = None
+    if args.resume:
+        if os.path.isfile(args.resume):
+            done = read_checkpoint(args.resume)
+            logger.info("Resuming, %d packages are done", len(done))
+        checkpoint = io.open(args.resume, 'a', encoding='utf8')
+
+    sample = None
+    values = collections.defaultdict(dict)  # values[column][name]
+    if args.sample:
+        stratum = args.strata and _stratum(
+            args.ecosystem, sampling.STRATA[args.strata])
+        sample = sampling.StratifiedSample(args.sample, args.seed, stratum)
+        if done:
+            logger.info("%d sampled packages restored",
+                        restore_sample(args, sample, done, values))
+
+    writer = Writer(args.output, args.format, COLUMNS[args.command],
+                    append=bool(args.resume))
+    if sample is not None and sample.stratum:
+        # (name, rows, stratum); strata are registered as they come
+        func = functools.partial(
+            sampled_rows, args.ecosystem, args.command, args.strata)
+    else:
+        func = functools.partial(rows, args.ecosystem, args.command)
+    stage = pipeline.Stage(func, args.workers, processes=args.processes,
+                           skip_errors=True)
+    count = 0
+    try:
+        for result in pipeline.pipeline(
+                packages(args, done, sample), [stage]):
+            name, package_rows = result[:2]
+            writer.write(package_rows)
+            count += len(package_rows)
+            line = name
+            if len(result) > 2:
+                sample.add(name, result[2])
+                # to restore the sample on resume, see `restore_sample()`
+                line += u"\t" + result[2]
+            if sample is not None:
+                for column, value in package_values(
+                        args.command, package_rows).items():
+                    values[column][name] = value
+            # rows are flushed before the package is marked as done
+            if checkpoint is not None:
+                checkpoint.write(line + u"\n")
+                checkpoint.flush()
+    finally:
+        writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+    if sample is not None:
+        print(sample.report(values), file=sys.stderr)
+    return count
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m stecosystems",
+        description="Crawl package ecosystems")
+    parser.add_argument('command', choices=sorted(COLUMNS))
+    parser.add_argument('ecosystem', choices=ECOSYSTEMS)
+    parser.add_argument('-w', '--workers', type=int,
+                        help="number of packages processed in parallel; "
+                             "twice the number of CPUs by default")
+    parser.add_argument('--processes', action='store_true',
+                        help="use processes instead of threads, "
+                             "for CPU-bound commands")
+    parser.add_argument('-o', '--output', help="output file, stdout "
+                                               "by default")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='csv')
+    parser.add_argument('--resume', metavar="CHECKPOINT",
+                        help="file to record processed packages in; if it "
+                             "exists, they are skipped and the output is "
+                             "appended to")
+    parser.add_argument('--filter', metavar="REGEX",
+                        help="only process package names matching it")
+    parser.add_argument('--start', help="skip names smaller than this one")
+    parser.add_argument('--stop', help="skip names starting from this one")
+    parser.add_argument('--limit', type=int,
+                        help="max number of packages to process")
+    parser.add_argument('--sample', type=float, metavar="FRACTION",
+                        help="process a reproducible sample of packages "
+                             "and print estimates to stderr")
+    parser.add_argument('--seed', default=0, help="sample seed")
+    parser.add_argument('--strata', choices=sorted(sampling.STRATA),
+                        help="stratify the sample by the number of "
+                             "releases or the year of the first release")
+    parser.add_argument('--cache-dir',
+                        help="pypi: directory for archives, names, setup.py, "
+                             "LOC and known failures caches")
+    parser.add_argument('--mirror', help="local registry mirror, "
+                                         "see stecosystems.mirror")
+    parser.add_argument('--dump', help="npm: _all_docs dump file, "
+                                       "the registry by default")
+    parser.add_argument('--trace', help="trace file, see stecosystems.trace")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    count = run(args)
+    logger.info("%d rows written", count)
+
+
+if __name__ == '__main__':
+    main()
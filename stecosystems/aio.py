@@ -0,0 +1,166 @@
+
+""" Asynchronous metadata crawler, Python 3.6+ only
+
+Fetching package metadata is pure latency-bound HTTP, so a single event
+loop can keep many more requests in flight than a pool of threads:
+
+    async for package in crawl(names, concurrency=100):
+        print(package.name, package.latest_ver)
+
+or, from synchronous code:
+
+    for package in crawl_sync(names, concurrency=100):
+        ...
+
+Requires aiohttp (`pip install aiohttp`).
+"""
+
+import asyncio
+import logging
+
+from .base import TIMEOUT
+from . import pypi
+
+DEFAULT_CONCURRENCY = 50
+# same as BasePackage._request(): three attempts, then give up
+ATTEMPTS = 3
+# delay before the first retry, seconds; doubled for every next one
+RETRY_DELAY = 1
+# rate limiting and server errors are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+logger = logging.getLogger('stecosystems.aio')
+
+
+async def _aiter(names):
+    """ Convert a regular or asynchronous iterable into async iterator """
+    if hasattr(names, '__aiter__'):
+        async for name in names:
+            yield name
+    else:
+        for name in names:
+            yield name
+
+
+async def _fetch(session, package_class, name, compact):
+    """ Async counterpart of `package_class(name)`
+
+    Local sources (mirror, npm dump index, PyPI negative cache) are checked
+    first, same as in the synchronous `_fetch_info()`. Only 404 means the
+    package doesn't exist; 429 and 5xx responses, timeouts and connection
+    errors are retried with exponential backoff, anything else raises IOError.
+    """
+    import aiohttp
+
+    info = package_class._local_info(name)
+    if info is not None:
+        return package_class(name, info=info, compact=compact)
+
+    url = package_class._info_url(name)
+    error = "Failed to reach %s." % package_class.base_url
+    for attempt in range(ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            async with session.get(url) as response:
+                if response.status == 404:
+                    raise package_class._not_found(name)
+                if response.status in RETRY_STATUSES:
+                    error = "%s responded %d" % (url, response.status)
+                    continue
+                if response.status != 200:
+                    raise IOError("%s responded %d" % (url, response.status))
+                # malformed JSON raises ValueError, skipped by crawl()
+                info = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            continue
+        except aiohttp.ClientError as e:
+            error = "Failed to retrieve %s: %s" % (url, e)
+            continue
+        return package_class(name, info=info, compact=compact)
+    raise IOError(error)
+
+
+async def crawl(names, package_class=pypi.Package,
+                concurrency=DEFAULT_CONCURRENCY, compact=False):
+    """ Fetch metadata of the specified packages concurrently
+
+    Packages are yielded in order of completion, not in order of names.
+    Missing packages and malformed metadata are skipped, like in
+    `Package.all()`. Network errors which persist after retries (e.g. the
+    registry is down or keeps rate limiting) are raised as IOError, since
+    skipping them would silently drop existing packages.
+
+    Names are consumed lazily and there are never more than `concurrency`
+    requests in flight, so memory use doesn't depend on the number of names.
+    If the consumer stops iteration or the task running it is cancelled,
+    in-flight requests are cancelled as well.
+
+    Args:
+        names (Union[Iterable[str], AsyncIterable[str]]): package names
+        package_class (type): `pypi.Package` or `npm.Package`
+        concurrency (int): max number of simultaneous requests
+        compact (bool): create packages in compact mode,
+            see `stecosystems.compact`
+
+    Yields:
+        BasePackage: package_class instances
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("Please install aiohttp to use async crawler")
+
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+            timeout=timeout, connector=connector) as session:
+        names = _aiter(names)
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < concurrency:
+                    try:
+                        name = await names.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(
+                        _fetch(session, package_class, name, compact)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        package = task.result()
+                    except ValueError as e:
+                        # PackageDoesNotExist is a subclass of ValueError
+                        logger.debug("Skipping package: %s", e)
+                        continue
+                    yield package
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await names.aclose()
+
+
+def crawl_sync(names, **kwargs):
+    """ Synchronous wrapper for `crawl()`, accepting the same parameters.
+    Runs a new event loop in the calling thread.
+    """
+    loop = asyncio.new_event_loop()
+    agen = crawl(names, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
@@ -1,32 +1,272 @@
 
+import collections
+import functools
+import importlib
 import logging
+import threading
+import weakref
 
-import requests
 import six
 
-import stscraper as scraper
 import stutils
-import stutils.decorators as d
 from stutils import versions
 
+
+class LazyModule(object):
+    """ Module proxy importing the actual module on first attribute access
+
+    `requests`, `stscraper` and especially `pandas` (pulled by
+    `stutils.decorators`) take hundreds of milliseconds to import,
+    which is a lot for short-lived workers that might never use them.
+
+    >>> json = LazyModule('json')
+    >>> json.loads('[1]')
+    [1]
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._name
+
+
+requests = LazyModule('requests')
+scraper = LazyModule('stscraper')
+d = LazyModule('stutils.decorators')
+
 TIMEOUT = stutils.get_config('PYPI_TIMEOUT', 10)
-urlretrieve = six.moves.urllib.request.urlretrieve
 logger = logging.getLogger('stecosystems')
 
 
+def urlretrieve(url, filename=None):
+    # urllib.request (and, transitively, ssl & http.client) is imported
+    # by six.moves on first use
+    return six.moves.urllib.request.urlretrieve(url, filename)
+
+
+def _argstring(*args):
+    # same as stutils.decorators._argstring, to keep cache keys compatible
+    return "_".join([str(arg).replace("/", ".") for arg in args])
+
+
+# locks by key, see `key_lock()`
+_key_locks = weakref.WeakValueDictionary()
+# guards `_key_locks` and creation of per-instance caches
+_locks_lock = threading.Lock()
+
+
+def key_lock(key):
+    # type: (Hashable) -> threading.RLock
+    """ Get a process-wide lock of the key, e.g. of a path to work on.
+    The lock is shared while anybody holds a reference to it.
+
+    >>> key_lock('/tmp/foo') is key_lock('/tmp/foo')
+    True
+    """
+    with _locks_lock:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = threading.RLock()
+            _key_locks[key] = lock
+        return lock
+
+
+def cached_method(func):
+    """ Memoize for class methods
+
+    Same as `stutils.decorators.cached_method`, but doesn't require
+    to import `stutils.decorators` (and thus pandas) at class definition.
+    It is also thread-safe: concurrent calls with the same arguments wait
+    for the first one instead of computing the result again, since shared
+    instances (see `BasePackage.get()`) are used by many threads.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        key = _argstring((func.__name__,) + args)
+        cache = getattr(self, '_cache', None)
+        if cache is not None and key in cache:
+            return cache[key]
+        with _locks_lock:
+            if not hasattr(self, '_cache'):
+                self._cache = {}
+                self._cache_locks = {}
+            lock = self._cache_locks.setdefault(key, threading.RLock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = func(self, *args)
+            result = self._cache[key]
+        with _locks_lock:
+            self._cache_locks.pop(key, None)
+        return result
+    return wrapper
+
+
+def cached_property(func):
+    return property(cached_method(func))
+
+
+class _LazyFSCacher(object):
+    """ Postpones creation of `stutils.decorators.fs_cache` helper
+    (and its cache directory) until the decorated function is used
+    """
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        functools.update_wrapper(self, func)
+        self._args = args
+        self._kwargs = kwargs
+        self._cacher = None
+
+    def _load(self):
+        if self._cacher is None:
+            self._cacher = d.fs_cache(*self._args, **self._kwargs)(self.func)
+        return self._cacher
+
+    def __call__(self, *args):
+        return self._load()(*args)
+
+    def __getattr__(self, attr):
+        # expired(), cached(), invalidate(), get_cache_fname() etc
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+
+def fs_cache(*args, **kwargs):
+    """ Lazy counterpart of `stutils.decorators.fs_cache`
+
+    Accepts the same parameters. Neither `stutils.decorators` nor cache
+    folders are touched until the decorated function is called.
+    """
+    def decorator(func):
+        return _LazyFSCacher(func, args, kwargs)
+    return decorator
+
+
 class PackageDoesNotExist(ValueError):
     pass
 
 
+class InstanceRegistry(object):
+    """ Thread-safe map of shared instances. The `size` most recently used
+    ones are kept alive; older ones are only kept while referenced
+    elsewhere.
+
+    >>> registry = InstanceRegistry(size=1)
+    >>> class Obj(object): pass
+    >>> a, b = Obj(), Obj()
+    >>> registry.add('a', a) is a, registry.add('a', b) is a
+    (True, True)
+    >>> _ = registry.add('b', b)  # evicts 'a' from recently used
+    >>> len(registry)  # but it is still referenced by `a`
+    2
+    >>> del a
+    >>> registry.get('a') is None, len(registry)
+    (True, 1)
+    """
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()  # LRU, strong references
+        self._alive = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._alive)
+
+    def _touch(self, key, value):
+        # should be called with the lock acquired
+        self._recent.pop(key, None)
+        self._recent[key] = value
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            value = self._alive.get(key)
+            if value is not None:
+                self._touch(key, value)
+            return value
+
+    def add(self, key, value):
+        """ Register the value, unless there is one already.
+        Returns the registered value """
+        with self._lock:
+            value = self._alive.setdefault(key, value)
+            self._touch(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._alive.clear()
+
+
 class BasePackage(object):
     base_url = None
+    mirror = None  # local mirror, see stecosystems.mirror
+    mirror_class = None  # mirror layout of the registry
     name = None  # package name
+    # max number of recently used instances kept alive by `get()`;
+    # note that pypi packages keep extracted releases until collected
+    registry_size = 256
+    _registry = None  # InstanceRegistry of every subclass, see `get()`
+    _registry_lock = threading.Lock()
 
     @classmethod
     def all(cls, **kwargs):
         # type: (**dict) -> BasePackage
         raise NotImplementedError
 
+    @classmethod
+    def normalize_name(cls, name):
+        # type: (str) -> str
+        """ Key of the package name in the registry, see `get()` """
+        return name
+
+    @classmethod
+    def registry(cls):
+        # type: () -> InstanceRegistry
+        """ Process-wide registry of instances of this class """
+        registry = cls.__dict__.get('_registry')
+        if registry is None:
+            with cls._registry_lock:
+                registry = cls.__dict__.get('_registry')
+                if registry is None:
+                    registry = InstanceRegistry(cls.registry_size)
+                    cls._registry = registry
+        return registry
+
+    @classmethod
+    def get(cls, name, **kwargs):
+        """ Get a shared package instance, so that results memoized by
+        `cached_method` and `cached_property` survive between calls.
+        Use it instead of the constructor wherever the same package might
+        be created again, e.g. in worker loops.
+
+        Instances are keyed by the normalized name and keyword arguments
+        (e.g. `compact`); `info` is only used to create a new instance.
+        Two threads asking for the same new package at the same time might
+        both create it, but only the first one is registered and returned.
+        """
+        info = kwargs.pop('info', None)
+        key = (cls.normalize_name(name),) + tuple(sorted(kwargs.items()))
+        registry = cls.registry()
+        package = registry.get(key)
+        if package is None:
+            package = registry.add(key, cls(name, info=info, **kwargs))
+        return package
+
     def __init__(self, name, **kwargs):
         """
         Args:
@@ -45,6 +285,41 @@ class BasePackage(object):
     def __repr__(self):
         return "<?? package: %s>" % self.name
 
+    @classmethod
+    def _mirror_info(cls, name):
+        # type: (str) -> Optional[dict]
+        """ Get package info from the local mirror, if configured.
+
+        Returns None if there is no mirror or the package is not found,
+        so remote registry should be used.
+        Raises PackageDoesNotExist on a miss if the fallback is disabled.
+        """
+        if cls.mirror is None:
+            return None
+        info = cls.mirror.metadata(name)
+        if info is None and not cls.mirror.fallback:
+            raise PackageDoesNotExist(
+                "Package %s is not found in %s" % (name, cls.mirror))
+        return info
+
+    @classmethod
+    def _local_info(cls, name):
+        # type: (str) -> Optional[dict]
+        """ Get package info without asking the registry, e.g. from
+        the mirror. Used by the sync and async (`aio`) fetchers alike.
+
+        Returns None if the registry has to be asked.
+        Raises PackageDoesNotExist if the package is known to be missing.
+        """
+        return cls._mirror_info(name)
+
+    @classmethod
+    def _not_found(cls, name):
+        # type: (str) -> PackageDoesNotExist
+        """ Get the exception to raise if the registry responds 404 """
+        return PackageDoesNotExist(
+            "Package %s does not exist or not public" % name)
+
     @classmethod
     def _request(cls, *path):
         if path and not (path[0].startswith('https://') or path[0].startswith('http://')):
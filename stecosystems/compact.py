@@ -0,0 +1,271 @@
+
+""" Compact in-memory representation of package metadata
+
+PyPI and npm JSON documents contain a lot of data not used by `Package`
+methods, most notably READMEs (`description`, per-version `readme`).
+Records in this module keep only the used fields in `__slots__` objects,
+with interned short strings and array-backed release tables.
+
+Records mimic read-only dicts (`record['field']`, `record.get('field')`),
+so they can be used in place of the original JSON by `Package` methods
+and helpers like `json_path()`.
+
+>>> meta = PypiMeta.from_json({'name': 'six', 'version': '1.12.0',
+...                            'description': 'long README'})
+>>> meta['name'], meta.get('description'), meta.get('license', '')
+('six', None, '')
+>>> table = ReleaseTable.from_json({'1.0': [
+...     {'url': 'https://files/six-1.0.tar.gz', 'packagetype': 'sdist',
+...      'upload_time': '2010-01-01T10:10:10', 'size': 100}], '1.1': []})
+>>> '1.0' in table, len(table['1.1'])
+(True, 0)
+>>> f = table['1.0'][0]
+>>> f['packagetype'], f['upload_time'], f['size']
+('sdist', '2010-01-01', 100)
+"""
+
+from array import array
+import datetime
+import re
+
+import six
+
+from .base import scraper
+
+# file types by their code in ReleaseTable
+PACKAGETYPES = ("sdist", "bdist_wheel", "bdist_egg", "bdist_rpm", "bdist_deb",
+                "bdist_wininst", "bdist_dumb", "bdist_msi", "bdist_dmg", "")
+# strings shorter than this are interned to share them across packages
+INTERN_LIMIT = 64
+# max number of repository URLs kept from the description, see `PypiMeta`
+DESCRIPTION_URLS_LIMIT = 3
+
+
+def _intern(value):
+    if isinstance(value, six.text_type) and len(value) < INTERN_LIMIT:
+        if six.PY2:  # intern() only accepts byte strings in Python 2
+            try:
+                return intern(value.encode('ascii'))
+            except UnicodeEncodeError:
+                return value
+        return six.moves.intern(value)
+    return value
+
+
+class Record(object):
+    """ Base class for __slots__ records providing dict-like read access
+
+    Missing fields are stored as None and behave like missing dict keys.
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(**{field: _intern(item.get(field))
+                      for field in cls.__slots__})
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def keys(self):
+        return [field for field in self.__slots__
+                if getattr(self, field) is not None]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % (key, self[key]) for key in self.keys()))
+
+
+def _description_urls(description, name):
+    # type: (Optional[str], Optional[str]) -> Optional[str]
+    """ Repository URLs in the description which might be named after
+    the package, newline separated
+
+    >>> _description_urls("Fork of github.com/a/b, see github.com/a/Foo_Bar"
+    ...                   " or https://github.com/a/foo-bar.git", 'foo.bar')
+    'github.com/a/Foo_Bar\\ngithub.com/a/foo-bar.git'
+    """
+    if not description or not name:
+        return None
+
+    def key(repo_name):
+        # PEP 503 normalization, names on PyPI and GitHub might differ in it
+        return re.sub(r"[-_.]+", "-", repo_name).lower()
+
+    name = key(name)
+    urls = []
+    for m in scraper.URL_PATTERN.finditer(description):
+        url = m.group(0)
+        repo_name = url[:-4] if url.endswith('.git') else url
+        if key(repo_name.rsplit("/", 1)[-1]) == name and url not in urls:
+            urls.append(url)
+            if len(urls) >= DESCRIPTION_URLS_LIMIT:
+                break
+    return "\n".join(urls) or None
+
+
+class PypiMeta(Record):
+    """ Fields of PyPI JSON API `info` section used by pypi.Package
+
+    The description is not kept, but repository URLs it mentions are
+    (`description_urls`), so that `pypi.find_repositories()` gives the same
+    results for compact and full metadata.
+    """
+    __slots__ = ('name', 'version', 'home_page', 'download_url',
+                 'project_urls', 'author', 'author_email', 'license',
+                 'description_urls')
+
+    @classmethod
+    def from_json(cls, item):
+        record = super(PypiMeta, cls).from_json(item)
+        if record.project_urls:
+            record.project_urls = {
+                _intern(key): url for key, url in record.project_urls.items()}
+        record.description_urls = _description_urls(
+            item.get('description'), item.get('name'))
+        return record
+
+
+class FileInfo(object):
+    """ A view of a single file in a ReleaseTable, mimicking the PyPI JSON
+    API file description. `upload_time` is truncated to the date.
+    """
+    __slots__ = ('_table', '_idx')
+
+    def __init__(self, table, idx):
+        self._table = table
+        self._idx = idx
+
+    def __getitem__(self, key):
+        table, idx = self._table, self._idx
+        if key == 'url':
+            return table.urls[idx]
+        if key == 'filename':
+            return table.urls[idx].rsplit("/", 1)[-1]
+        if key == 'packagetype':
+            return PACKAGETYPES[table.packagetypes[idx]]
+        if key == 'upload_time':
+            return datetime.date.fromordinal(table.dates[idx]).isoformat()
+        if key == 'size':
+            return table.sizes[idx]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class ReleaseTable(object):
+    """ Array-backed replacement of PyPI JSON API `releases` section
+
+    Files of all releases are stored in columns; files of the i-th release
+    occupy rows `offsets[i]:offsets[i+1]`.
+    """
+    __slots__ = ('labels', '_index', 'offsets', 'urls', 'packagetypes',
+                 'dates', 'sizes')
+
+    def __init__(self):
+        self.labels = []
+        self._index = {}  # label -> position in self.labels
+        self.offsets = array('L', [0])
+        self.urls = []
+        self.packagetypes = array('B')
+        self.dates = array('L')  # date ordinals
+        self.sizes = array('L')
+
+    @classmethod
+    def from_json(cls, releases):
+        # type: (Dict[str, List[dict]]) -> ReleaseTable
+        table = cls()
+        for label, files in releases.items():
+            table._index[_intern(label)] = len(table.labels)
+            table.labels.append(_intern(label))
+            for info in files:
+                table.urls.append(info['url'])
+                pkgtype = info.get('packagetype') or ""
+                table.packagetypes.append(PACKAGETYPES.index(pkgtype)
+                                          if pkgtype in PACKAGETYPES
+                                          else len(PACKAGETYPES) - 1)
+                date = datetime.datetime.strptime(
+                    info['upload_time'][:10], "%Y-%m-%d").date()
+                table.dates.append(date.toordinal())
+                table.sizes.append(info.get('size') or 0)
+            table.offsets.append(len(table.urls))
+        return table
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def keys(self):
+        return list(self.labels)
+
+    def __getitem__(self, label):
+        i = self._index[label]
+        return [FileInfo(self, idx)
+                for idx in range(self.offsets[i], self.offsets[i + 1])]
+
+    def items(self):
+        return [(label, self[label]) for label in self.labels]
+
+
+class NpmVersion(Record):
+    """ Fields of a single version in npm registry document """
+    __slots__ = ('dependencies', 'ctime', 'mtime', 'dist')
+
+    @classmethod
+    def from_json(cls, item):
+        deps = item.get('dependencies')
+        dist = item.get('dist') or {}
+        return cls(
+            # in some old packages dependencies are lists, keep as is
+            dependencies=({_intern(name): _intern(ver)
+                           for name, ver in deps.items()}
+                          if isinstance(deps, dict) else deps),
+            ctime=_intern(item.get('ctime')),
+            mtime=_intern(item.get('mtime')),
+            dist={'tarball': dist['tarball']} if 'tarball' in dist else None)
+
+
+class NpmDoc(Record):
+    """ Fields of npm registry package document used by npm.Package and
+    table builders in `deprecated`
+    """
+    __slots__ = ('name', 'repository', 'homepage', 'bugs', 'author',
+                 'license', 'time', 'versions')
+
+    @classmethod
+    def from_json(cls, item):
+        record = super(NpmDoc, cls).from_json(item)
+        if isinstance(record.time, dict):
+            record.time = {_intern(ver): _intern(date)
+                           for ver, date in record.time.items()}
+        if isinstance(record.versions, dict):
+            record.versions = {_intern(ver): NpmVersion.from_json(release)
+                               for ver, release in record.versions.items()
+                               if isinstance(release, dict)}
+        return record
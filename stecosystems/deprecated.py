@@ -3,18 +3,19 @@ from collections import defaultdict
 import json
 import os
 
-import pandas as pd
-
-import stutils.email_utils as email
-import stscraper as scraper
-from stutils import decorators as d
-from stutils import mapreduce
-
 from .base import *
 from . import pypi
 from . import npm
+from . import pipeline
+from . import trace
+from . import workqueue
+
+# pandas and email_utils (which imports pandas) are only needed
+# by the functions below, so they're loaded on first use
+pd = LazyModule('pandas')
+email = LazyModule('stutils.email_utils')
 
-fs_cache = d.fs_cache('npm')
+fs_cache = fs_cache('npm')
 
 
 def pypi_packages_info():
@@ -36,7 +37,7 @@ def pypi_packages_info():
     for package_name in pypi.Package.all():
         logger.info("Processing %s", package_name)
         try:
-            p = pypi.Package(package_name)
+            p = pypi.Package.get(str(package_name))
         except pypi.PackageDoesNotExist:
             # some deleted packages aren't removed from the list
             continue
@@ -46,7 +47,7 @@ def pypi_packages_info():
             urls[package_name] = p.repository
 
         try:
-            author_email = email.clean(p.info["info"].get('author_email'))
+            author_email = email.clean(p.meta.get('author_email'))
         except email.InvalidEmail:
             author_email = None
 
@@ -54,7 +55,7 @@ def pypi_packages_info():
             author_projects[author_email].append(package_name)
 
         authors[package_name] = author_email
-        licenses[package_name] = p.info['info']['license']
+        licenses[package_name] = p.meta.get('license')
 
         if p.repository:
             provider, project_url = scraper.parse_url(p.repository)
@@ -89,7 +90,76 @@ def pypi_packages_info():
                         index=names)
 
 
-def pypi_dependencies():
+def _locate_dependencies(item):
+    # download the release; runs in a thread, sharing the package object
+    package, version, release_date = item
+    source_type, path = package._dependencies_source(version)
+    url = source_type == 'setup.py' and \
+        package.download_url(version, 'metadata')
+    # the folder is removed after parsing, not with the package object
+    return (package.name, version, release_date, source_type, path, url,
+            package.detach_dir(version))
+
+
+def _parse_dependencies(item):
+    # parse the located dependencies; runs in a worker process
+    name, version, release_date, source_type, path, url, extract_dir = item
+
+    def get_setup_params(path):
+        params = pypi.setup_params(path)
+        if params is None and url:
+            pypi.add_no_setup(url, path)
+        return params
+
+    try:
+        with trace.span(name, version, 'dependencies'):
+            p_deps = pypi.parse_dependencies(
+                source_type, path, get_setup_params)
+    finally:
+        if extract_dir:
+            pypi.remove_dirs([extract_dir])
+    return {
+        'name': name,
+        'version': version,
+        'date': release_date,
+        'deps': ",".join(p_deps.keys()).lower(),
+        'raw_dependencies': json.dumps(p_deps)
+    }
+
+
+def _read_dependencies_cache(fname):
+    """ Read rows saved by `pypi_dependencies()`, by (name, version) """
+    if not os.path.isfile(fname):
+        logger.info("deps_and_size() cache file doesn't exists. "
+                    "Computing everything from scratch is a lengthy process "
+                    "and will likely take a week or so")
+        return {}
+
+    logger.info("deps_and_size() cache file already exists. "
+                "Existing records will be reused")
+    deps = {}
+    # versions like 1.0 would be read as numbers otherwise
+    df = pd.read_csv(fname, index_col=["name", "version"],
+                     dtype={"name": str, "version": str})
+    for index, row in df.iterrows():
+        item = row.to_dict()
+        item["name"] = index[0]
+        item["version"] = index[1]
+        deps[tuple(index)] = item
+    return deps
+
+
+def _save_dependencies_cache(fname, deps):
+    """ Save rows by (name, version) and return them as a DataFrame """
+    df = pd.DataFrame(deps.values()).sort_values(["name", "version"]).set_index(
+        ["name", "version"], drop=True)
+    df.to_csv(fname)
+    return df
+
+
+def pypi_dependencies(queue_path=None, processes=None,
+                      download_workers=None, parse_workers=None,
+                      prefetch=None):
     """ Get a bunch of information about npm packages
     This will return pd.DataFrame with package name as index and columns:
         - version: version of release, str
@@ -98,73 +168,98 @@ def pypi_dependencies():
         - raw_dependencies: dependencies, JSON dict name: ver
         - raw_test_dependencies
         - raw_build_dependencies
-    """
-    deps = {}
-    fname = fs_cache.get_cache_fname(".deps_and_size.cache")
-
-    if os.path.isfile(fname):
-        logger.info("deps_and_size() cache file already exists. "
-                    "Existing records will be reused")
-
-        def gen(df):
-            d = {}
-            for index, row in df.iterrows():
-                item = row.to_dict()
-                item["name"] = index[0]
-                item["version"] = index[1]
-                d[tuple(index)] = item
-            return d
-
-        deps = gen(pd.read_csv(fname, index_col=["name", "version"]))
-
-    else:
-        logger.info("deps_and_size() cache file doesn't exists. "
-                    "Computing everything from scratch is a lengthy process "
-                    "and will likely take a week or so")
 
-    tp = mapreduce.ThreadPool()
-    logger.info("Starting a threadppol with %d workers...", tp.n)
+    If `queue_path` is specified, releases are processed through a shared
+    `workqueue.WorkQueue` instead of a local pipeline, so that workers
+    on other nodes can join the crawl:
+        python -m stecosystems.workqueue <queue_path>
+    The crawl can be interrupted and resumed with the same queue_path.
+    `processes` is the number of local worker processes in this case.
+    `prefetch` is a dict of `prefetch.Prefetcher` arguments to download
+    releases of the next jobs in background, see `workqueue.work()`.
 
-    package_names = pypi_packages_info().index
+    Otherwise, releases are downloaded by `download_workers` threads and
+    parsed by `parse_workers` processes, see `pipeline.Stage` for defaults.
 
-    def do(pkg_name, ver, release_date):
-        # this method is used by worker threads, calling done() on finish
-        p_deps = pypi.Package(pkg_name).dependencies(ver)
+    Both ways, releases found in the cache file are not processed again,
+    and new results are added to it.
+    """
+    fname = fs_cache.get_cache_fname(".deps_and_size.cache")
+    deps = _read_dependencies_cache(fname)
+    if queue_path:
+        return _pypi_dependencies_queued(
+            queue_path, fname, deps, processes, prefetch)
+
+    def releases():
+        for package_name in pypi_packages_info().index:
+            logger.info("Processing %s", package_name)
+            try:
+                p = pypi.Package.get(package_name, compact=True)
+            except pypi.PackageDoesNotExist:
+                continue
 
-        return {
-            'name': pkg_name,
-            'version': ver,
-            'date': release_date,
+            for version, release_date in p.releases(True, True):
+                if (package_name, version) not in deps:
+                    logger.info("    %s", version)
+                    yield p, version, release_date
+                else:
+                    logger.info("    %s (cached)", version)
+
+    # downloads go to threads, parsing to processes; the number of releases
+    # in flight is bounded, so memory use doesn't grow with the backlog
+    rows = pipeline.pipeline(releases(), [
+        pipeline.Stage(_locate_dependencies, download_workers,
+                       skip_errors=True),
+        pipeline.Stage(_parse_dependencies, parse_workers, processes=True,
+                       skip_errors=True)
+    ], ordered=False)
+    for row in rows:
+        deps[(row["name"], row["version"])] = row
+
+    return _save_dependencies_cache(fname, deps)
+
+
+def _pypi_dependencies_queued(queue_path, fname, deps, processes=None,
+                              prefetch=None):
+    # same as pypi_dependencies(), but through a work queue;
+    # deps are cached rows by (name, version), saved to fname with new ones
+    queue = workqueue.WorkQueue(queue_path)
+    dates = {}  # dates[(name, version)] = release date
+
+    def jobs():
+        for package_name in pypi_packages_info().index:
+            logger.info("Processing %s", package_name)
+            try:
+                p = pypi.Package.get(package_name, compact=True)
+            except pypi.PackageDoesNotExist:
+                continue
+            for version, release_date in p.releases(True, True):
+                if (package_name, version) in deps:
+                    logger.info("    %s (cached)", version)
+                    continue
+                dates[(package_name, version)] = release_date
+                yield package_name, version, 'pypi.dependencies'
+
+    # jobs are inserted in batches, so workers on other nodes can start
+    # while packages are still being enumerated
+    logger.info("Added %d new jobs to %s", queue.add(jobs()), queue_path)
+    if prefetch is None:
+        workqueue.run(queue_path, processes)
+    else:  # jobs are only prefetched within a leased batch
+        workqueue.run(queue_path, processes, batch=16, prefetch=prefetch)
+    logger.info("Jobs by status: %s", queue.stats())
+
+    for name, version, _, p_deps in queue.results('pypi.dependencies'):
+        if (name, version) in deps:  # cached by an earlier run
+            continue
+        deps[(name, version)] = {
+            'name': name,
+            'version': version,
+            'date': dates.get((name, version)),
             'deps': ",".join(p_deps.keys()).lower(),
             'raw_dependencies': json.dumps(p_deps)
         }
-
-    def done(output):
-        deps[(output["name"], output["version"])] = output
-
-    for package_name in package_names:
-        logger.info("Processing %s", package_name)
-        try:
-            p = pypi.Package(package_name)
-        except pypi.PackageDoesNotExist:
-            continue
-
-        for version, release_date in p.releases(True, True):
-            if (package_name, version) not in deps:
-                logger.info("    %s", version)
-                tp.submit(do, package_name, version, release_date, callback=done)
-            else:
-                logger.info("    %s (cached)", version)
-
-    # wait for workers to complete
-    tp.shutdown()
-
-    # save updates
-    df = pd.DataFrame(deps.values()).sort_values(["name", "version"]).set_index(
-        ["name", "version"], drop=True)
-    df.to_csv(fname)
-
-    return df
+    return _save_dependencies_cache(fname, deps)
 
 
 @fs_cache
@@ -177,41 +272,58 @@ def npm_packages_info():
         - deps: dependencies, comma separated string
         - owners
     """
+    return npm_packages_table(npm.Package.all(fields=npm.TABLE_FIELDS))
+
+
+def npm_packages_table(packages):
+    # type: (Iterable[npm.Package]) -> pd.DataFrame
+    """ Same as `npm_packages_info()` for the given packages, not cached.
+    Use it to process only packages changed since the last run, see
+    `npmsync.NpmSync.packages()` """
 
     def gen():
         logger = logging.getLogger("npm.utils.package_info")
-        for package in npm.Package.all():
-            logger.info("Processing %s", package['key'])
+        for package in packages:
+            logger.info("Processing %s", package.name)
+            doc = package.meta
             # TODO: before falling back to str(package), use named pattern
-            repo = npm._get_field(package['doc'].get('repository'), 'url') or \
-                npm._get_field(package['doc'].get('homepage'), 'url') or \
-                npm._get_field(package['doc'].get('bugs'), 'url') or str(package)
+            repo = resolve_field(doc.get('repository'), 'url') or \
+                resolve_field(doc.get('homepage'), 'url') or \
+                resolve_field(doc.get('bugs'), 'url') or str(doc)
 
             m = repo and scraper.URL_PATTERN.search(repo)
 
             yield {
-                'name': package['key'],
+                'name': package.name,
                 'url': m and m.group(0),
-                'author': npm._get_field(package['doc'].get('author', {}), 'email'),
-                'license': npm.json_path(package, 'doc', 'license')
+                'author': resolve_field(doc.get('author', {}), 'email'),
+                'license': json_path(doc, 'license')
             }
 
     return pd.DataFrame(gen()).set_index('name', drop=True)
 
 
-def npm_dependencies():
+def npm_dependencies(packages=None):
     """ Get a bunch of information about npm packages
     This will return pd.DataFrame with package name as index and columns:
         - version: version of release, str
         - date: release date, ISO str
         - deps: names of dependencies, comma separated string
         - raw_dependencies: dependencies, JSON dict name: ver
+
+    Args:
+        packages (Optional[Iterable[npm.Package]]): packages to process,
+            e.g. only changed ones from `npmsync.NpmSync.packages()`.
+            All registry packages by default.
     """
+    if packages is None:
+        packages = npm.Package.all(fields=npm.TABLE_FIELDS)
 
     def gen():
         logger = logging.getLogger("npm.utils.package_info")
-        for package in npm.Package.all():
-            logger.info("Processing %s", package['key'])
+        for package in packages:
+            logger.info("Processing %s", package.name)
+            doc = package.meta
             # possible sources of release date:
             # - ['doc']['time'][<ver>] - best source, sometimes missing
             # - ['doc']['versions'][<ver>]['ctime|mtime']  # e.g. Graph
@@ -219,19 +331,17 @@ def npm_dependencies():
             # - ['doc']['ctime|mtime']  # e.g. Lingo
             # - empty  # JSLint-commonJS
 
-            for version, release in package['doc'].get('versions', {}).items():
+            for version, release in (doc.get('versions') or {}).items():
                 deps = release.get('dependencies') or {}
-                deps = {dep.decode("utf8"): ver
-                        for dep, ver in deps.items()}
-                time = npm.json_path(package, 'doc', 'time', version) or \
-                    npm.json_path(release, 'ctime') or \
-                    npm.json_path(release, 'mtime') or \
-                    npm.json_path(package, 'doc', 'time', 'created') or \
-                    npm.json_path(package, 'doc', 'time', 'modified') or \
+                time = json_path(doc, 'time', version) or \
+                    json_path(release, 'ctime') or \
+                    json_path(release, 'mtime') or \
+                    json_path(doc, 'time', 'created') or \
+                    json_path(doc, 'time', 'modified') or \
                     None
 
                 yield {
-                    'name': package['key'],
+                    'name': package.name,
                     'version': version,
                     'date': time,
                     'deps': ",".join(deps.keys()),
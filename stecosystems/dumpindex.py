@@ -0,0 +1,275 @@
+""" Byte-offset index of the npm registry `_all_docs` dump
+
+Looking up a package in the 14+ GB dump used by `npm.Package.all()` means
+parsing it from the start. This index maps package names to the byte
+range of their rows in the dump, so that a single document is read by
+parsing just its slice of the memory-mapped file:
+
+    index = DumpIndex('/data/npm.json')
+    index.build()  # one-time pass over the dump
+    doc = index.get('left-pad')
+
+or, to make `npm.Package(name)` read from the dump before trying
+the mirror and the registry, set `NPM_DUMP_PATH` config variable or:
+
+    npm.Package.dump = DumpIndex('/data/npm.json')
+
+The index is stored next to the dump, `<dump path>.idx`, as a single binary
+file (all integers are little-endian):
+
+    header:  magic (8 bytes), number of records (uint32),
+             offset of the string table (uint32), dump size (uint64)
+    records: (name offset, name length, row offset, row length),
+             sorted by package name
+    strings: utf8 encoded package names
+
+Lookups are binary searches over the records. Both files are memory-mapped
+read-only, so they can be shared by any number of processes, e.g. shard
+readers, see `names()`.
+
+>>> import tempfile
+>>> dump = os.path.join(tempfile.mkdtemp(), 'npm.json')
+>>> with open(dump, 'wb') as fh:
+...     _ = fh.write(b'{"total_rows":2,"offset":0,"rows":[\\r\\n'
+...                  b'{"id":"b","doc":{"name":"b"}},\\r\\n'
+...                  b'{"id":"a","doc":{"name":"a","x":"}"}}\\r\\n]}')
+>>> index = DumpIndex(dump)
+>>> index.build()
+2
+>>> index.get('a'), 'c' in index, list(index.names())
+({'name': 'a', 'x': '}'}, False, ['a', 'b'])
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+MAGIC = b'STNPMIX1'
+HEADER = struct.Struct('<8sIIQ')
+# offset and length of the name in the string table, row offset and length
+RECORD = struct.Struct('<IHQI')
+
+# strings and brackets, everything else is irrelevant to find row bounds
+_TOKEN = re.compile(br'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+# row of a CouchDB response, which puts every row on its own line
+_ROW_LINE = re.compile(br'^\s*(\{"id":\s*("(?:[^"\\]|\\.)*").*\})\s*,?\s*$',
+                       re.DOTALL)
+_ID = re.compile(br'"id"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+logger = logging.getLogger('stecosystems.dumpindex')
+
+
+def _line_rows(mm, start):
+    """ Iterate (name, offset, length) of rows, one per line.
+    Raises ValueError as soon as a line is not a complete row """
+    pos = start
+    while True:
+        end = mm.find(b'\n', pos)
+        if end < 0:
+            end = len(mm)
+        line = mm[pos:end]
+        stripped = line.strip()
+        if stripped.startswith(b']'):  # end of rows
+            return
+        if stripped:
+            match = _ROW_LINE.match(line)
+            if not match:
+                raise ValueError("Not a single line row at %d" % pos)
+            yield (json.loads(match.group(2).decode('utf8')),
+                   pos + match.start(1), match.end(1) - match.start(1))
+        if end >= len(mm):
+            return
+        pos = end + 1
+
+
+def _scan_rows(mm, start):
+    """ Iterate (name, offset, length) of rows in arbitrarily formatted
+    JSON, tracking nesting of brackets outside of strings """
+    depth = 0
+    row_start = None
+    for match in _TOKEN.finditer(mm, start):
+        token = match.group(0)
+        if token[:1] == b'"':
+            continue
+        if token in (b'{', b'['):
+            if depth == 0:
+                if token == b'[':  # end of rows
+                    raise ValueError("Malformed rows at %d" % match.start())
+                row_start = match.start()
+            depth += 1
+        else:
+            depth -= 1
+            if depth < 0:  # end of rows
+                return
+            if depth == 0:
+                row = mm[row_start:match.end()]
+                name = _ID.search(row)
+                if name:  # rows always have ids, but just in case
+                    yield (json.loads(name.group(1).decode('utf8')),
+                           row_start, match.end() - row_start)
+
+
+def dump_rows(mm):
+    # type: (mmap.mmap) -> Iterator[Tuple[str, int, int]]
+    """ Iterate (package name, offset, length) of rows in the dump """
+    match = re.search(br'"rows"\s*:\s*\[', mm)
+    if match is None:
+        raise ValueError("Not an _all_docs dump: no rows")
+    start = match.end()
+    # fast path for dumps saved as is, i.e. with one row per line;
+    # the whole dump is checked before anything is returned
+    try:
+        return list(_line_rows(mm, start))
+    except ValueError:
+        logger.info("Dump is not line-delimited, scanning JSON tokens")
+    return list(_scan_rows(mm, start))
+
+
+class DumpIndex(object):
+    """ Memory-mapped index of package rows in the `_all_docs` dump """
+    path = None  # index file
+    dump_path = None
+    _mm = None
+    _dump_mm = None
+    _size = 0  # number of records
+    _strings_offset = 0
+
+    def __init__(self, dump_path, path=None):
+        """
+        Args:
+            dump_path (str): `_all_docs?include_docs=true` dump,
+                as accepted by `npm.Package.all()`
+            path (Optional[str]): index file path, `<dump_path>.idx` by
+                default. The file is created by `build()`.
+        """
+        self.dump_path = dump_path
+        self.path = path or dump_path + '.idx'
+        self.reload()
+
+    def __repr__(self):
+        return "<DumpIndex: %s, %d packages>" % (self.dump_path, self._size)
+
+    def reload(self):
+        """ Re-open the index and the dump, e.g. after rebuilding
+        by another process """
+        self.close()
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size, strings_offset, dump_size = HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            mm.close()
+            raise ValueError("%s is not a dump index file" % self.path)
+        if dump_size != os.path.getsize(self.dump_path):
+            mm.close()
+            raise ValueError("%s is outdated, rebuild it" % self.path)
+        with open(self.dump_path, 'rb') as fh:
+            self._dump_mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mm, self._size, self._strings_offset = mm, size, strings_offset
+
+    def close(self):
+        for mm in (self._mm, self._dump_mm):
+            if mm is not None:
+                mm.close()
+        self._mm = self._dump_mm = None
+        self._size = 0
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def _record(self, i):
+        return RECORD.unpack_from(self._mm, HEADER.size + i * RECORD.size)
+
+    def _name(self, i):
+        name_offset, name_len = self._record(i)[:2]
+        start = self._strings_offset + name_offset
+        return self._mm[start:start + name_len]
+
+    def _find(self, name):
+        # type: (str) -> Optional[int]
+        key = name.encode('utf8')
+        lo, hi = 0, self._size
+        while lo < hi:  # lower bound
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._size and self._name(lo) == key:
+            return lo
+        return None
+
+    def row(self, name):
+        # type: (str) -> Optional[bytes]
+        """ Get the raw JSON row of the package, None if it's not indexed """
+        i = self._find(name)
+        if i is None:
+            return None
+        offset, length = self._record(i)[2:]
+        return self._dump_mm[offset:offset + length]
+
+    def get(self, name):
+        # type: (str) -> Optional[dict]
+        """ Get the package document, None if it's not in the dump """
+        row = self.row(name)
+        return row and json.loads(row.decode('utf8')).get('doc')
+
+    def names(self, shard=None):
+        # type: (Optional[Tuple[int, int]]) -> Iterator[str]
+        """ Iterate indexed package names in sorted order
+
+        Args:
+            shard (Optional[Tuple[int, int]]): (i, n) to iterate only
+                the i-th of n contiguous name ranges, for parallel readers
+        """
+        start, stop = 0, self._size
+        if shard is not None:
+            i, n = shard
+            start, stop = self._size * i // n, self._size * (i + 1) // n
+        for i in range(start, stop):
+            yield self._name(i).decode('utf8')
+
+    def build(self):
+        # type: () -> int
+        """ Index the dump, replacing the existing index.
+        Returns the number of indexed packages """
+        with open(self.dump_path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            dump_size = len(mm)
+            try:
+                # the last row wins, as in a dict
+                rows = {name.encode('utf8'): (offset, length)
+                        for name, offset, length in dump_rows(mm)}
+            finally:
+                mm.close()
+
+        names = sorted(rows)
+        strings_len = 0
+        packed = []
+        for name in names:
+            packed.append(RECORD.pack(strings_len, len(name), *rows[name]))
+            strings_len += len(name)
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, len(names),
+                                 HEADER.size + RECORD.size * len(names),
+                                 dump_size))
+            fh.writelines(packed)
+            fh.writelines(names)
+        # atomic on POSIX; processes which mmapped the old file keep using it
+        os.rename(tmp_path, self.path)
+        self.reload()
+        return len(names)
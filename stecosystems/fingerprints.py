@@ -0,0 +1,125 @@
+
+""" Persistent store of per-file and per-release LOC counts
+
+Consecutive releases of a package usually differ in a few files, so LOC
+are counted once per distinct file content, identified by its hash
+(fingerprint), and reused across releases, packages and runs.
+Release totals are stored as well, so that later runs don't even need
+to download known releases. See `pypi.Package.loc_history()`.
+
+Counts are stored in a SQLite database, which can be shared by several
+processes.
+"""
+
+import os
+import sqlite3
+import threading
+
+# line types, as in pylint raw metrics
+LINE_TYPES = ('code', 'docstring', 'comment', 'empty')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT PRIMARY KEY,
+    code INTEGER, docstring INTEGER, comment INTEGER, empty INTEGER
+);
+CREATE TABLE IF NOT EXISTS releases (
+    package TEXT, version TEXT, loc INTEGER,
+    PRIMARY KEY (package, version)
+);
+"""
+# version of `pypi.python_file_loc()`; counts by older versions are dropped
+COUNTER_VERSION = 2
+# max number of SQL variables in a query, SQLite default is 999
+_BATCH_SIZE = 500
+
+
+class FingerprintStore(object):
+    """ LOC counts by file content hash and by release """
+    path = None
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): database file, created if doesn't exist
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < \
+                COUNTER_VERSION:
+            with conn:
+                conn.execute("DELETE FROM files")
+                conn.execute("DELETE FROM releases")
+            conn.execute("PRAGMA user_version = %d" % COUNTER_VERSION)
+
+    def __repr__(self):
+        return "<FingerprintStore: %s>" % self.path
+
+    def _connection(self):
+        # connections can't be shared with forked processes, e.g. pool
+        # workers, which inherit thread locals of the parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def files(self, hashes):
+        # type: (Iterable[str]) -> Dict[str, Dict[str, int]]
+        """ Get known counts of the files by their hashes
+
+        Returns:
+            Dict[str, Dict[str, int]]: counts[hash] = {line type: count},
+                unknown hashes are omitted
+        """
+        hashes = list(set(hashes))
+        res = {}
+        conn = self._connection()
+        for i in range(0, len(hashes), _BATCH_SIZE):
+            batch = hashes[i:i + _BATCH_SIZE]
+            for row in conn.execute(
+                    "SELECT hash, %s FROM files WHERE hash IN (%s)" % (
+                        ", ".join(LINE_TYPES), ", ".join("?" * len(batch))),
+                    batch):
+                res[row[0]] = dict(zip(LINE_TYPES, row[1:]))
+        with self._lock:
+            self.hits += len(res)
+            self.misses += len(hashes) - len(res)
+        return res
+
+    def add_files(self, counts):
+        # type: (Dict[str, Dict[str, int]]) -> None
+        """ Store counts[hash] = {line type: count} """
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                ((digest,) + tuple(c.get(t, 0) for t in LINE_TYPES)
+                 for digest, c in counts.items()))
+
+    def releases(self, package):
+        # type: (str) -> Dict[str, int]
+        """ Get known LOC of the package releases, {version: loc} """
+        return dict(self._connection().execute(
+            "SELECT version, loc FROM releases WHERE package = ?", (package,)))
+
+    def add_release(self, package, version, loc):
+        # type: (str, str, int) -> None
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO releases VALUES (?, ?, ?)",
+                         (package, version, loc))
+
+    def stats(self):
+        # type: () -> Dict[str, float]
+        """ File lookups of this process: hits, misses and hit_rate """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / total if total else 0.0}
@@ -0,0 +1,122 @@
+
+""" Local mirror backends for package metadata and distribution files
+
+If a mirror is configured, `Package` reads metadata JSON and distribution
+archives from the local directory; archives are extracted right from
+the mirror, without copying. On a miss, it falls back to the remote
+registry, unless `fallback` is disabled.
+
+Mirrors can be configured either explicitly:
+
+    pypi.Package.mirror = PypiMirror('/data/pypi')
+
+or with `PYPI_MIRROR_PATH` and `NPM_MIRROR_PATH` config variables.
+"""
+
+import json
+import logging
+import os
+import re
+
+import six
+
+logger = logging.getLogger('stecosystems.mirror')
+
+
+class Mirror(object):
+    """ Base class for local mirrors """
+    path = None
+    fallback = True
+
+    def __init__(self, path, fallback=True):
+        """
+        Args:
+            path (str): mirror root directory
+            fallback (bool): whether to use the remote registry if
+                the package or file is not found in the mirror
+        """
+        self.path = path
+        self.fallback = fallback
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.path)
+
+    def metadata_paths(self, name):
+        # type: (str) -> Iterable[str]
+        """ Candidate paths to the package metadata file, relative to root
+        """
+        raise NotImplementedError
+
+    def file_relpath(self, url):
+        # type: (str) -> Optional[str]
+        """ Path to the distribution file, relative to root """
+        raise NotImplementedError
+
+    def metadata(self, name):
+        # type: (str) -> Optional[dict]
+        """ Get package metadata, or None if it's not in the mirror """
+        for relpath in self.metadata_paths(name):
+            path = os.path.join(self.path, relpath)
+            try:
+                with open(path, 'rb') as fh:
+                    return json.loads(fh.read().decode('utf8'))
+            except (IOError, OSError):
+                continue
+            except ValueError:
+                logger.warning("Malformed metadata file in mirror: %s", path)
+                return None
+        return None
+
+    def file_path(self, url):
+        # type: (str) -> Optional[str]
+        """ Get absolute path to the distribution file, if it is mirrored """
+        relpath = self.file_relpath(url)
+        if relpath is None:
+            return None
+        path = os.path.join(self.path, relpath)
+        return path if os.path.isfile(path) else None
+
+
+def _url_path(url):
+    # path part of the URL, unquoted, without leading slash
+    return six.moves.urllib.parse.unquote(
+        six.moves.urllib.parse.urlsplit(url).path).lstrip("/")
+
+
+class PypiMirror(Mirror):
+    """ bandersnatch-style PyPI mirror:
+
+        <root>/web/json/<name>  # metadata, as returned by JSON API
+        <root>/web/pypi/<normalized name>/json  # same, newer layout
+        <root>/web/packages/<xx>/<yy>/<hash>/<filename>
+    """
+    def metadata_paths(self, name):
+        normalized = re.sub(r"[-_.]+", "-", name).lower()  # PEP 503
+        return (os.path.join('web', 'json', name),
+                os.path.join('web', 'pypi', normalized, 'json'))
+
+    def file_relpath(self, url):
+        # https://files.pythonhosted.org/packages/xx/yy/<hash>/<filename>
+        path = _url_path(url)
+        if not path.startswith('packages/'):
+            return None
+        return os.path.join('web', path)
+
+
+class NpmMirror(Mirror):
+    """ registry-static style npm mirror:
+
+        <root>/<name>/index.json  # package document
+        <root>/<name>/-/<name>-<version>.tgz  # tarballs
+
+    Scoped packages (@scope/name) are stored in a subfolder of the scope.
+    """
+    def metadata_paths(self, name):
+        return (os.path.join(name, 'index.json'),)
+
+    def file_relpath(self, url):
+        # https://registry.npmjs.org/<name>/-/<name>-<version>.tgz
+        path = _url_path(url)
+        if "/-/" not in path:
+            return None
+        return path
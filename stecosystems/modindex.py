@@ -0,0 +1,198 @@
+
+""" Reverse index of PyPI packages: top level module -> (package, version)
+
+`pypi.Package.modules()` lists modules provided by a release; this index
+answers the opposite question, i.e. which releases provide a given module.
+
+The index is stored in a single binary file, which is memory-mapped
+read-only, so it can be shared by any number of worker processes.
+File layout (all integers are little-endian):
+
+    header:  magic (8 bytes), number of records (uint32),
+             offset of the string table (uint32)
+    records: (module, package, version) triples sorted by module name,
+             each field stored as (offset, length) in the string table
+    strings: utf8 encoded unique strings
+
+Lookups are binary searches over the records, so they take O(log N)
+string comparisons and do not need to load the table into memory.
+Updates merge new records into the table and atomically replace the file;
+readers keep using the old copy until `reload()`.
+
+>>> import tempfile
+>>> index = ModuleIndex(os.path.join(tempfile.mkdtemp(), 'modules.idx'))
+>>> index.update([('yaml', 'PyYAML', '5.1'), ('yaml', 'pyaml', '1.0'),
+...               ('six', 'six', '1.12.0')])
+>>> index.lookup('yaml')
+[('PyYAML', '5.1'), ('pyaml', '1.0')]
+>>> 'numpy' in index, len(index)
+(False, 3)
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'STMODIX1'
+HEADER = struct.Struct('<8sII')
+# offsets and lengths of module name, package name and version
+RECORD = struct.Struct('<IHIHIH')
+
+logger = logging.getLogger('stecosystems.modindex')
+
+
+class ModuleIndex(object):
+    """ Memory-mapped reverse index of modules provided by packages """
+    path = None
+    _fh = None
+    _mm = None
+    _size = 0  # number of records
+    _strings_offset = 0
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): index file path. The file is created by the first
+                call to `update()` if it doesn't exist.
+        """
+        self.path = path
+        self.reload()
+
+    def reload(self):
+        """ Re-open the index file to pick up updates by other processes """
+        self.close()
+        if not os.path.isfile(self.path):
+            return
+        self._fh = open(self.path, 'rb')
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size, self._strings_offset = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a module index file" % self.path)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._fh.close()
+        self._fh = self._mm = None
+        self._size = 0
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, module):
+        return bool(self.lookup(module))
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._mm[start:start + length]
+
+    def _record(self, i):
+        # type: (int) -> tuple
+        return RECORD.unpack_from(self._mm, HEADER.size + i * RECORD.size)
+
+    def _module(self, i):
+        module_offset, module_len = self._record(i)[:2]
+        return self._string(module_offset, module_len)
+
+    def _decode(self, i):
+        rec = self._record(i)
+        return tuple(self._string(rec[j], rec[j+1]).decode('utf8')
+                     for j in (0, 2, 4))
+
+    def lookup(self, module):
+        # type: (str) -> List[Tuple[str, str]]
+        """ Get releases providing the specified top level module
+
+        Args:
+            module (str): top level module name, e.g. `yaml`
+
+        Returns:
+            List[Tuple[str, str]]: sorted list of (package name, version)
+        """
+        key = module.encode('utf8')
+        lo, hi = 0, self._size
+        while lo < hi:  # lower bound
+            mid = (lo + hi) // 2
+            if self._module(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        res = []
+        while lo < self._size and self._module(lo) == key:
+            res.append(self._decode(lo)[1:])
+            lo += 1
+        return res
+
+    def __iter__(self):
+        """ Iterate (module, package, version) records in sorted order """
+        for i in range(self._size):
+            yield self._decode(i)
+
+    def update(self, records):
+        # type: (Iterable[Tuple[str, str, str]]) -> None
+        """ Merge (module, package, version) records into the index
+
+        Records are merged with the existing ones in memory, so it is more
+        efficient to update the index in large batches.
+        """
+        records = set(records)
+        if not records:
+            return
+        records.update(self)
+        records = sorted(tuple(field.encode('utf8') for field in record)
+                         for record in records)
+
+        strings = {}  # strings[value] = offset
+        chunks = []
+        strings_len = 0
+        packed = []
+        for record in records:
+            fields = []
+            for value in record:
+                if value not in strings:
+                    strings[value] = strings_len
+                    chunks.append(value)
+                    strings_len += len(value)
+                fields.extend((strings[value], len(value)))
+            packed.append(RECORD.pack(*fields))
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, len(records),
+                                 HEADER.size + RECORD.size * len(records)))
+            fh.writelines(packed)
+            fh.writelines(chunks)
+        # atomic on POSIX; processes which mmapped the old file keep using it
+        os.rename(tmp_path, self.path)
+        self.reload()
+
+    def add_packages(self, packages):
+        # type: (Iterable[Tuple[pypi.Package, str]]) -> None
+        """ Index modules of the provided package releases
+
+        Args:
+            packages (Iterable[Tuple[pypi.Package, str]]):
+                (package, version) pairs, as in `package.modules(version)`
+        """
+        records = []
+        for package, version in packages:
+            logger.debug("Indexing modules of %s %s", package.name, version)
+            records.extend(
+                (module.split(".", 1)[0], package.name, version)
+                for module in package.modules(version))
+        self.update(records)
+
+    def releases(self):
+        # type: () -> Set[Tuple[str, str]]
+        """ Get (package, version) pairs already present in the index.
+        Useful to skip processed releases while building the index
+        incrementally.
+        """
+        return set(record[1:] for record in self)
@@ -0,0 +1,189 @@
+
+""" Persistent cache of known failures
+
+A full crawl runs into thousands of failures which will happen again
+on the next run: packages deleted but still listed in the index, broken
+download links, sdists without parseable setup(). This cache remembers
+them, with the reason and time, so that they are skipped before any
+network or sandbox work until their time to live expires.
+
+Failures are identified by kind and key:
+
+    missing      PEP 503 normalized package name
+    broken_link  URL of the distribution file
+    no_setup     URL of the sdist which setup() couldn't be parsed from
+
+Distribution files on PyPI are immutable, so file failures are kept
+longer than missing packages, which might be re-uploaded.
+See `DEFAULT_TTL`.
+
+Failures are stored in a SQLite database, which can be shared by several
+processes. To inspect or reset it:
+
+    python -m stecosystems.negcache /data/pypi/.negative.sqlite --clear missing
+
+>>> import tempfile
+>>> cache = NegativeCache(os.path.join(tempfile.mkdtemp(), 'neg.sqlite'))
+>>> cache.add('missing', 'foo', "Package foo does not exist on PyPi")
+>>> cache.get('missing', 'foo')
+'Package foo does not exist on PyPi'
+>>> cache.get('missing', 'bar') is None
+True
+>>> cache.add('missing', 'bar', "gone", timestamp=time.time() - 10 ** 8)
+>>> cache.get('missing', 'bar') is None  # expired
+True
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+# time to live by kind of failure, in seconds; None means forever
+DEFAULT_TTL = {
+    'missing': 7 * 24 * 3600,
+    'broken_link': 30 * 24 * 3600,
+    'no_setup': 365 * 24 * 3600,
+}
+# for kinds not listed above
+FALLBACK_TTL = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    kind TEXT, key TEXT, reason TEXT, timestamp REAL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+
+class NegativeCache(object):
+    """ Known failures by kind and key, with time to live """
+    path = None
+
+    def __init__(self, path, ttl=None):
+        """
+        Args:
+            path (str): database file, created if doesn't exist
+            ttl (Optional[Dict[str, Optional[float]]]): time to live by kind,
+                in seconds, overriding `DEFAULT_TTL`
+        """
+        self.path = path
+        self.ttl = dict(DEFAULT_TTL, **(ttl or {}))
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connection().executescript(SCHEMA)
+
+    def __repr__(self):
+        return "<NegativeCache: %s>" % self.path
+
+    def _connection(self):
+        # connections can't be shared with forked processes, e.g. pool
+        # workers, which inherit thread locals of the parent
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _expired(self, kind, timestamp, now=None):
+        ttl = self.ttl.get(kind, FALLBACK_TTL)
+        return ttl is not None and timestamp + ttl < (now or time.time())
+
+    def get(self, kind, key):
+        # type: (str, str) -> Optional[str]
+        """ Get the reason of a known failure, None if there is no
+        failure or it has expired, i.e. it is time to retry """
+        row = self._connection().execute(
+            "SELECT reason, timestamp FROM failures "
+            "WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        hit = row is not None and not self._expired(kind, row[1])
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if hit else None
+
+    def add(self, kind, key, reason, timestamp=None):
+        # type: (str, str, str, Optional[float]) -> None
+        """ Record a failure, replacing the previous one """
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?)",
+                         (kind, key, reason, timestamp or time.time()))
+
+    def remove(self, kind=None, key=None):
+        # type: (Optional[str], Optional[str]) -> int
+        """ Forget failures of the kind and/or key, all by default.
+        Returns the number of removed records """
+        conditions, params = [], []
+        for column, value in (('kind', kind), ('key', key)):
+            if value is not None:
+                conditions.append(column + " = ?")
+                params.append(value)
+        query = "DELETE FROM failures"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        conn = self._connection()
+        with conn:
+            return conn.execute(query, params).rowcount
+
+    def purge(self):
+        # type: () -> int
+        """ Remove expired records. Returns the number of removed records """
+        now = time.time()
+        expired = [(kind, key) for kind, key, timestamp in
+                   self._connection().execute(
+                       "SELECT kind, key, timestamp FROM failures")
+                   if self._expired(kind, timestamp, now)]
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "DELETE FROM failures WHERE kind = ? AND key = ?", expired)
+        return len(expired)
+
+    def counts(self):
+        # type: () -> Dict[str, int]
+        """ Number of records by kind, including expired ones """
+        return dict(self._connection().execute(
+            "SELECT kind, COUNT(*) FROM failures GROUP BY kind"))
+
+    def stats(self):
+        # type: () -> Dict[str, float]
+        """ Lookups of this process: hits, misses and hit_rate """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / total if total else 0.0}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m stecosystems.negcache",
+        description="Inspect or reset the cache of known failures")
+    parser.add_argument('path', help="cache database file")
+    parser.add_argument('--purge', action='store_true',
+                        help="remove expired records")
+    parser.add_argument('--clear', metavar="KIND", nargs='?', const='',
+                        help="remove records of the kind, all by default")
+    args = parser.parse_args(args)
+
+    if not os.path.isfile(args.path):
+        parser.error("%s does not exist" % args.path)
+    cache = NegativeCache(args.path)
+    if args.purge:
+        print("Removed %d expired records" % cache.purge())
+    if args.clear is not None:
+        print("Removed %d records" % cache.remove(args.clear or None))
+    for kind, count in sorted(cache.counts().items()):
+        print("%-12s %d" % (kind, count))
+
+
+if __name__ == '__main__':
+    main()
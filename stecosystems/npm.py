@@ -13,36 +13,344 @@ extra metrics:
 
 from __future__ import print_function
 
-import urllib
+import collections
+import re
+import tarfile
 
 from .base import *
-from stutils import decorators as d
+from .compact import NpmDoc
+from .dumpindex import DumpIndex
+from .mirror import NpmMirror
+from . import trace
+
+# registry-static mirror to read package documents from, see `mirror`
+NPM_MIRROR_PATH = stutils.get_config('NPM_MIRROR_PATH')
+# indexed `_all_docs` dump to read package documents from, see `dumpindex`
+# and `dump_index()`
+NPM_DUMP_PATH = stutils.get_config('NPM_DUMP_PATH')
+_dump_index = None
+mapreduce = LazyModule('stutils.mapreduce')  # imports pandas
+
+
+def dump_index():
+    # type: () -> Optional[DumpIndex]
+    """ Index of the `NPM_DUMP_PATH` dump, opened on the first use.
+    None if the dump is not configured or the index is outdated. """
+    global _dump_index
+    if _dump_index is None:
+        _dump_index = False
+        if NPM_DUMP_PATH:
+            try:
+                _dump_index = DumpIndex(NPM_DUMP_PATH)
+            except (ValueError, IOError, OSError) as e:
+                logger.warning("Not using the dump index: %s", e)
+    return _dump_index or None
+
+
+# document fields used by table builders in `deprecated`
+TABLE_FIELDS = ('name', 'repository', 'homepage', 'bugs', 'author', 'license',
+                'time', 'ctime', 'mtime', 'versions.*.dependencies',
+                'versions.*.ctime', 'versions.*.mtime')
+_SKIP = object()  # marker of fields not included into projection
+
+
+def projection(fields):
+    # type: (Iterable[str]) -> dict
+    """ Convert dotted field paths into a trie; None marks included subtrees
+
+    >>> projection(['a.b', 'a.c', 'd', 'd.e']) == {
+    ...     'a': {'b': None, 'c': None}, 'd': None}
+    True
+    """
+    trie = {}
+    for field in fields:
+        node = trie
+        keys = field.split('.')
+        for key in keys[:-1]:
+            if key in node and node[key] is None:
+                break  # the parent is already fully included
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+    return trie
+
+
+def _skip(events):
+    """ Skip the rest of a container which start event was consumed """
+    depth = 1
+    for event, _ in events:
+        if event == 'start_map' or event == 'start_array':
+            depth += 1
+        elif event == 'end_map' or event == 'end_array':
+            depth -= 1
+            if not depth:
+                return
+
+
+def project(event, value, events, fields=None):
+    """ Build a JSON value from ijson.basic_parse() events, keeping only
+    the projected fields. Skipped subtrees are consumed without creating
+    any Python objects besides the events themselves.
+
+    It is meant to save memory: on a synthetic dump with READMEs in every
+    release, documents projected to `TABLE_FIELDS` take 16 times less
+    memory, but parsing is only ~10% faster (see
+    `benchmarks/npm_projection.py`). Skipped subtrees are still tokenized,
+    and strings are decoded by the parser. Skipping them at the byte level
+    in pure Python, or with regular expressions, is slower than the yajl
+    backend of ijson.
+
+    Args:
+        event (str): current event
+        value: current event value
+        events (Iterator): the rest of ijson.basic_parse() events
+        fields (Optional[dict]): projection as returned by `projection()`,
+            None to keep everything
+    """
+    if event == 'start_map':
+        obj = {}
+        for event, key in events:
+            if event == 'end_map':
+                return obj
+            # event is 'map_key'
+            if fields is None:
+                subfields = None
+            else:
+                subfields = fields.get(key, fields.get('*', _SKIP))
+            event, value = next(events)
+            if subfields is _SKIP:
+                if event == 'start_map' or event == 'start_array':
+                    _skip(events)
+            else:
+                obj[key] = project(event, value, events, subfields)
+    elif event == 'start_array':
+        arr = []
+        for event, value in events:
+            if event == 'end_array':
+                return arr
+            arr.append(project(event, value, events, fields))
+    return value
+
+
+# files counted by `tarball_loc()`
+JS_EXTENSIONS = ('.js', '.mjs', '.cjs', '.jsx', '.ts', '.mts', '.cts', '.tsx')
+# longest chunk of a line read at once; minified files have huge lines
+MAX_LINE_CHUNK = 65536
+# strings, template literal quotes and comment delimiters
+_JS_TOKEN = re.compile(r"""//|/\*|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`""")
+_JS_TEMPLATE_END = re.compile(r"(?:\\.|[^`\\])*`")
+
+
+class JsLineCounter(object):
+    """ Count lines of JavaScript/TypeScript code by type, keeping state
+    of block comments and template literals between lines.
+
+    Line types are the same as in `pypi.python_file_loc()`, so that sizes
+    line up across ecosystems; `docstring` is always 0. Lines with both code
+    and comments count as code.
+
+    >>> counter = JsLineCounter()
+    >>> for line in (b"/* block", b"  comment */ var a = 1;", b"",
+    ...              b"// comment", b"var s = '// not a comment';"):
+    ...     counter.feed(line)
+    >>> counter.counts == {
+    ...     'code': 2, 'docstring': 0, 'comment': 2, 'empty': 1}
+    True
+    """
+    def __init__(self):
+        self.counts = dict.fromkeys(('code', 'docstring', 'comment', 'empty'), 0)
+        self.in_comment = False
+        self.in_template = False
+        self._last = None  # type of the last counted line
+
+    def reset(self):
+        """ Reset comment state before the next file """
+        self.in_comment = self.in_template = False
+
+    def _scan(self, line):
+        # returns (has_code, has_comment) of a line or its part
+        has_code = has_comment = False
+        pos = 0
+        while pos < len(line):
+            if self.in_comment:
+                has_comment = True
+                end = line.find("*/", pos)
+                if end < 0:
+                    return has_code, has_comment
+                self.in_comment = False
+                pos = end + 2
+                continue
+            if self.in_template:
+                has_code = True
+                match = _JS_TEMPLATE_END.match(line, pos)
+                if not match:
+                    return has_code, has_comment
+                self.in_template = False
+                pos = match.end()
+                continue
+            match = _JS_TOKEN.search(line, pos)
+            end = match.start() if match else len(line)
+            has_code = has_code or bool(line[pos:end].strip())
+            if not match:
+                break
+            token = match.group(0)
+            if token == "//":
+                return has_code, True
+            elif token == "/*":
+                self.in_comment = True
+            elif token == "`":
+                self.in_template = True
+            else:  # string literal
+                has_code = True
+            pos = match.end()
+        return has_code, has_comment
+
+    def feed(self, line, continued=False):
+        # type: (bytes, bool) -> None
+        """ Count a line, without the line break. If `continued`, it is
+        a continuation of the previous chunk of the same physical line """
+        in_code = self.in_template
+        has_code, has_comment = self._scan(line.decode('utf8', 'replace'))
+        has_code = has_code or in_code
+        if continued:
+            if has_code and self._last == 'comment':
+                self.counts['comment'] -= 1
+            elif self._last == 'empty' and (has_code or has_comment):
+                self.counts['empty'] -= 1
+            else:
+                return
+        if has_code:
+            self._last = 'code'
+        elif has_comment or self.in_comment:
+            self._last = 'comment'
+        else:
+            self._last = 'empty'
+        self.counts[self._last] += 1
+
+
+class _CountingReader(object):
+    """ File-like wrapper counting bytes read from a stream """
+    def __init__(self, fh):
+        self.fh = fh
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.bytes += len(data)
+        return data
+
+
+def tarball_loc(fileobj):
+    # type: (file) -> Dict[str, int]
+    """ Count lines of JS/TS files in a .tgz stream, in a single pass and
+    without writing files to disk. Only MAX_LINE_CHUNK bytes of a file are
+    kept in memory at once. Bundled dependencies (node_modules) are skipped.
+
+    Returns:
+        Dict[str, int]: line counts by type as in `JsLineCounter`, plus
+            `files` (number of counted files), `bytes` (compressed size)
+            and `unpacked_bytes` (total size of all files)
+    """
+    reader = _CountingReader(fileobj)
+    counter = JsLineCounter()
+    files = unpacked = 0
+    # streaming mode: members are read sequentially, no seeking
+    with tarfile.open(fileobj=reader, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            unpacked += member.size
+            name = member.name
+            if not name.endswith(JS_EXTENSIONS) or \
+                    "node_modules/" in name:
+                continue
+            fh = tar.extractfile(member)
+            files += 1
+            counter.reset()
+            continued = False
+            while True:
+                chunk = fh.readline(MAX_LINE_CHUNK)
+                if not chunk:
+                    break
+                complete = chunk.endswith(b"\n")
+                counter.feed(chunk.rstrip(b"\r\n"), continued)
+                continued = not complete
+    res = dict(counter.counts)
+    res.update(files=files, bytes=reader.bytes, unpacked_bytes=unpacked)
+    return res
 
 
 class Package(BasePackage):
     base_url = 'http://registry.npmjs.com/'
-    info = None  # stores cached package info
+    _info = None  # stores cached package info, unless in compact mode
+    meta = None  # package info or its compact version
+    compact = False
+    mirror = NPM_MIRROR_PATH and NpmMirror(NPM_MIRROR_PATH)
+    mirror_class = NpmMirror
+    dump = None  # indexed dump, `dump_index()` by default
 
     @classmethod
-    def all(cls, cache_file=None):
+    def all(cls, cache_file=None, compact=False, fields=None):
+        """ Iterate all npm packages from the registry `_all_docs` dump
+
+        Args:
+            cache_file (Optional[Union[str, file]]): local copy of the dump,
+                either a path or a file-like object.
+                The registry is used by default.
+                To read single packages from it, see `dumpindex`.
+            compact (bool): create packages in compact mode
+            fields (Optional[Iterable[str]]): document fields to keep, as
+                dotted paths, `*` matches any key (e.g.
+                `versions.*.dependencies`). Other fields are skipped as
+                they are parsed, without building documents, to save
+                memory; parsing takes about as long, see `project()`.
+                See `TABLE_FIELDS` for fields used by table builders.
+                Whole documents are kept by default.
+        """
         if isinstance(cache_file, six.string_types):
             fh = open(cache_file, 'rb')
-        elif isinstance(cache_file, six.StringIO):
+        elif cache_file is not None:
             fh = cache_file
         else:
             # how to create cache file: wget -O npm.json <url below>
             # it is 14Gb as of Jan 2019
-            fh = urllib.urlopen(
+            fh = six.moves.urllib.request.urlopen(
                 'https://skimdb.npmjs.com/registry/_all_docs?include_docs=true')
 
-        # requires yajl-tools: apt-get install yajl-tools
-        import ijson.backends.yajl2 as ijson
-
-        for package_info in ijson.items(fh, 'rows.item'):
-            package_name = package_info['id']
-            yield Package(package_name, info=package_info['doc'])
-
-    def __init__(self, name, info=None):
+        # the fastest available backend; for the C one, install yajl-tools:
+        #   apt-get install yajl-tools
+        import ijson
+
+        if fields is None:
+            for package_info in ijson.items(fh, 'rows.item'):
+                package_name = package_info['id']
+                yield Package(package_name, info=package_info['doc'],
+                              compact=compact)
+            return
+
+        doc_projection = projection(fields)
+        doc_projection['_id'] = None  # to tell empty docs from missing ones
+        row_projection = {'id': None, 'doc': doc_projection}
+        # basic_parse is considerably faster than parse, as it doesn't
+        # build prefix strings for every event
+        events = ijson.basic_parse(fh)
+        next(events)  # start_map of the root object
+        for event, key in events:
+            if event != 'map_key':  # end_map of the root object
+                break
+            event, value = next(events)
+            if key != 'rows':  # total_rows, offset
+                if event == 'start_map' or event == 'start_array':
+                    _skip(events)
+                continue
+            for event, value in events:  # rows array items
+                if event != 'start_map':  # end_array
+                    break
+                row = project(event, value, events, row_projection)
+                if row.get('doc'):  # deleted packages don't have docs
+                    yield Package(row['id'], info=row['doc'], compact=compact)
+
+    def __init__(self, name, info=None, compact=False):
         """
         Args:
             name (str): package name.
@@ -51,19 +359,55 @@ class Package(BasePackage):
                 ecosystem API lists packages with their metadata, so it's
                 cheaper to reuse it.
                 End users should not use this parameter.
+            compact (bool): keep only metadata used by the class methods
+                in compact records (see `stecosystems.compact`) instead of
+                the full registry document. Full `info` is still available,
+                but will be re-fetched on every access.
         """
-        if info:
-            self.info = info
-        else:
-            try:
-                self.info = self._request(name).json()
-            except IOError:
-                raise PackageDoesNotExist(
-                    "Package %s does not exist or not public" % name)
+        with trace.span(name, None, 'init'):
+            if not info:
+                info = self._fetch_info(name)
+
+            self.compact = compact
+            if compact:
+                self.meta = NpmDoc.from_json(info)
+            else:
+                self._info = self.meta = info
 
         super(Package, self).__init__(name)
 
-    @d.cached_property
+    @classmethod
+    def _info_url(cls, name):
+        return cls.base_url + name
+
+    @classmethod
+    def _local_info(cls, name):
+        # the dump might be outdated, but it's the cheapest source
+        dump = cls.dump or dump_index()
+        info = dump and dump.get(name)
+        if info:
+            return info
+        return cls._mirror_info(name)
+
+    @classmethod
+    def _fetch_info(cls, name):
+        info = cls._local_info(name)
+        if info is not None:
+            return info
+        try:
+            return cls._request(cls._info_url(name)).json()
+        except IOError:
+            raise PackageDoesNotExist(
+                "Package %s does not exist or not public" % name)
+
+    @property
+    def info(self):
+        """ Full package document, as returned by npm registry """
+        if self._info is None:
+            return self._fetch_info(self.name)
+        return self._info
+
+    @cached_property
     def _extra_info(self):
         return requests.get(
             "https://api.npms.io/v2/package/" +
@@ -108,12 +452,29 @@ class Package(BasePackage):
         Returns:
              List[Tuple[str, str]]: (label, date), sorted by date
         """
-        raise NotImplementedError
+        times = self.meta.get('time') or {}
+        releases = sorted(
+            ((label, (times.get(label) or
+                      json_path(release, 'ctime') or "")[:10])
+             for label, release in (self.meta.get('versions') or {}).items()),
+            key=lambda r: r[1])
+
+        if not include_unstable:
+            releases = [(label, date)
+                        for label, date in releases
+                        if re.match(r"^\d+(\.\d+)*$", label)]
+
+        if not include_backports and releases:
+            _rel = []
+            for label, date in releases:
+                if not _rel or versions.compare(label, _rel[-1][0]) >= 0:
+                    _rel.append((label, date))
+            releases = _rel
+
+        return releases
 
     def download_url(self, ver):
-        """Get URL to package file of the specified version
-        This function takes into account supported file types and their
-        relative preference (e.g. wheel files before source packages)
+        """Get URL of the release tarball
 
         Args:
             ver (str): version string
@@ -121,8 +482,8 @@ class Package(BasePackage):
         Returns:
             Optional[str]: url string if found, None otherwise
         """
-        assert ver in self.info['releases']
-        raise NotImplementedError
+        assert ver in self.meta['versions']
+        return json_path(self.meta, 'versions', ver, 'dist', 'tarball')
 
     def download(self, ver=None):
         """Download and extract the specified package version
@@ -136,15 +497,27 @@ class Package(BasePackage):
         """
         raise NotImplementedError
 
-    @d.cached_property
+    @cached_property
     def repository(self):
-        """ Search for software repository URL
+        """ Search for software repository URL in `repository`, `homepage`
+        and `bugs` fields of the package document
 
         Returns:
-            Optional[str]: path to the folder with extracted package,
-                None if download failed
+            Optional[str]: repository URL, None if not found
         """
-        raise NotImplementedError
+        for field in ('repository', 'homepage', 'bugs'):
+            url = resolve_field(self.meta.get(field), 'url')
+            m = isinstance(url, six.string_types) and \
+                scraper.URL_PATTERN.search(url)
+            if m:
+                return m.group(0)
+        return None
+
+    @property
+    def latest_ver(self):
+        """ Label of the latest stable release, None if there are none """
+        releases = self.releases()
+        return releases[-1][0] if releases else None
 
     def dependencies(self, ver=None):
         """ Get technical dependencies
@@ -157,8 +530,65 @@ class Package(BasePackage):
                 `version` might contain platform-specific modifiers, e.g.
                 '>=3.12.1'. If not specified, `version will be `None`.
         """
-        raise NotImplementedError
+        ver = ver or self.latest_ver
+        deps = json_path(self.meta, 'versions', ver, 'dependencies') or {}
+        if isinstance(deps, list):  # some old packages list names only
+            return dict.fromkeys(deps)
+        return dict(deps)
+
+    @cached_method
+    @trace.traced('tarball_loc')
+    def tarball_stats(self, ver):
+        """ Get line counts and sizes of the release tarball, see
+        `tarball_loc()`. The tarball is streamed from the registry
+        (or the mirror) and never written to disk.
+
+        Args:
+            ver (str): version string
+
+        Returns:
+            Optional[Dict[str, int]]: counts, None if there is no tarball
+        """
+        url = self.download_url(ver)
+        if not url:
+            return None
+        fname = self.mirror and self.mirror.file_path(url)
+        if fname:
+            with open(fname, 'rb') as fh:
+                return tarball_loc(fh)
+        if self.mirror and not self.mirror.fallback:
+            logger.warning("Tarball is not mirrored: %s", url)
+            return None
+        response = requests.get(url, stream=True, timeout=TIMEOUT)
+        try:
+            response.raise_for_status()
+            return tarball_loc(response.raw)
+        finally:
+            response.close()
 
     def loc_size(self, ver):
-        """ Get package size in LOC """
-        raise NotImplementedError
+        """ Get size of the release JS/TS code in LOC (code lines only),
+        same as `pypi.Package.loc_size()` """
+        stats = self.tarball_stats(ver)
+        return stats['code'] if stats else 0
+
+    def loc_history(self, include_unstable=True, include_backports=True,
+                    n_workers=None):
+        """ Get LOC size of all package releases in one call, streaming
+        tarballs concurrently. Same as `pypi.Package.loc_history()`.
+
+        Args:
+            include_unstable (bool): see `releases()`
+            include_backports (bool): see `releases()`
+            n_workers (Optional[int]): number of download threads
+
+        Returns:
+            OrderedDict[str, int]: LOC by release label, in order of
+                release date
+        """
+        labels = [label for label, _ in
+                  self.releases(include_unstable, include_backports)]
+        sizes = mapreduce.map(lambda ver, _: self.loc_size(ver),
+                              dict.fromkeys(labels), n_workers)
+        return collections.OrderedDict(
+            (label, sizes.get(label, 0)) for label in labels)
@@ -0,0 +1,256 @@
+
+""" Incremental sync of npm package documents from the registry changes feed
+
+The `_all_docs` dump used by `npm.Package.all()` is 14+ GB, so refreshing
+it is a multi-hour job. The registry is a CouchDB database, and its
+`_changes` feed lists every updated or deleted document after a given
+sequence number. `NpmSync` consumes the feed in batches and keeps
+a per-package local store, in the registry-static layout used by
+`mirror.NpmMirror`:
+
+    <root>/<name>/index.json  # package document
+    <root>/_seq  # last processed sequence number, JSON
+
+so the store doubles as a metadata mirror:
+
+    sync = NpmSync('/data/npm')
+    changed = sync.sync()  # names of updated and deleted packages
+    npm.Package.mirror = NpmMirror('/data/npm')
+    df = deprecated.npm_dependencies(sync.packages(changed))
+
+To bootstrap the store, record the current sequence number before
+downloading the dump, and then import it:
+
+    sync.bootstrap()
+    sync.import_packages(npm.Package.all('npm.json'))
+
+Changes made during the download are replayed on the next `sync()`.
+The registry URL can point to a local stand-in serving the same
+`_changes` and database info endpoints, e.g. a CouchDB replica.
+"""
+
+import collections
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+
+import stutils
+
+from .base import requests, TIMEOUT
+from . import npm
+
+# CouchDB database of the registry, serving `_changes` and `_all_docs`
+NPM_REGISTRY_DB = stutils.get_config(
+    'NPM_REGISTRY_DB', 'https://skimdb.npmjs.com/registry')
+
+# sequence numbers are strings in CouchDB 2+, so they are stored as JSON
+SEQ_FILE = '_seq'
+BATCH_SIZE = 1000
+
+logger = logging.getLogger('stecosystems.npmsync')
+
+
+def _valid_name(name):
+    # type: (str) -> bool
+    """ Check that a document id is a package name safe to use as a path
+
+    >>> _valid_name('left-pad'), _valid_name('@babel/core')
+    (True, True)
+    >>> _valid_name('_design/app'), _valid_name('../etc'), _valid_name('a/b')
+    (False, False, False)
+    """
+    return bool(name) and not name.startswith(('_', '.')) and \
+        re.match(r"^(@[^/@]+/)?[^/@]+$", name) is not None and \
+        ".." not in name.split("/")
+
+
+def _write_atomic(path, data):
+    # type: (str, bytes) -> None
+    """ Write to a temp file and rename, so that readers (and a process
+    killed mid-write) never leave a partially written file """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:  # created concurrently
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    with io.open(fd, 'wb') as fh:
+        fh.write(data)
+    os.rename(tmp_path, path)
+
+
+class NpmSync(object):
+    """ Local store of npm package documents, updated from `_changes` """
+    path = None
+    registry = None
+
+    def __init__(self, path, registry=None):
+        """
+        Args:
+            path (str): store root directory, created on the first write
+            registry (Optional[str]): CouchDB database URL,
+                `NPM_REGISTRY_DB` by default
+        """
+        self.path = path
+        self.registry = (registry or NPM_REGISTRY_DB).rstrip("/")
+
+    def __repr__(self):
+        return "<NpmSync: %s from %s>" % (self.path, self.registry)
+
+    def _doc_path(self, name):
+        return os.path.join(self.path, name, 'index.json')
+
+    @property
+    def seq(self):
+        """ Last processed sequence number, None if the store was never
+        synced or bootstrapped """
+        try:
+            with io.open(os.path.join(self.path, SEQ_FILE),
+                         encoding='utf8') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @seq.setter
+    def seq(self, value):
+        _write_atomic(os.path.join(self.path, SEQ_FILE),
+                      json.dumps(value).encode('utf8'))
+
+    def _get(self, path='', **params):
+        url = self.registry + ("/" + path if path else "")
+        for _ in range(3):
+            try:
+                r = requests.get(url, params=params, timeout=TIMEOUT * 6)
+            except requests.exceptions.RequestException as e:
+                logger.warning("Failed to reach %s: %s, retrying", url, e)
+                continue
+            r.raise_for_status()
+            return r.json()
+        raise IOError("Failed to reach %s. "
+                      "Check your Internet connection." % url)
+
+    def bootstrap(self, seq=None):
+        """ Record the starting sequence number, the current one of
+        the registry by default """
+        if seq is None:
+            seq = self._get()['update_seq']
+        self.seq = seq
+        return seq
+
+    def get(self, name):
+        # type: (str) -> Optional[dict]
+        """ Get a stored package document, None if it's not in the store """
+        try:
+            with io.open(self._doc_path(name), 'rb') as fh:
+                return json.loads(fh.read().decode('utf8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, name, doc):
+        # type: (str, dict) -> None
+        _write_atomic(self._doc_path(name), json.dumps(doc).encode('utf8'))
+
+    def delete(self, name):
+        # type: (str) -> None
+        """ Remove the package document. Mirrored tarballs, if any,
+        are kept """
+        try:
+            os.remove(self._doc_path(name))
+        except OSError:
+            pass
+
+    def changes(self, since, limit=BATCH_SIZE):
+        # type: (object, int) -> Tuple[List[dict], object]
+        """ Get a batch of changes with documents
+
+        Returns:
+            Tuple[List[dict], object]: (results, last_seq); results are
+                feed rows: {'seq', 'id', 'deleted', 'doc'}
+        """
+        res = self._get('_changes', since=since, limit=limit,
+                        include_docs='true')
+        return res.get('results') or [], res.get('last_seq', since)
+
+    def apply(self, rows):
+        # type: (Iterable[dict]) -> List[str]
+        """ Update the store with `_changes` rows
+
+        Returns:
+            List[str]: names of updated and deleted packages
+        """
+        changed = []
+        for row in rows:
+            name = row.get('id')
+            if not _valid_name(name):
+                continue
+            if row.get('deleted') or not row.get('doc'):
+                self.delete(name)
+            else:
+                self.put(name, row['doc'])
+            changed.append(name)
+        return changed
+
+    def sync(self, batch_size=BATCH_SIZE, max_batches=None):
+        # type: (int, Optional[int]) -> List[str]
+        """ Apply all changes since the recorded sequence number.
+        The sequence number is recorded after every batch, so an
+        interrupted sync resumes where it stopped.
+
+        Args:
+            batch_size (int): number of changes per request
+            max_batches (Optional[int]): stop after this many batches
+
+        Returns:
+            List[str]: unique names of updated and deleted packages,
+                in order of their last change
+        """
+        since = self.seq
+        if since is None:
+            raise ValueError("%r is not bootstrapped. Use bootstrap() or "
+                             "bootstrap(0) to replay the whole feed" % self)
+        changed = collections.OrderedDict()
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            rows, last_seq = self.changes(since, batch_size)
+            for name in self.apply(rows):
+                changed.pop(name, None)
+                changed[name] = True
+            if rows:
+                self.seq = since = last_seq
+                batches += 1
+                logger.info("%s: %d changes, seq %s",
+                            self, len(changed), str(since)[:32])
+            if len(rows) < batch_size:
+                break
+        return list(changed)
+
+    def import_packages(self, packages):
+        # type: (Iterable[npm.Package]) -> int
+        """ Store documents of packages, e.g. from `npm.Package.all()`.
+        Returns the number of stored documents.
+
+        Compact packages don't keep their documents, and `info` of every
+        one of them would be a registry request, so they are not accepted.
+        """
+        count = 0
+        for package in packages:
+            if package.compact:
+                raise ValueError("%s is compact and doesn't keep its document"
+                                 ", use compact=False" % package.name)
+            if _valid_name(package.name):
+                self.put(package.name, package.info)
+                count += 1
+        return count
+
+    def packages(self, names, compact=False):
+        # type: (Iterable[str], bool) -> Iterator[npm.Package]
+        """ Iterate stored packages, e.g. changed ones to feed table
+        builders in `deprecated`. Deleted packages are skipped. """
+        for name in names:
+            doc = self.get(name)
+            if doc:
+                yield npm.Package(name, info=doc, compact=compact)
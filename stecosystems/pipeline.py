@@ -0,0 +1,203 @@
+
+""" Bounded multi-stage executor
+
+Processing a release takes several steps of very different nature:
+downloading is I/O-bound and works well in threads, while parsing is
+CPU-bound and only scales across processes. A pipeline runs every stage
+in its own pool and streams items through them:
+
+    rows = pipeline(releases, [
+        Stage(download, workers=16),  # threads
+        Stage(parse, processes=True),  # processes, one per CPU by default
+    ])
+    for row in rows:
+        ...
+
+Every stage keeps at most `queue_size` items submitted but not yet
+consumed by the next stage. Input is consumed lazily, so memory use
+depends on queue sizes, not on the number of items. By default, results
+are yielded in order of input; with `ordered=False`, as soon as they are
+ready.
+
+Process stage functions, their inputs and outputs have to be picklable.
+"""
+
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import six
+from six.moves import cPickle as pickle
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+logger = logging.getLogger('stecosystems.pipeline')
+
+
+class Stage(object):
+    """ A single pipeline step, func(item) -> result """
+    func = None
+    workers = None
+    processes = False
+    queue_size = None
+    skip_errors = False
+
+    def __init__(self, func, workers=None, processes=False, queue_size=None,
+                 skip_errors=False):
+        """
+        Args:
+            func (Callable): function applied to every item
+            workers (Optional[int]): number of threads or processes. Defaults
+                to the number of CPUs for processes, and twice as many
+                for threads.
+            processes (bool): whether to run in a process pool; use it for
+                CPU-bound stages.
+            queue_size (Optional[int]): max number of items submitted to this
+                stage but not yet consumed by the next one,
+                twice the number of workers by default.
+            skip_errors (bool): log and drop items raising an exception,
+                instead of propagating it.
+        """
+        self.func = func
+        self.processes = processes
+        self.workers = workers or (CPU_COUNT if processes else CPU_COUNT * 2)
+        self.queue_size = max(queue_size or self.workers * 2, self.workers)
+        self.skip_errors = skip_errors
+
+    def __repr__(self):
+        return "<Stage: %s, %d %s>" % (
+            getattr(self.func, '__name__', self.func), self.workers,
+            "processes" if self.processes else "threads")
+
+    def pool(self):
+        if self.processes:
+            return multiprocessing.Pool(self.workers)
+        return ThreadPool(self.workers)
+
+
+class _Call(object):
+    """ Picklable wrapper returning (success, result or exception)
+
+    In process pools, items and outcomes are pickled by the wrapper
+    (see `_dumps()`), so that pickling errors come back as outcomes too.
+    Pools only report them to `error_callback`, which Python 2 doesn't have.
+    """
+    def __init__(self, func, pickled=False):
+        self.func = func
+        self.pickled = pickled
+
+    def __call__(self, item):
+        if self.pickled:
+            item = pickle.loads(item)
+        try:
+            outcome = True, self.func(item)
+        except Exception as e:
+            outcome = False, e
+        return _dumps(outcome) if self.pickled else outcome
+
+
+def _dumps(outcome):
+    # type: (tuple) -> bytes
+    """ Pickle (success, result or exception), replacing unpicklable
+    results and exceptions with an exception """
+    try:
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:  # pickle raises all kinds of errors
+        return pickle.dumps((False, pickle.PicklingError(
+            "Can't pickle %r: %r" % (outcome[1], e))), pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(data):
+    # type: (bytes) -> tuple
+    try:
+        return pickle.loads(data)
+    except Exception as e:  # e.g. exceptions with custom constructors
+        return False, pickle.UnpicklingError("Can't unpickle result: %r" % e)
+
+
+def _run_stage(stage, items, ordered):
+    """ Apply the stage to items, keeping at most stage.queue_size of them
+    in flight """
+    done = six.moves.queue.Queue()  # (seq, success, result)
+    call = _Call(stage.func, pickled=stage.processes)
+    pool = stage.pool()
+    items = iter(items)
+    exhausted = False
+    submitted = yielded = 0
+    ready = {}  # ready[seq] = (success, result), for ordered output
+
+    def submit(seq, item):
+        def callback(outcome):
+            if stage.processes:
+                outcome = _loads(outcome)
+            done.put((seq,) + tuple(outcome))
+
+        if stage.processes:
+            try:
+                item = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                done.put((seq, False, e))
+                return
+        kwargs = {'callback': callback}
+        if six.PY3:  # just in case, errors come as outcomes already
+            kwargs['error_callback'] = lambda e: done.put((seq, False, e))
+        pool.apply_async(call, (item,), **kwargs)
+
+    try:
+        while True:
+            # fill the stage, but give way to results which are ready
+            while not exhausted and submitted - yielded < stage.queue_size \
+                    and done.empty():
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                submit(submitted, item)
+                submitted += 1
+            if exhausted and yielded == submitted:
+                break
+
+            seq, success, result = done.get()
+            ready[seq] = (success, result)
+            while ready:
+                # in unordered mode, any result is the next one
+                key = yielded if ordered else next(iter(ready))
+                if key not in ready:
+                    break
+                success, result = ready.pop(key)
+                yielded += 1
+                if success:
+                    yield result
+                elif stage.skip_errors:
+                    logger.warning("%r: skipping item: %r", stage, result)
+                else:
+                    raise result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def pipeline(items, stages, ordered=True):
+    # type: (Iterable, Iterable[Stage], bool) -> Iterator
+    """ Stream items through the stages
+
+    Args:
+        items (Iterable): input of the first stage, consumed lazily
+        stages (Iterable[Stage]): pipeline steps; output of a stage is
+            the input of the next one
+        ordered (bool): preserve the order of items. If False, every stage
+            passes results on as soon as they are ready, so a slow item
+            doesn't hold back the rest.
+
+    Returns:
+        Iterator: results of the last stage. If the iteration is stopped
+            early, all pools are terminated.
+
+    >>> list(pipeline(range(5), [Stage(abs), Stage(str, processes=True)]))
+    ['0', '1', '2', '3', '4']
+    """
+    for stage in stages:
+        items = _run_stage(stage, items, ordered)
+    return items
@@ -0,0 +1,257 @@
+
+""" Background prefetch of release files for upcoming work
+
+A worker processing releases one by one downloads, extracts and parses
+each of them in sequence, so the network is idle while it parses and
+the CPU is idle while it downloads. A prefetcher looks ahead in the work
+list and downloads files of the upcoming items in background threads:
+
+    with Prefetcher(pypi.Package, '/tmp/prefetch') as prefetcher:
+        for package, version in prefetcher.ahead(releases, files):
+            package.dependencies(version)
+
+where `files(item)` lists (url, size) of the files the item will need,
+e.g. `pypi.Package.release_files()`. Files are stored in the layout of
+the package class mirror (see `mirror`), and the prefetcher is installed
+as the mirror for the duration of the `with` block, so `download()` finds
+the files locally and extracts them in place. Files which are not
+prefetched are downloaded as usual. If a mirror is configured already,
+files are local anyway and the prefetcher does nothing.
+
+Prefetching is bounded by the number of download threads, the number of
+items to look ahead and the total size of prefetched files. Files of
+an item are removed when the consumer moves on to the next item.
+"""
+
+import collections
+import logging
+import os
+import shutil
+import threading
+
+import six
+import stutils
+
+from .base import urlretrieve
+
+# total size of prefetched files kept at once, bytes
+PREFETCH_MAX_BYTES = int(stutils.get_config('PREFETCH_MAX_BYTES', 2 * 10 ** 9))
+PREFETCH_WORKERS = int(stutils.get_config('PREFETCH_WORKERS', 4))
+
+_DONE = object()  # end of items marker
+
+logger = logging.getLogger('stecosystems.prefetch')
+
+
+class Prefetcher(object):
+    """ Downloads files of upcoming items in background, see `ahead()` """
+    path = None
+    package_class = None
+    mirror = None  # the store, in the package class mirror layout
+
+    def __init__(self, package_class, path, max_bytes=PREFETCH_MAX_BYTES,
+                 workers=PREFETCH_WORKERS, lookahead=None):
+        """
+        Args:
+            package_class (type): `pypi.Package` or `npm.Package`
+            path (str): store directory. Every process uses its own
+                subfolder, which is removed on exit.
+            max_bytes (int): max total size of prefetched files not yet
+                consumed; larger files are not prefetched
+            workers (int): number of download threads
+            lookahead (Optional[int]): max number of items to look ahead,
+                four times the number of workers by default
+        """
+        self.package_class = package_class
+        self.path = os.path.join(path, str(os.getpid()))
+        self.mirror = package_class.mirror_class(self.path)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.lookahead = lookahead or workers * 4
+        self.active = False
+        self._pool = None
+        self._saved_mirror = None
+        self._cond = threading.Condition()
+        self._reserved = 0  # bytes of scheduled and not yet removed files
+        self._refs = collections.Counter()  # references to store paths
+        self.stats = collections.Counter()
+
+    def __repr__(self):
+        return "<Prefetcher: %s, %s>" % (self.path, dict(self.stats))
+
+    def __enter__(self):
+        if self.package_class.mirror is not None:
+            logger.info("%s has a mirror already, not prefetching",
+                        self.package_class)
+            return self
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(self.workers)
+        self._saved_mirror = self.package_class.mirror
+        self.package_class.mirror = self.mirror
+        self.active = True
+        return self
+
+    def __exit__(self, *args):
+        if self.active:
+            self.package_class.mirror = self._saved_mirror
+            self._pool.terminate()
+            self._pool.join()
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.active = False
+            logger.info("Prefetch stats: %s", dict(self.stats))
+        return False
+
+    def _reserve(self, size, stop):
+        # wait until the files fit into the budget; stop on early exit
+        with self._cond:
+            while self._reserved and self._reserved + size > self.max_bytes:
+                if stop.is_set():
+                    return False
+                self._cond.wait(0.5)
+            self._reserved += size
+            return True
+
+    def _fetch(self, url, path):
+        if os.path.isfile(path):
+            return
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # created concurrently
+                pass
+        # partially downloaded files should never be seen by `download()`
+        tmp_path = path + ".part"
+        try:
+            urlretrieve(url, tmp_path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.info("Failed to prefetch %s: %s", url, e)
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            with self._cond:
+                self.stats['failed'] += 1
+        else:
+            size = os.path.getsize(path)
+            with self._cond:
+                self.stats['files'] += 1
+                self.stats['bytes'] += size
+
+    def _schedule(self, files, stop):
+        # type: (Iterable[Tuple[str, int]], threading.Event) -> list
+        """ Start downloading the files, returns (result, path, size) """
+        new = []  # (url, path, size) of files not yet in the store
+        known = []
+        for url, size in files:
+            relpath = self.mirror.file_relpath(url)
+            if relpath is None:
+                continue
+            path = os.path.join(self.path, relpath)
+            with self._cond:
+                if self._refs[path]:  # scheduled for an earlier item
+                    self._refs[path] += 1
+                    known.append((None, path, 0))
+                    continue
+            if size and size <= self.max_bytes:
+                new.append((url, path, size))
+            else:
+                self.stats['skipped'] += 1
+        # skip the largest files until the rest fits into the budget
+        new.sort(key=lambda f: f[2])
+        while sum(f[2] for f in new) > self.max_bytes:
+            new.pop()
+            self.stats['skipped'] += 1
+        total = sum(f[2] for f in new)
+        if new and not self._reserve(total, stop):
+            return known
+        res = known
+        for url, path, size in new:
+            with self._cond:
+                self._refs[path] += 1
+            res.append((self._pool.apply_async(self._fetch, (url, path)),
+                        path, size))
+        return res
+
+    def _discard(self, fetches):
+        """ Remove files of a consumed item """
+        for result, path, size in fetches:
+            if result is not None:
+                result.wait()
+            with self._cond:
+                self._refs[path] -= 1
+                if not self._refs[path]:
+                    del self._refs[path]
+                    try:
+                        os.remove(path)
+                    except OSError:  # failed to download
+                        pass
+                self._reserved -= size
+                self._cond.notify_all()
+
+    def ahead(self, items, files):
+        # type: (Iterable, Callable) -> Iterator
+        """ Iterate items, prefetching files of the upcoming ones
+
+        Args:
+            items (Iterable): work items, consumed by a background thread
+            files (Callable): files(item) -> Iterable[Tuple[str, int]],
+                (url, size) of files needed to process the item.
+                Called in a background thread.
+
+        Returns:
+            Iterator: the same items in the same order. Files of an item are
+                downloaded (or failed) by the time it is yielded.
+        """
+        if not self.active:
+            for item in items:
+                yield item
+            return
+
+        pending = six.moves.queue.Queue(self.lookahead)
+        stop = threading.Event()
+
+        def feed():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    try:
+                        item_files = files(item) or ()
+                    except Exception as e:
+                        # it will fail again in the consumer, and be reported
+                        logger.debug("Can't list files of %r: %r", item, e)
+                        item_files = ()
+                    pending.put((item, self._schedule(item_files, stop)))
+            finally:
+                pending.put(_DONE)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        previous = None
+        try:
+            while True:
+                if previous is not None:
+                    self._discard(previous)
+                    previous = None
+                entry = pending.get()
+                if entry is _DONE:
+                    break
+                item, previous = entry
+                for result, _, _ in previous:
+                    if result is not None:
+                        result.wait()
+                yield item
+        finally:
+            stop.set()
+            if previous is not None:
+                self._discard(previous)
+            while feeder.is_alive() or not pending.empty():
+                try:
+                    entry = pending.get(timeout=0.5)
+                except six.moves.queue.Empty:
+                    continue
+                if entry is _DONE:
+                    break
+                self._discard(entry[1])
+            feeder.join()
@@ -7,35 +7,82 @@
 from __future__ import print_function
 
 import ast  # used to parse setuptools.setup() parameters from setup.py
+import bisect
+import codecs
+import collections
+import hashlib
+import io
 import json
+import multiprocessing
 import os
 import re
 import shutil
+import sys
 import tempfile
-from typing import Dict, Optional
+import tokenize
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 import warnings
-from xml.etree import ElementTree
 
 from .base import *
-import stscraper as scraper
-from stutils import decorators as d
+from .compact import PypiMeta, ReleaseTable
+from .fingerprints import FingerprintStore
+from .mirror import PypiMirror
+from .negcache import NegativeCache
+from .setupcache import SetupCache
+from . import trace
 from stutils import sysutils
 
+mapreduce = LazyModule('stutils.mapreduce')  # imports pandas
+
 DEFAULT_SAVE_PATH = os.path.join(tempfile.gettempdir(), 'pypi')
-# directory where package archives are stored
-try:
-    PYPI_SAVE_PATH = stutils.get_config('PYPI_SAVE_PATH', DEFAULT_SAVE_PATH)
-    sysutils.mkdir(PYPI_SAVE_PATH)
-except FileNotFoundError:
-    warnings.warn(
-        "\nThe configured PyPI save path (%s) doesn't exist.\nFalling back "
-        "to default (%s)" % (PYPI_SAVE_PATH, DEFAULT_SAVE_PATH),
-        RuntimeWarning)
-    PYPI_SAVE_PATH = DEFAULT_SAVE_PATH
-    sysutils.mkdir(PYPI_SAVE_PATH)
+# directory where package archives are stored.
+# It is created on first use by `save_path()`, not at import time
+PYPI_SAVE_PATH = stutils.get_config('PYPI_SAVE_PATH', DEFAULT_SAVE_PATH)
+_save_path_ready = False
+
+# persistent cache of sandboxed setup.py output, see `setup_params()`.
+# Defaults to .sparams folder in the save path
+PYPI_SETUP_CACHE_PATH = stutils.get_config('PYPI_SETUP_CACHE_PATH')
+_setup_cache = None
+# persistent per-file LOC counts, see `Package.loc_history()`.
+# Defaults to .loc.sqlite in the save path
+PYPI_LOC_CACHE_PATH = stutils.get_config('PYPI_LOC_CACHE_PATH')
+_loc_store = None
+# persistent cache of known failures, see `negative_cache()`.
+# Defaults to .negative.sqlite in the save path
+PYPI_NEGATIVE_CACHE_PATH = stutils.get_config('PYPI_NEGATIVE_CACHE_PATH')
+_negative_cache = None
+# HTTP status codes of distribution files which are gone for good
+BROKEN_LINK_STATUSES = (403, 404, 410)
+
+# bandersnatch mirror to read metadata and archives from, see `mirror`
+PYPI_MIRROR_PATH = stutils.get_config('PYPI_MIRROR_PATH')
 
 logger = logging.getLogger("ghd.pypi")
-fs_cache = d.fs_cache('pypi')
+fs_cache = fs_cache('pypi')
+
+
+def save_path():
+    """ Return directory to store package archives, creating it if necessary
+
+    If the configured `PYPI_SAVE_PATH` can't be created, falls back to
+    the default location in the system temp folder.
+    """
+    global PYPI_SAVE_PATH, _save_path_ready
+    if _save_path_ready:
+        return PYPI_SAVE_PATH
+    try:
+        sysutils.mkdir(PYPI_SAVE_PATH)
+    except (IOError, OSError):  # FileNotFoundError is not defined in Py2
+        warnings.warn(
+            "\nThe configured PyPI save path (%s) doesn't exist.\nFalling "
+            "back to default (%s)" % (PYPI_SAVE_PATH, DEFAULT_SAVE_PATH),
+            RuntimeWarning)
+        PYPI_SAVE_PATH = DEFAULT_SAVE_PATH
+        sysutils.mkdir(PYPI_SAVE_PATH)
+    _save_path_ready = True
+    return PYPI_SAVE_PATH
+
 
 # path to provided shell scripts
 _PATH = os.path.dirname(__file__) or '.'
@@ -89,6 +136,18 @@ BUILTINS = {
     'webbrowser', 'whichdb', 'winreg', 'winsound', 'with', 'wsgiref', 'xdrlib',
     'xmlrpc', 'xmlrpclib', 'xrange', 'zipapp', 'zipfile', 'zipimport', 'zlib'
 }
+# Python 3.10+ provides the full list, including private modules
+STDLIB = BUILTINS | set(getattr(sys, 'stdlib_module_names', ()))
+
+# number of processes to parse imports, CPU count by default
+IMPORTS_WORKERS = int(stutils.get_config('PYPI_IMPORTS_WORKERS', 0)) or None
+# below this number of files, parsing in a pool is slower than inline
+IMPORTS_POOL_THRESHOLD = 32
+# parsed imports, by sha1 of the file content
+_imports_cache = {}
+IMPORTS_CACHE_SIZE = 100000
+_imports_pool = None
+_imports_pool_size = None
 
 
 def shell(cmd, *args, **kwargs):
@@ -116,6 +175,86 @@ SUPPORTED_FORMATS = {
     # '.rpm': 'rpm2cpio "%(fname)s" | $(cd "%(dir)s" && cpio -i -d)'
 }
 
+# what release files are downloaded for, see `Package.artifact()`
+PURPOSES = ('metadata', 'modules', 'source')
+DEFAULT_PURPOSE = 'source'
+# file preference by purpose: tiers[packagetype] = rank, lower is better.
+# Pure Python wheels get -1, see `artifact_rank()`.
+# NOT SUPPORTED: "bdist_dumb", "bdist_rpm", "bdist_deb", "bdist_wininst"
+#   bdist_dumb (contains file structure from root)
+#   bdist_rpm - need to add cpio command to extract content
+#   bdist_deb - not enough data / haven't seen any so far
+#   bdist_wininst is .exe files, most of the time
+# The last three remain on the list only because they
+# often contain source dist instead
+_METADATA_TIERS = {
+    # static metadata; sdists need to run setup.py in a sandbox
+    'bdist_wheel': 2, 'bdist_egg': 2, 'sdist': 3,
+    'bdist_rpm': 4, 'bdist_deb': 4, 'bdist_wininst': 4}
+ARTIFACT_TIERS = {
+    'metadata': _METADATA_TIERS,
+    'modules': _METADATA_TIERS,  # top_level.txt is in the static metadata
+    # platform wheels might contain compiled modules instead of sources
+    'source': {'bdist_wheel': 2, 'sdist': 1, 'bdist_egg': 2,
+               'bdist_rpm': 3, 'bdist_deb': 3, 'bdist_wininst': 3},
+}
+
+
+def artifact_rank(info, purpose=DEFAULT_PURPOSE):
+    # type: (dict, str) -> Tuple[int, int]
+    """ Sorting key of release files for the purpose, lower is better
+
+    Files are compared by type first (see `ARTIFACT_TIERS`) and then by
+    size. Pure Python wheels are the best choice for any purpose, and
+    py3-none-any ones are preferred over py2-only.
+
+    >>> wheel = {'packagetype': 'bdist_wheel', 'size': 500,
+    ...          'filename': 'six-1.0-py2.py3-none-any.whl'}
+    >>> sdist = {'packagetype': 'sdist', 'size': 100,
+    ...          'filename': 'six-1.0.tar.gz'}
+    >>> artifact_rank(wheel, 'metadata') < artifact_rank(sdist, 'metadata')
+    True
+    >>> artifact_rank(wheel, 'source') > artifact_rank(sdist, 'source')
+    True
+    """
+    pkgtype = info['packagetype']
+    tier = ARTIFACT_TIERS[purpose][pkgtype]
+    if pkgtype == 'bdist_wheel':
+        filename = info.get('filename') or info['url'].rsplit("/", 1)[-1]
+        # {name}-{ver}(-{build})?-{python tag}-{abi tag}-{platform tag}.whl
+        tags = filename[:-4].split("-")[-3:]
+        if tags[1:] == ['none', 'any']:
+            # py3 or py2.py3 are better than py2 only
+            tier = 0 if 'py3' in tags[0].split(".") else 1
+            if purpose == 'source':  # compete with sdists on size
+                tier = ARTIFACT_TIERS[purpose]['sdist']
+    # unknown size goes last within the tier
+    return tier, info.get('size') or sys.maxsize
+
+
+def _strip_extension(fname):
+    for ext in SUPPORTED_FORMATS:
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+
+def _single_dir(extract_dir, download_url):
+    # edge case: zip source archives usually (always?) contain
+    # extra level folder. If after extraction there is a single dir in the
+    # folder, change extract_dir to that folder
+    if not download_url.endswith(".zip"):
+        return extract_dir
+    single_dir = None
+    for entry in os.listdir(extract_dir):
+        entry_path = os.path.join(extract_dir, entry)
+        if os.path.isdir(entry_path):
+            if single_dir is None:
+                single_dir = entry_path
+            else:
+                return extract_dir
+    return single_dir or extract_dir
+
 """
 Notes:
 1. There is no reliable source for supported Python version.
@@ -127,13 +266,299 @@ Notes:
 """
 
 
-class PackageDoesNotExist(ValueError):
-    pass
+# PEP 691 JSON flavor of the simple index
+SIMPLE_JSON = 'application/vnd.pypi.simple.v1+json'
+SIMPLE_CHUNK_SIZE = 64 * 1024
+# package names can't contain '<', so no need for a full-blown HTML parser
+SIMPLE_TAIL_SIZE = 4096  # longer than any anchor
+SIMPLE_ANCHOR_PATTERN = re.compile(r"<a\b[^>]*>([^<]*)</a>", re.I)
+
+
+def canonical_name(name):
+    # type: (str) -> str
+    """ Normalize package name as defined by PEP 503
+
+    >>> canonical_name("Foo.Bar__baz")
+    'foo-bar-baz'
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _seek_sorted(fh, key):
+    # type: (file, bytes) -> None
+    """ Position file with sorted lines at the first line >= key
+    Binary search over byte offsets, so only O(log N) lines are read.
+    """
+    def line_after(pos):  # the first line starting at or after pos
+        fh.seek(max(pos - 1, 0))
+        if pos:
+            fh.readline()
+        return fh.readline()
+
+    fh.seek(0, os.SEEK_END)
+    lo, hi = 0, fh.tell()
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line = line_after(mid)
+        if line and line.rstrip(b"\n") < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    fh.seek(max(lo - 1, 0))
+    if lo:
+        fh.readline()
+
+
+# files setup.py usually reads to get the list of dependencies
+SETUP_INPUTS_PATTERN = re.compile(
+    r"^(setup\.(py|cfg)|pyproject\.toml|requirements.*\.txt)$")
+
+
+def file_hash(path):
+    # type: (str) -> str
+    """ Get sha1 hash of the file content """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# failed release marker, see `Package.dependency_history()`
+_FAILED = object()
+
+
+def dependency_source_hash(source_type, path):
+    # type: (str, str) -> str
+    """ Get hash of the dependencies defined by a source located by
+    `Package._dependencies_source()`. For metadata, version, description
+    and other fields changing in every release are left out, so releases
+    with the same dependencies usually have the same hash. setup.py might
+    compute dependencies from anything, e.g. pin subpackages to its own
+    version, so it is hashed byte for byte with its inputs, using
+    `setup_cache_key()`.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> def metadata_hash(version, deps):
+    ...     path = os.path.join(folder, 'METADATA')
+    ...     with open(path, 'w') as fh:
+    ...         _ = fh.write("Name: foo\\nVersion: %s\\n" % version + "".join(
+    ...             "Requires-Dist: %s\\n" % dep for dep in deps) +
+    ...             "\\nfoo %s is great" % version)
+    ...     return dependency_source_hash('METADATA', path)
+    >>> metadata_hash('1.0', ['six']) == metadata_hash('1.1', ['six'])
+    True
+    >>> metadata_hash('1.0', ['six']) == metadata_hash('1.0', ['six>=1.10'])
+    False
+    >>> def setup_hash(version):
+    ...     with open(os.path.join(folder, 'setup.py'), 'w') as fh:
+    ...         _ = fh.write("VERSION = '%s'\\nsetup(name='foo', version="
+    ...                      "VERSION, install_requires=['foo-core==%%s' "
+    ...                      "%% VERSION])" % version)
+    ...     return dependency_source_hash('setup.py', folder)
+    >>> setup_hash('1.0') == setup_hash('1.0')
+    True
+    >>> setup_hash('1.0') == setup_hash('2.0')
+    False
+    """
+    if source_type == 'setup.py':
+        return setup_cache_key(path)
+    with open(path, 'rb') as fh:
+        content = fh.read()
+    if source_type == 'metadata.json':
+        content = json.dumps(json.loads(content.decode('utf8')).get(
+            'run_requires', []), sort_keys=True).encode('utf8')
+    elif source_type == 'METADATA':
+        content = b"\n".join(line.strip() for line in content.splitlines()
+                             if line.startswith(b"Requires-Dist:"))
+    # requires.txt only lists dependencies
+    return hashlib.sha1(source_type.encode('utf8') + b"\0" + content
+                        ).hexdigest()
+
+
+# files setup.py often reads without naming them in a string literal,
+# e.g. `from mypackage import __version__`
+SETUP_READS_PATTERN = re.compile(
+    r"^(__init__|_?_?version_?_?|__about__|__pkginfo__)\.py$|^VERSION",
+    re.IGNORECASE)
+# string literals in setup.py which might be file names
+SETUP_LITERAL_PATTERN = re.compile(r"""['"]([^'"\s]{1,200})['"]""")
+
+
+def setup_cache_key(extract_dir):
+    # type: (str) -> str
+    """ Get hash of everything setup() parameters might depend on:
+
+    - content of setup.py and other setup inputs in the top folder
+        (see `SETUP_INPUTS_PATTERN`),
+    - content of files named by string literals in setup.py, like README
+        read into long_description, at any depth,
+    - content of likely version files (see `SETUP_READS_PATTERN`)
+        in the top two levels,
+    - the layout find_packages() and package_dir depend on: names of
+        files and folders in the top folder and paths of all `__init__.py`.
+        Other files, e.g. new tests or docs, don't change the key.
+
+    Files are hashed byte for byte, so it is also used to dedupe releases
+    by dependencies, see `dependency_source_hash()`.
+    """
+    with open(os.path.join(extract_dir, 'setup.py'), 'rb') as fh:
+        literals = set(
+            re.sub(r"^(\./)+", "", literal.replace("\\", "/")) for literal in
+            SETUP_LITERAL_PATTERN.findall(fh.read().decode('utf8', 'replace')))
+
+    names = []  # relative paths of files defining the layout
+    hashed = []  # relative paths of files to hash content of
+    for root, dirs, files in os.walk(extract_dir):
+        dirs.sort()
+        relroot = os.path.relpath(root, extract_dir)
+        depth = 0 if relroot == "." else relroot.count(os.sep) + 1
+        if not depth:
+            names.extend(name + "/" for name in dirs)
+        for fname in sorted(files):
+            relpath = fname if not depth else os.path.join(relroot, fname)
+            if not depth or fname == '__init__.py':
+                names.append(relpath)
+            if (not depth and SETUP_INPUTS_PATTERN.match(fname)
+                    or depth < 2 and SETUP_READS_PATTERN.match(fname)
+                    or fname in literals
+                    or relpath.replace(os.sep, "/") in literals):
+                hashed.append(relpath)
+
+    sha = hashlib.sha1()
+    sha.update("\0".join(names).encode('utf8', 'replace') + b"\0\0")
+    for relpath in hashed:
+        path = os.path.join(extract_dir, relpath)
+        if os.path.isfile(path):  # not a broken symlink
+            sha.update(relpath.encode('utf8', 'replace') + b"\0")
+            sha.update(file_hash(path).encode('ascii'))
+    return sha.hexdigest()
+
+
+def setup_cache():
+    # type: () -> SetupCache
+    """ Persistent cache of sandboxed setup.py output of this process.
+    Use `setup_cache().stats()` to get hit rate. """
+    global _setup_cache
+    if _setup_cache is None:
+        _setup_cache = SetupCache(
+            PYPI_SETUP_CACHE_PATH or os.path.join(save_path(), '.sparams'))
+    return _setup_cache
+
+
+# info fields which might contain repository URL; compact metadata keeps
+# repository URLs of the description in `description_urls`
+REPOSITORY_FIELDS = ('home_page', 'download_url', 'project_urls',
+                     'description', 'description_urls')
+REPOSITORY_BATCH_SIZE = 1000
+# find_repositories() results by hash of package name and REPOSITORY_FIELDS
+_repository_cache = {}
+REPOSITORY_CACHE_SIZE = 100000
+
+
+def _repository_text(meta):
+    # type: (dict) -> str
+    """ Concatenate URL-bearing fields of package info """
+    chunks = []
+    for field in REPOSITORY_FIELDS:
+        value = meta.get(field)
+        if isinstance(value, dict):  # project_urls
+            chunks.extend(value.values())
+        elif value:
+            chunks.append(value)
+    return "\n".join(chunk for chunk in chunks
+                     if isinstance(chunk, six.string_types))
+
+
+def _find_repositories_batch(batch):
+    # type: (List[Tuple[str, dict]]) -> Dict[str, Optional[str]]
+    res = {}
+    names, keys, offsets, texts = [], [], [], []
+    offset = 0
+    for name, meta in batch:
+        # any repository URL in the home page is good enough
+        m = scraper.URL_PATTERN.search(meta.get('home_page') or "")
+        if m:
+            res[name] = m.group(0)
+            continue
+
+        text = _repository_text(meta)
+        key = hashlib.sha1(
+            (name + "\0" + text).encode('utf8', 'replace')).hexdigest()
+        if key in _repository_cache:
+            res[name] = _repository_cache[key]
+            continue
+        res[name] = None
+        names.append(name)
+        keys.append(key)
+        offsets.append(offset)
+        texts.append(text)
+        offset += len(text) + 1  # +1 for the separator
+
+    # a single regex pass over all packages in the batch. Newlines can't be
+    # a part of the match, so URLs won't span across packages
+    for m in scraper.URL_PATTERN.finditer("\n".join(texts)):
+        idx = bisect.bisect_right(offsets, m.start()) - 1
+        name = names[idx]
+        if res[name] is not None:
+            continue
+        # same as scraper.named_url_pattern(): repository named after
+        # the package, case insensitive, possibly with .git suffix
+        url = m.group(0)
+        if url.endswith('.git'):
+            url = url[:-4]
+        if url.rsplit("/", 1)[-1].lower() == name.lower():
+            res[name] = url
+
+    if len(_repository_cache) + len(keys) > REPOSITORY_CACHE_SIZE:
+        _repository_cache.clear()
+    for name, key in zip(names, keys):
+        _repository_cache[key] = res[name]
+    return res
+
+
+def find_repositories(metas, batch_size=REPOSITORY_BATCH_SIZE):
+    # type: (Iterable[Tuple[str, dict]], int) -> Dict[str, Optional[str]]
+    """ Find repository URLs of many packages using their metadata
+
+    Only URL-bearing fields are checked (see `REPOSITORY_FIELDS`):
+    home page might contain any repository URL, other fields must contain
+    a repository named after the package. Packages are processed in batches
+    with a single precompiled pattern, and results are cached by hash of
+    the checked fields. Package content is not checked, unlike in
+    `Package.repository`.
+
+    Args:
+        metas (Iterable[Tuple[str, dict]]): (package name, `info` section
+            of PyPI package info) pairs, e.g. `(package.name, package.meta)`
+        batch_size (int): number of packages to scan in one pass
+
+    Returns:
+        Dict[str, Optional[str]]: repository URLs by package name
+
+    >>> find_repositories([
+    ...     ('a', {'home_page': 'https://github.com/user/a_repo'}),
+    ...     ('b', {'description': 'see github.com/user/b.git'}),
+    ...     ('c', {'project_urls': {'Source': 'https://github.com/u/d'}})])
+    {'a': 'github.com/user/a_repo', 'b': 'github.com/user/b', 'c': None}
+    """
+    res = {}
+    batch = []
+    for name, meta in metas:
+        batch.append((name, meta))
+        if len(batch) >= batch_size:
+            res.update(_find_repositories_batch(batch))
+            batch = []
+    if batch:
+        res.update(_find_repositories_batch(batch))
+    return res
 
 
 def get_builtins(python_version):
     """ Return set of built-in libraries for Python2/3 respectively
-    Intented for parsing imports from source files
+    Intented for parsing imports from source files.
+    `STDLIB` is a precomputed offline alternative used by `Package.imports()`
     """
     assert python_version in (2, 3)
     url = "https://docs.python.org/%s/library/index.html" % python_version
@@ -164,6 +589,8 @@ def python_loc_size(package_dir):
     +----------+-------+------+---------+-----------+
 
     In this example (pandas 0.1) we're looking for 4882
+
+    `Package.loc_size()` doesn't use it anymore, see `python_file_loc()`.
     """
     status, pylint_out = shell("pylint", "--py3k", package_dir,
                                local=False, raise_on_status=False,
@@ -178,6 +605,142 @@ def python_loc_size(package_dir):
     return int(match)
 
 
+# tokens not affecting the line type, see `python_file_loc()`
+_JUNK_TOKENS = (tokenize.NL, tokenize.INDENT, tokenize.NEWLINE)
+_ENCODING = getattr(tokenize, 'ENCODING', None)  # Python 3 only
+
+
+def _simple_file_loc(source_code):
+    # fallback for python_file_loc(), for code which can't be tokenized
+    counts = dict.fromkeys(('code', 'docstring', 'comment', 'empty'), 0)
+    for line in source_code.splitlines():
+        line = line.strip()
+        if not line:
+            counts['empty'] += 1
+        elif line.startswith(b"#"):
+            counts['comment'] += 1
+        else:
+            counts['code'] += 1
+    return counts
+
+
+def python_file_loc(source_code):
+    # type: (bytes) -> Dict[str, int]
+    """ Count lines of Python source code by type, like pylint raw metrics
+    used by `python_loc_size()`, but without running pylint: every logical
+    line is classified by its first token, and all its physical lines are
+    counted as such.
+
+    Counts are close to, but not the same as pylint ones, so `loc_size()`
+    values differ from those computed with `python_loc_size()` by earlier
+    versions. E.g. code lines of stdlib `json` and `email` packages are
+    1-1.3% lower than pylint 4.1 reports. Don't mix values from both.
+
+    >>> python_file_loc(b"'doc'\\n\\nimport os  # comment\\n# comment\\n") == {
+    ...     'code': 1, 'docstring': 1, 'comment': 1, 'empty': 1}
+    True
+    >>> python_file_loc(b"def f():\\n    if x:\\n        pass\\n") == {
+    ...     'code': 3, 'docstring': 0, 'comment': 0, 'empty': 0}
+    True
+    >>> python_file_loc(b"def f():\\n    pass\\n'doc'\\n") == {
+    ...     'code': 2, 'docstring': 1, 'comment': 0, 'empty': 0}
+    True
+    """
+    counts = dict.fromkeys(('code', 'docstring', 'comment', 'empty'), 0)
+    readline = io.BytesIO(source_code).readline
+    if six.PY3:
+        tokens = tokenize.tokenize(readline)
+    else:
+        tokens = tokenize.generate_tokens(readline)
+    try:
+        # DEDENT tokens are empty and are placed on the next line, or after
+        # the last line at the end of file, so they are left out as well
+        tokens = [token for token in tokens if token[0] not in
+                  (tokenize.ENDMARKER, tokenize.DEDENT, _ENCODING)]
+    except (tokenize.TokenError, SyntaxError, UnicodeDecodeError):
+        return _simple_file_loc(source_code)
+
+    i = 0
+    while i < len(tokens):
+        start = tokens[i][2][0]
+        end = start
+        line_type = None
+        while i < len(tokens) and tokens[i][2][0] == start:
+            token_type = tokens[i][0]
+            end = tokens[i][3][0]
+            if line_type is None:
+                if token_type == tokenize.STRING:
+                    line_type = 'docstring'
+                elif token_type == tokenize.COMMENT:
+                    line_type = 'comment'
+                elif token_type not in _JUNK_TOKENS:
+                    line_type = 'code'
+            i += 1
+        if line_type is None:
+            line_type = 'empty'
+        elif i < len(tokens) and tokens[i][0] == tokenize.NEWLINE:
+            i += 1
+        counts[line_type] += end - start + 1
+    return counts
+
+
+def loc_store():
+    # type: () -> FingerprintStore
+    """ Persistent per-file LOC counts of this process, see
+    `Package.loc_history()`. Use `loc_store().stats()` to get hit rate. """
+    global _loc_store
+    if _loc_store is None:
+        _loc_store = FingerprintStore(
+            PYPI_LOC_CACHE_PATH or os.path.join(save_path(), '.loc.sqlite'))
+    return _loc_store
+
+
+def negative_cache():
+    # type: () -> NegativeCache
+    """ Persistent cache of known failures of this process: missing
+    packages, broken links and sdists without parseable setup(), see
+    `negcache`. Use `negative_cache().stats()` to get hit rate. """
+    global _negative_cache
+    if _negative_cache is None:
+        _negative_cache = NegativeCache(
+            PYPI_NEGATIVE_CACHE_PATH or
+            os.path.join(save_path(), '.negative.sqlite'))
+    return _negative_cache
+
+
+def add_no_setup(url, extract_dir):
+    # type: (str, str) -> None
+    """ Remember that setup() parameters couldn't be parsed from the file,
+    so that it is not downloaded again """
+    negative_cache().add('no_setup', url, "No parseable setup() in %s" %
+                         os.path.basename(os.path.normpath(extract_dir)))
+
+
+def files_loc(fnames, store=None):
+    # type: (Iterable[str], Optional[FingerprintStore]) -> int
+    """ Get total code LOC of the Python files
+
+    Files are identified by content hash; only files not found in the store
+    are counted, and their counts are added to the store.
+
+    Args:
+        fnames (Iterable[str]): paths to .py files
+        store (Optional[FingerprintStore]): `loc_store()` by default
+    """
+    store = store or loc_store()
+    hashes = [file_hash(fname) for fname in fnames]
+    counts = store.files(hashes)
+    new = {}
+    for fname, digest in zip(fnames, hashes):
+        if digest not in counts and digest not in new:
+            with open(fname, 'rb') as fh:
+                new[digest] = python_file_loc(fh.read())
+    if new:
+        store.add_files(new)
+        counts.update(new)
+    return sum(counts[digest]['code'] for digest in hashes)
+
+
 def parse_setup_params(setup_source_code):
     # type: (str) -> Dict[str, str]
     """ Attempt to parse setuptools.setup() parameters from setup.py
@@ -212,50 +775,474 @@ def parse_setup_params(setup_source_code):
     return res
 
 
+def _statement_imports(tokens):
+    """ Get imported module names from a tokenized logical line
+    Only NAME and OP token strings are expected
+    """
+    for i, token in enumerate(tokens):
+        # `import` might follow a colon, e.g. `try: import json`
+        if token in ('import', 'from') and (i == 0 or tokens[i-1] == ':'):
+            break
+    else:
+        return []
+
+    tokens = tokens[i:]
+    if tokens[0] == 'from':
+        if 'import' not in tokens:
+            return []
+        module = tokens[1:tokens.index('import')]
+        if not module or module[0] == '.':  # relative import
+            return []
+        return ["".join(module)]
+
+    names = []
+    for chunk in " ".join(tokens[1:]).split(","):
+        name = chunk.split(" as ", 1)[0].replace(" ", "")
+        if name and name[0] != '(':
+            names.append(name)
+    return names
+
+
+def _tokenize_imports(source_code):
+    # type: (bytes) -> Set[str]
+    """ Fallback for `parse_imports()` for source code which can't be
+    parsed into AST, usually Python 2 code under Python 3 interpreter
+    """
+    names = set()
+    statement = []  # tokens of the current logical line
+    readline = io.BytesIO(source_code).readline
+    if six.PY3:
+        tokens = tokenize.tokenize(readline)
+    else:
+        tokens = tokenize.generate_tokens(readline)
+    try:
+        for token in tokens:
+            if token[0] in (tokenize.NEWLINE, tokenize.ENDMARKER) \
+                    or token[1] == ';':
+                names.update(_statement_imports(statement))
+                statement = []
+            elif token[0] in (tokenize.NAME, tokenize.OP):
+                statement.append(token[1])
+    except (tokenize.TokenError, SyntaxError, UnicodeDecodeError):
+        # IndentationError is a subclass of SyntaxError
+        # keep whatever was parsed before the error
+        pass
+    names.update(_statement_imports(statement))
+    return names
+
+
+def parse_imports(source_code):
+    # type: (bytes) -> Set[str]
+    """ Get names of modules imported by the source code
+
+    Relative imports are ignored. Python 2 code which can't be parsed by the
+    current interpreter is processed by tokenizer instead.
+
+    >>> sorted(parse_imports(b"import os.path, six as s\\nfrom . import x\\n"
+    ...                      b"from a.b import (c, d)"))
+    ['a.b', 'os.path', 'six']
+    >>> sorted(parse_imports(b"print 'hi'\\nimport urllib2, a.b as c\\n"
+    ...                      b"try: from StringIO import StringIO\\n"
+    ...                      b"except ImportError, e: pass"))
+    ['StringIO', 'a.b', 'urllib2']
+    """
+    try:
+        tree = ast.parse(source_code)
+    except (SyntaxError, ValueError, TypeError, RuntimeError, MemoryError):
+        # ValueError: source contains null bytes
+        # RuntimeError (RecursionError): too deeply nested code
+        return _tokenize_imports(source_code)
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and not node.level \
+                and node.module:
+            names.add(node.module)
+    return names
+
+
+def _python_files(path):
+    """ Iterate .py files in the given directory, or the file itself """
+    if os.path.isfile(path):
+        if path.endswith('.py'):
+            yield path
+        return
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            if fname.endswith('.py'):
+                yield os.path.join(root, fname)
+
+
+def files_imports(fnames, n_workers=None):
+    # type: (Iterable[str], Optional[int]) -> Set[str]
+    """ Get names of modules imported by the provided Python files
+
+    Results are memoized by file content hash, so identical files (e.g.
+    unchanged across releases or vendored by multiple packages) are parsed
+    only once. If there are many files to parse, they are processed by a
+    pool of processes.
+
+    Args:
+        fnames (Iterable[str]): paths to Python files
+        n_workers (Optional[int]): number of processes to use,
+            `PYPI_IMPORTS_WORKERS` config variable or CPU count by default
+
+    Returns:
+        Set[str]: full module names, e.g. 'os.path'
+    """
+    global _imports_pool, _imports_pool_size
+    names = set()
+    missing = {}  # missing[hash] = source code
+    for fname in fnames:
+        try:
+            with open(fname, 'rb') as fh:
+                source_code = fh.read()
+        except (IOError, OSError):  # broken symlinks, permissions etc
+            continue
+        key = hashlib.sha1(source_code).hexdigest()
+        if key in _imports_cache:
+            names.update(_imports_cache[key])
+        else:
+            missing[key] = source_code
+
+    if not missing:
+        return names
+
+    keys = list(missing.keys())
+    sources = [missing[key] for key in keys]
+    if len(sources) < IMPORTS_POOL_THRESHOLD:
+        results = [parse_imports(source) for source in sources]
+    else:
+        n_workers = n_workers or IMPORTS_WORKERS or multiprocessing.cpu_count()
+        if _imports_pool is None or _imports_pool_size != n_workers:
+            if _imports_pool is not None:
+                _imports_pool.terminate()
+            _imports_pool = multiprocessing.Pool(n_workers)
+            _imports_pool_size = n_workers
+        results = _imports_pool.map(parse_imports, sources, chunksize=8)
+
+    if len(_imports_cache) + len(keys) > IMPORTS_CACHE_SIZE:
+        _imports_cache.clear()
+    for key, result in zip(keys, results):
+        _imports_cache[key] = frozenset(result)
+        names.update(result)
+    return names
+
+
+def remove_dirs(dirs):
+    # type: (Iterable[str]) -> None
+    """ Remove extracted package folders, unless a custom save path is
+    configured """
+    if DEFAULT_SAVE_PATH != PYPI_SAVE_PATH:
+        return
+    for folder in dirs:
+        try:
+            # str conversion is required because of this shutil bug:
+            # https://bugs.python.org/issue24672
+            # use tai5_uan5_gian5_gi2_tsu1_liau7_khoo3-tng7_su5_piau1_im1
+            # to test this issue
+            shutil.rmtree(str(folder))
+        except OSError:
+            logger.debug("Error removing temp dir: %s", folder)
+
+
+def setup_params(extract_dir):
+    # type: (str) -> Optional[dict]
+    """ Get setup() parameters by running setup.py in a sandbox
+
+    Results are cached by `setup_cache_key()`, so identical setup.py
+    in other releases or packages doesn't run again.
+    """
+    if not os.path.isfile(os.path.join(extract_dir, 'setup.py')):
+        return None
+    key = setup_cache_key(extract_dir)
+    cache = setup_cache()
+    params = cache.get(key, cache)
+    if params is not cache:
+        return params
+
+    # failures to run the sandbox itself raise an exception
+    # and are not cached
+    _, output = shell("docker.sh", extract_dir)
+    params = None
+    if output.strip():
+        params = json.loads(output)
+    else:
+        logger.warning("Could not parse setup() params in %s", extract_dir)
+    cache.put(key, params)
+    return params
+
+
+def parse_dependencies(source_type, path, get_setup_params=setup_params):
+    # type: (Optional[str], Optional[str], Callable) -> Dict[str, str]
+    """ Parse dependencies from the source located by
+    `Package._dependencies_source()`. It doesn't need the package object,
+    so it can run in a process pool.
+
+    Args:
+        source_type (Optional[str]): 'metadata.json', 'METADATA',
+            'requires.txt' or 'setup.py'
+        path (Optional[str]): source file or, for setup.py,
+            the extracted package folder
+        get_setup_params (Callable): function to get setup() parameters
+            from extracted package folder, `setup_params()` by default
+    """
+    if source_type == 'metadata.json':
+        logger.debug("    .. WHEEL package, parsing from metadata.json")
+        info = json.load(open(path))
+        # only unconditional dependencies are considered
+        # http://legacy.python.org/dev/peps/pep-0426/#dependency-specifiers
+        deps = []
+        for dep in info.get('run_requires', []):
+            if 'extra' not in dep and 'environment' not in dep:
+                deps.extend(dep['requires'])
+    elif source_type == 'METADATA':
+        logger.debug("    .. WHEEL package, parsing from METADATA")
+        # example record:
+        # Requires-Dist: numpy (>=1.9.0)
+        # len("Requires-Dist:") == 14
+        raw_deps = [line[14:].strip()
+                    for line in open(path)
+                    if line.startswith("Requires-Dist:")]
+
+        deps = []
+        for raw_dep in raw_deps:
+            chunks = raw_dep.split(None, 1)
+            if len(chunks) == 1:
+                deps.append(raw_dep)
+                continue
+            chunks[1] = chunks[1].strip("()")
+            deps.append(" ".join(chunks))
+
+    elif source_type == 'requires.txt':
+        logger.debug("    .. egg package, parsing requires.txt")
+        deps = []
+        for line in open(path, 'r'):
+            if "[" in line:
+                break
+            if line:
+                deps.append(line)
+    elif source_type == 'setup.py':
+        logger.debug("    ..generic package, running setup.py in a sandbox")
+        params = get_setup_params(path)
+        if params is None:
+            logger.debug("    .. looks to be a malformed package")
+            return {}
+        deps = params.get('install_requires', [])
+    else:
+        return {}
+
+    def dep_split(dependency):
+        match = re.match(r"[\w_.-]+", dependency)
+        if not match:  # invalid dependency
+            name = ""
+        else:
+            name = match.group(0)
+        version = dependency[len(name):].strip()
+        return name, version
+
+    return dict(dep_split(dep.strip()) for dep in deps if dep.strip())
+
+
 class Package(BasePackage):
     base_url = "https://pypi.org"
-    info = None  # stores cached package info
+    _info = None  # stores cached package info, unless in compact mode
+    meta = None  # 'info' section of package info, or its compact version
+    _releases = None  # 'releases' section of package info
     _dirs = None  # created directories to cleanup later
+    compact = False
+    mirror = PYPI_MIRROR_PATH and PypiMirror(PYPI_MIRROR_PATH)
+    mirror_class = PypiMirror
+
+    @classmethod
+    def _stream_names(cls):
+        """ Iterate raw package names from the simple index as they arrive
+
+        JSON simple API (PEP 691) is used if the server supports it,
+        otherwise HTML is scanned for anchors chunk by chunk.
+        """
+        r = requests.get(cls.base_url + "/simple/", stream=True,
+                         timeout=TIMEOUT,
+                         headers={'Accept': SIMPLE_JSON + ', text/html;q=0.1'})
+        try:
+            r.raise_for_status()
+            if r.headers.get('Content-Type', '').startswith(SIMPLE_JSON):
+                import ijson
+                r.raw.decode_content = True  # handle gzip encoding
+                for name in ijson.items(r.raw, 'projects.item.name'):
+                    yield name
+                return
+
+            decoder = codecs.getincrementaldecoder(
+                r.encoding or 'utf8')('replace')
+            tail = ""  # unprocessed end of the previous chunk
+            for chunk in r.iter_content(SIMPLE_CHUNK_SIZE):
+                text = tail + decoder.decode(chunk)
+                end = 0
+                for match in SIMPLE_ANCHOR_PATTERN.finditer(text):
+                    yield match.group(1).strip()
+                    end = match.end()
+                # the tail might contain a partial anchor; limit its size
+                # in case there are long chunks without anchors
+                tail = text[end:][-SIMPLE_TAIL_SIZE:]
+        finally:
+            r.close()
 
     @classmethod
-    def all(cls):
-        tree = ElementTree.fromstring(cls._request("simple/").content)
-        for package_name in sorted(a.text.lower() for a in tree.iter('a')):
+    def names(cls, start=None, cache_file=None):
+        """ Iterate PEP 503 normalized names of all packages
+
+        Names are yielded as the index is being received, in the order of
+        the index. If `cache_file` is specified, the full index is saved
+        there as a sorted list of names, one per line; later calls read
+        names from this file in sorted order instead of the network.
+
+        Args:
+            start (Optional[str]): skip names lexicographically smaller
+                than this one, e.g. to resume an interrupted run.
+                With a cache file, it takes O(log N) reads to get there.
+            cache_file (Optional[str]): path to the sorted names file.
+                The file is written only if the index was fully consumed.
+        """
+        start = start and canonical_name(start)
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as fh:
+                if start:
+                    _seek_sorted(fh, start.encode('utf8'))
+                for line in fh:
+                    yield line.decode('utf8').rstrip("\n")
+            return
+
+        names = set() if cache_file else None
+        for name in cls._stream_names():
+            name = canonical_name(name)
+            if names is not None:
+                names.add(name)
+            if not start or name >= start:
+                yield name
+
+        if cache_file:
+            tmp_fname = cache_file + '.tmp'
+            with open(tmp_fname, 'wb') as fh:
+                fh.writelines(
+                    name.encode('utf8') + b"\n" for name in sorted(names))
+            os.rename(tmp_fname, cache_file)
+
+    @classmethod
+    def all(cls, compact=False, start=None, cache_file=None):
+        """ Iterate all PyPI packages, skipping missing ones
+
+        Args:
+            compact (bool): create packages in compact mode
+            start (Optional[str]): skip package names smaller than this one
+            cache_file (Optional[str]): sorted names file, see `names()`
+        """
+        for package_name in cls.names(start, cache_file):
             try:
-                package = Package(package_name)
+                package = cls.get(package_name, compact=compact)
             except PackageDoesNotExist:
                 continue
             else:
                 yield package
 
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, info=None, compact=False, **kwargs):
+        """
+        Args:
+            name (str): package name
+            info (Optional[dict]): package info, if already retrieved
+                (e.g. by `stecosystems.aio.crawl()`).
+                End users should not use this parameter.
+            compact (bool): keep only metadata used by the class methods
+                in compact records (see `stecosystems.compact`) instead of
+                the full JSON. Full `info` is still available, but will be
+                re-fetched on every access.
+        """
         self.name = name
+        with trace.span(name, None, 'init'):
+            info = info or self._fetch_info(name)
+            self.compact = compact
+            if compact:
+                self.meta = PypiMeta.from_json(info['info'])
+                self._releases = ReleaseTable.from_json(info['releases'])
+            else:
+                self._info = info
+                self.meta = info['info']
+                self._releases = info['releases']
+
+        self._dirs = []
+        self.latest_ver = self.meta.get('version')
+        super(Package, self).__init__(self.meta['name'])
+
+    @classmethod
+    def normalize_name(cls, name):
+        return canonical_name(name)
+
+    @classmethod
+    def _info_url(cls, name):
+        return "/".join((cls.base_url, "pypi", name, "json"))
+
+    @classmethod
+    def _local_info(cls, name):
+        info = cls._mirror_info(name)
+        if info is not None:
+            return info
+        reason = negative_cache().get('missing', canonical_name(name))
+        if reason:
+            raise PackageDoesNotExist(reason)
+        return None
+
+    @classmethod
+    def _not_found(cls, name):
+        reason = "Package %s does not exist on PyPi" % name
+        # unlike network errors, 404 will happen again
+        negative_cache().add('missing', canonical_name(name), reason)
+        return PackageDoesNotExist(reason)
+
+    @classmethod
+    def _fetch_info(cls, name):
+        info = cls._local_info(name)
+        if info is not None:
+            return info
         try:
-            self.info = self._request("pypi", name, "json").json()
-        except IOError:
+            return cls._request(cls._info_url(name)).json()
+        except IOError as e:
+            response = getattr(e, 'response', None)
+            if getattr(response, 'status_code', None) == 404:
+                raise cls._not_found(name)
             raise PackageDoesNotExist(
                 "Package %s does not exist on PyPi" % name)
         except ValueError:  # simplejson.scanner.JSONDecodeError is a subclass
             # malformed json
             raise ValueError("PyPi package description is invalid")
 
-        self._dirs = []
-        self.latest_ver = self.info['info'].get('version')
-        super(Package, self).__init__(self.info['info']['name'])
+    @property
+    def info(self):
+        """ Full package info, as returned by PyPI JSON API """
+        if self._info is None:
+            return self._fetch_info(self.name)
+        return self._info
 
     def __del__(self):
-        if DEFAULT_SAVE_PATH != PYPI_SAVE_PATH:
-            return
-        for folder in self._dirs:
-            try:
-                # str conversion is required because of this shutil bug:
-                # https://bugs.python.org/issue24672
-                # use tai5_uan5_gian5_gi2_tsu1_liau7_khoo3-tng7_su5_piau1_im1
-                # to test this issue
-                shutil.rmtree(str(folder))
-            except OSError:
-                logger.debug("Error removing temp dir after package %s: %s",
-                             self.name, folder)
+        remove_dirs(self._dirs or ())  # None if __init__ failed
+
+    def detach_dir(self, ver):
+        # type: (str) -> Optional[str]
+        """ Stop tracking the extraction folder of the release, so that it is
+        not removed together with the package object. Used to pass extracted
+        releases to other processes; the caller is responsible for removing
+        the folder with `remove_dirs()`.
+
+        Returns:
+            Optional[str]: the folder, or None if it was not created by
+                this package object
+        """
+        extract_dir = os.path.join(save_path(), self.name + "-" + ver)
+        if extract_dir not in self._dirs:
+            return None
+        self._dirs.remove(extract_dir)
+        return extract_dir
 
     def __str__(self):
         return self.name
@@ -280,7 +1267,7 @@ class Package(BasePackage):
         """
         releases = sorted([
             (label, min(f['upload_time'][:10] for f in files))
-            for label, files in self.info['releases'].items()
+            for label, files in self._releases.items()
             if files],  # skip empty releases
             key=lambda r: r[1])  # sort by date
 
@@ -298,68 +1285,135 @@ class Package(BasePackage):
 
         return releases
 
-    def download_url(self, ver):
+    def artifact(self, ver, purpose=DEFAULT_PURPOSE):
+        """ Choose the cheapest release file suitable for the purpose
+
+        Candidates are ranked by `artifact_rank()`, i.e. by file type
+        first and then by size, so that e.g. dependencies are read from
+        a 50KB pure Python wheel rather than a 200MB platform one.
+
+        Args:
+            ver (str): version string
+            purpose (str): one of PURPOSES:
+                - 'metadata': dependencies, static metadata of any wheel
+                    or egg is enough
+                - 'modules': top level modules, same as metadata
+                - 'source': source code analysis, e.g. LOC and imports;
+                    pure Python wheels and sdists are preferred
+
+        Returns:
+            Optional[dict]: file info from the JSON API `releases` section
+                (`url`, `filename`, `packagetype`, `size`, ...),
+                None if there are no files in supported formats
+        """
+        assert ver in self._releases
+        assert purpose in PURPOSES, "Unknown purpose: %s" % purpose
+        candidates = [info for info in self._releases[ver]
+                      if info['packagetype'] in ARTIFACT_TIERS[purpose]
+                      and any(info['url'].endswith(ext)
+                              for ext in SUPPORTED_FORMATS)]
+        if not candidates:
+            # no downloadable files in supported format
+            logger.info("No downloadable files in supported formats "
+                        "for package %s ver %s found", self.name, ver)
+            return None
+        info = min(candidates, key=lambda i: artifact_rank(i, purpose))
+        logger.debug("%s %s: using %s (%s bytes) for %s, out of %d files",
+                     self.name, ver, info['filename'], info['size'] or "?",
+                     purpose, len(candidates))
+        return info
+
+    def release_files(self, ver, purposes=PURPOSES):
+        # type: (str, Iterable[str]) -> List[Tuple[str, int]]
+        """ (url, size) of files `download()` will use for the purposes,
+        without duplicates, e.g. to prefetch them (see `prefetch`).
+        Known broken links are left out. """
+        files = collections.OrderedDict()
+        for purpose in purposes:
+            info = self.artifact(ver, purpose)
+            if info and not negative_cache().get('broken_link', info['url']):
+                files[info['url']] = info.get('size') or 0
+        return list(files.items())
+
+    def download_url(self, ver, purpose=DEFAULT_PURPOSE):
         """Get URL to package file of the specified version
         This function takes into account supported file types and their
-        relative preference (e.g. wheel files before source packages)
+        relative preference for the purpose, see `artifact()`
 
         :param ver: str, version string
+        :param purpose: str, one of PURPOSES
         :return: url string if found, None otherwise
         """
-        assert ver in self.info['releases']
-        # the rationale for iterating several times filtering out pkgtype:
-        # some formats are more expensive to process, so it is basically
-        # a preference order
-        # NOT SUPPORTED: "bdist_dumb", "bdist_rpm", "bdist_deb", "bdist_wininst"
-        #   bdist_dumb (contains file structure from root)
-        #   bdist_rpm - need to add cpio command to extract content
-        #   bdist_deb - not enough data / haven't seen any so far
-        #   bdist_wininst is .exe files, most of the time
-        # The last three remain on the list only because they
-        # often contain source dist instead
-        for pkgtype in ("bdist_wheel", "bdist_egg", "sdist",
-                        "bdist_rpm", "bdist_deb", "bdist_wininst"):
-            for info in self.info['releases'][ver]:
-                if info['packagetype'] == pkgtype and \
-                    any(info['url'].endswith(ext)
-                        for ext in SUPPORTED_FORMATS):
-                    return info['url']
-        # no downloadable files in supported format
-        logger.info("No downloadable files in supported formats "
-                    "for package %s ver %s found", self.name, ver)
-        return None
+        info = self.artifact(ver, purpose)
+        return info and info['url']
 
-    @d.cached_method
-    def download(self, ver=None):
+    @cached_method
+    def download(self, ver=None, purpose=DEFAULT_PURPOSE):
         """Download and extract the specified package version from PyPi
         :param ver - Version of package
+        :param purpose - one of PURPOSES, see `artifact()`.
+            Files chosen for different purposes are extracted into
+            different subfolders of the release folder.
         """
         ver = ver or self.latest_ver
         logger.debug("Attempting to download package: %s", self.name)
         # ensure there is a downloadable package release
-        download_url = self.download_url(ver)
+        download_url = self.download_url(ver, purpose)
         if download_url is None:
             return None
 
+        # the release folder is removed with the package object
+        release_dir = os.path.join(save_path(), self.name + "-" + ver)
+        if not os.path.isdir(release_dir):
+            try:
+                os.mkdir(release_dir)
+            except OSError:  # created concurrently for another purpose
+                pass
+            else:
+                self._dirs.append(release_dir)
+
+        fname = download_url.rsplit("/", 1)[-1]
+        extract_dir = os.path.join(release_dir, _strip_extension(fname))
+        # threads sharing the package (see `get()`) might need the same file
+        with key_lock(extract_dir):
+            return self._extract(ver, download_url, extract_dir)
+
+    def _extract(self, ver, download_url, extract_dir):
+        # type: (str, str, str) -> Optional[str]
+        """ Download and extract the release file, unless it is extracted
+        already; see `download()` """
         # check if extraction folder exists
-        extract_dir = os.path.join(PYPI_SAVE_PATH, self.name + "-" + ver)
-        if os.path.isdir(extract_dir):
-            if any(os.path.isdir(dirname)
-                   for dirname in os.listdir(extract_dir)):
-                logger.debug(
-                    "Package %s was downloaded already, skipping", self.name)
-                return extract_dir  # already extracted
-        else:
-            os.mkdir(extract_dir)
-            self._dirs.append(extract_dir)
-
-        # download file to the folder
-        fname = os.path.join(extract_dir, download_url.rsplit("/", 1)[-1])
-        try:  # TODO: timeout handling
-            urlretrieve(download_url, fname)
-        except IOError:  # missing file, very rare but happens
-            logger.warning("Broken PyPi link: %s", download_url)
+        if os.path.isdir(extract_dir) and any(
+                os.path.isdir(os.path.join(extract_dir, entry))
+                for entry in os.listdir(extract_dir)):
+            logger.debug(
+                "Package %s was downloaded already, skipping", self.name)
+            return _single_dir(extract_dir, download_url)
+        sysutils.mkdir(extract_dir)
+
+        # mirrored archives are extracted in place, without copying
+        fname = self.mirror and self.mirror.file_path(download_url)
+        if fname:
+            logger.debug("Using mirrored archive %s", fname)
+        elif self.mirror and not self.mirror.fallback:
+            logger.warning("Archive is not mirrored: %s", download_url)
             return None
+        elif negative_cache().get('broken_link', download_url):
+            logger.debug("Known broken PyPi link: %s", download_url)
+            return None
+        else:
+            # download file to the folder
+            fname = os.path.join(extract_dir, download_url.rsplit("/", 1)[-1])
+            try:  # TODO: timeout handling
+                with trace.span(self.name, ver, 'download') as span:
+                    urlretrieve(download_url, fname)
+                    span.bytes = os.path.getsize(fname)
+            except IOError as e:  # missing file, very rare but happens
+                logger.warning("Broken PyPi link: %s", download_url)
+                if getattr(e, 'code', None) in BROKEN_LINK_STATUSES:
+                    negative_cache().add(
+                        'broken_link', download_url, "HTTP %s" % e.code)
+                return None
 
         # extract using supported format
         extension = ""
@@ -372,36 +1426,22 @@ class Package(BasePackage):
 
         cmd = SUPPORTED_FORMATS[extension] % {
             'fname': fname, 'dir': extract_dir}
-        os.system(cmd)
-
-        # fix permissions (+X = traverse dirs)
-        os.system('chmod -R u+rwX "%s"' % extract_dir)
-
-        # edge case: zip source archives usually (always?) contain
-        # extra level folder. If after extraction there is a single dir in the
-        # folder, change extract_dir to that folder
-        if download_url.endswith(".zip"):
-            single_dir = None
-            for entry in os.listdir(extract_dir):
-                entry_path = os.path.join(extract_dir, entry)
-                if os.path.isdir(entry_path):
-                    if single_dir is None:
-                        single_dir = entry_path
-                    else:
-                        single_dir = None
-                        break
-            if single_dir:
-                extract_dir = single_dir
+        with trace.span(self.name, ver, 'extract') as span:
+            span.bytes = os.path.getsize(fname)
+            os.system(cmd)
 
-        return extract_dir
+            # fix permissions (+X = traverse dirs)
+            os.system('chmod -R u+rwX "%s"' % extract_dir)
 
-    def _info_path(self, ver):
+        return _single_dir(extract_dir, download_url)
+
+    def _info_path(self, ver, purpose='metadata'):
         """
         :return: either xxx.dist-info or xxx.egg-info path, or None
 
         It is used by dependencies parser and to locate top_level.txt
         """
-        extract_dir = self.download(ver)
+        extract_dir = self.download(ver, purpose)
         if not extract_dir:
             return None
 
@@ -427,18 +1467,24 @@ class Package(BasePackage):
         logger.debug(
             "Neither dist-info nor egg-info folders found in %s", self.name)
 
-    @d.cached_method
+    def _known_no_setup(self, ver, purpose):
+        # type: (str, str) -> bool
+        """ Check if setup() of the release file is known to be unparseable,
+        to skip download and sandbox altogether """
+        url = self.download_url(ver, purpose)
+        return bool(url) and negative_cache().get('no_setup', url) is not None
+
+    def _add_no_setup(self, ver, purpose, extract_dir):
+        add_no_setup(self.download_url(ver, purpose), extract_dir)
+
+    @cached_method
     def get_setup_params(self, extract_dir=None):
         extract_dir = extract_dir or self.download()
-        if not os.path.isfile(os.path.join(extract_dir, 'setup.py')):
-            return None
-        _, output = shell("docker.sh", extract_dir)
-        if not output.strip():
-            logger.warning("Could not parse setup() params in %s", extract_dir)
-            return None
-        return json.loads(output)
+        with trace.span(self.name, None, 'setup_params'):
+            return setup_params(extract_dir)
 
-    @d.cached_method
+    @cached_method
+    @trace.traced('modules')
     def modules(self, ver=None):
         # type: (str) -> list
         """ Return list of modules provided by this package
@@ -462,15 +1508,23 @@ class Package(BasePackage):
             a3rt-sdk-py["0.0.3"] - folder not matching canonical name
             abofly["1.4.0"] - single file, using non-canonical name
         """
-        ver = ver or self.latest_ver
+        return self._modules(ver or self.latest_ver, 'modules')
+
+    @cached_method
+    def _modules(self, ver, purpose):
+        # type: (str, str) -> list
+        """ Modules provided by the release file chosen for the purpose,
+        see `modules()` """
         logger.debug("Package %s ver %s top folder:", self.name, ver)
         modules = []  # default return
 
-        extract_dir = self.download(ver)
+        if self._known_no_setup(ver, purpose):
+            return modules
+        extract_dir = self.download(ver, purpose)
         if not extract_dir:
             return modules
 
-        info_path = self._info_path(ver)
+        info_path = self._info_path(ver, purpose)
 
         def unique(*lists):
             # combine multiple iterables into one list with unique values
@@ -486,6 +1540,7 @@ class Package(BasePackage):
         # source package - check setup() parameters
         params = self.get_setup_params(extract_dir)
         if params is None:
+            self._add_no_setup(ver, purpose, extract_dir)
             return modules
         # scripts are not importable and thus ignored here
         # perhaps they should be considered by module_paths
@@ -493,45 +1548,111 @@ class Package(BasePackage):
                 'namespace_packages')
         return unique(*(params[key] for key in keys if key in params))
 
-    @d.cached_method
+    def _module_roots(self, ver, purpose):
+        # type: (str, str) -> List[str]
+        """ Folders which might contain top level modules in the release
+        file, relative to its root: the root itself, `package_dir` of
+        the root package in setup() parameters of source packages and
+        the conventional `src` """
+        roots = ['']
+        info_path = self._info_path(ver, purpose)
+        if not info_path or not os.path.isfile(
+                os.path.join(info_path, 'top_level.txt')):
+            # params are cached by _modules() already
+            params = self.get_setup_params(self.download(ver, purpose))
+            package_dir = (params or {}).get('package_dir') or {}
+            if isinstance(package_dir, dict) and package_dir.get(''):
+                roots.append(os.path.normpath(package_dir['']))
+        roots.append('src')
+        return roots
+
+    @cached_method
     def module_paths(self, ver):
-        """ Paths to dirs/files containing provided modules. """
+        """ Paths to dirs/files containing provided modules, relative to
+        the folder of the release file used for source analysis (see
+        `artifact()`). Modules are listed from the same file, so that
+        the paths match its layout, e.g. src/ in source packages. """
         mod_paths = []
-        extract_dir = self.download(ver)
-        for path in self.modules(ver):
-            if not os.path.isdir(os.path.join(extract_dir, path)):
+        extract_dir = self.download(ver, 'source')
+        if not extract_dir:
+            return mod_paths
+        modules = self._modules(ver, 'source')
+        roots = modules and self._module_roots(ver, 'source')
+        for module in modules:
+            for root in roots:
+                path = os.path.join(root, module) if root else module
+                if os.path.isdir(os.path.join(extract_dir, path)):
+                    break
                 if os.path.isfile(os.path.join(extract_dir, path + ".py")):
                     path += ".py"
-                else:
-                    # a C extension (no path) or a malformed package
-                    continue
+                    break
+            else:
+                # a C extension (no path) or a malformed package
+                continue
             mod_paths.append(path)
         return mod_paths
 
-    @d.cached_property
+    def _module_files(self, ver):
+        # type: (str) -> Optional[List[str]]
+        """ Absolute paths of .py files of the modules provided by the
+        release (see `module_paths()`), None if it can't be downloaded """
+        extract_dir = self.download(ver, 'source')
+        if not extract_dir:
+            return None
+        fnames = set()
+        for path in self.module_paths(ver):
+            fnames.update(_python_files(os.path.join(extract_dir, path)))
+        return sorted(fnames)
+
+    @cached_method
+    def imports(self, ver=None):
+        """ Get modules imported by the package source code
+
+        Only files of modules provided by the package (see `module_paths()`)
+        are considered, so setup.py, tests and docs are ignored.
+        Imports of the package own modules are not reported.
+
+        Args:
+            ver (Optional[str]): version string, latest version by default
+
+        Returns:
+            Dict[str, List[str]]: top level module names, in the form
+                `{'stdlib': [...], 'third_party': [...]}`
+        """
+        ver = ver or self.latest_ver
+        res = {'stdlib': [], 'third_party': []}
+        fnames = self._module_files(ver)
+        if fnames is None:
+            return res
+
+        own_modules = set(module.split(".", 1)[0]
+                          for module in self._modules(ver, 'source'))
+        names = set(name.split(".", 1)[0]
+                    for name in files_imports(fnames)) - own_modules
+
+        res['stdlib'] = sorted(name for name in names if name in STDLIB)
+        res['third_party'] = sorted(
+            name for name in names if name not in STDLIB)
+        return res
+
+    @cached_property
+    @trace.traced('repository')
     def repository(self):
         """Search for a pattern in package info and package content
         Search places:
         - info home page field
-        - full info page
+        - URL fields and description, see `find_repositories()`
         - package content
         :return url if found, None otherwise
 
         >>> Package("numpy").url
         'github.com/numpy/numpy'
         """
-        # check home page first
-        m = scraper.URL_PATTERN.search(
-            self.info.get('info', {}).get('home_page', ""))
-        if m:
-            return m.group(0)
+        url = find_repositories(((self.name, self.meta),))[self.name]
+        if url:
+            return url
 
         pattern = scraper.named_url_pattern(self.name)
-
-        m = re.search(pattern, str(self.info))
-        if m:
-            return m.group(0)
-
         for path in self.module_paths(self.latest_ver):
             _, output = shell("zgrep.sh", pattern, path, raise_on_status=False)
             output = output.strip()
@@ -539,7 +1660,45 @@ class Package(BasePackage):
                 return output
         return None
 
-    @d.cached_method
+    def _dependencies_source(self, ver):
+        # type: (str) -> Tuple[Optional[str], Optional[str]]
+        """ Locate the file defining dependencies of the release
+
+        Returns:
+            Tuple[Optional[str], Optional[str]]: (source type, path).
+                Source type is one of 'metadata.json', 'METADATA',
+                'requires.txt' or 'setup.py'; in the last case path is the
+                extracted package folder. (None, None) if there is nothing
+                to parse.
+        """
+        if self._known_no_setup(ver, 'metadata'):
+            return None, None
+        extract_dir = self.download(ver, 'metadata')
+        if not extract_dir:
+            return None, None
+
+        info_path = self._info_path(ver, 'metadata') or ""
+        if info_path.endswith(".dist-info"):
+            for fname in ('metadata.json', 'METADATA'):
+                path = os.path.join(info_path, fname)
+                if os.path.isfile(path):
+                    return fname, path
+            return None, None
+        elif info_path.endswith(".egg-info"):
+            path = os.path.join(info_path, 'requires.txt')
+            if os.path.isfile(path):
+                return 'requires.txt', path
+            return None, None
+        return 'setup.py', extract_dir
+
+    def _parse_dependencies(self, source_type, path):
+        # type: (Optional[str], Optional[str]) -> Dict[str, str]
+        """ Parse dependencies from the source located by
+        `_dependencies_source()` """
+        return parse_dependencies(source_type, path, self.get_setup_params)
+
+    @cached_method
+    @trace.traced('dependencies')
     def dependencies(self, ver=None):
         """Extract dependencies from either wheels metadata or setup.py
 
@@ -547,76 +1706,143 @@ class Package(BasePackage):
         True
         """
         ver = ver or self.latest_ver
-        default = {}  # default return vlaue
         logger.debug(
             "Getting dependencies for project %s ver %s", self.name, ver)
-        extract_dir = self.download(ver)
-        if not extract_dir:
-            return default
-
-        info_path = self._info_path(ver) or ""
-        if info_path.endswith(".dist-info"):
-            logger.debug("    .. WHEEL package, parsing from metadata.json")
-            fname = os.path.join(info_path, 'metadata.json')
-            if os.path.isfile(fname):
-                info = json.load(open(fname))
-                # only unconditional dependencies are considered
-                # http://legacy.python.org/dev/peps/pep-0426/#dependency-specifiers
-                deps = []
-                for dep in info.get('run_requires', []):
-                    if 'extra' not in dep and 'environment' not in dep:
-                        deps.extend(dep['requires'])
-            else:
-                fname = os.path.join(info_path, 'METADATA')
-                if not os.path.isfile(fname):
-                    return default
-                # example record:
-                # Requires-Dist: numpy (>=1.9.0)
-                # len("Requires-Dist:") == 14
-                raw_deps = [line[14:].strip()
-                            for line in open(fname)
-                            if line.startswith("Requires-Dist:")]
-
-                deps = []
-                for raw_dep in raw_deps:
-                    chunks = raw_dep.split(None, 1)
-                    if len(chunks) == 1:
-                        deps.append(raw_dep)
-                        continue
-                    chunks[1] = chunks[1].strip("()")
-                    deps.append(" ".join(chunks))
+        source_type, path = self._dependencies_source(ver)
+        if source_type == 'setup.py' and self.get_setup_params(path) is None:
+            self._add_no_setup(ver, 'metadata', path)
+        return self._parse_dependencies(source_type, path)
+
+    def dependency_history(self, include_unstable=True,
+                           include_backports=True, n_workers=None):
+        """ Get dependencies of all package releases
+
+        Releases are downloaded concurrently. Consecutive releases usually
+        carry identical dependencies, so they are hashed (see
+        `dependency_source_hash()`) and every distinct source is parsed
+        (or run in a sandbox, in case of setup.py) only once. Unparseable
+        setup.py files are added to the negative cache, same as by
+        `dependencies()`.
+
+        Args:
+            include_unstable (bool): see `releases()`
+            include_backports (bool): see `releases()`
+            n_workers (Optional[int]): number of download threads
+
+        Returns:
+            OrderedDict[str, Optional[Dict[str, str]]]: dependencies by
+                release label, in order of release date. Dependencies are
+                in the same format as returned by `dependencies()`; None if
+                the release failed to download or parse, unlike releases
+                without dependencies.
+        """
+        labels = [label for label, _ in
+                  self.releases(include_unstable, include_backports)]
+
+        # mapreduce.map() only logs exceptions, leaving results out, so
+        # failed releases are recorded explicitly, and
+        # sources[label] is ((source type, hash), (ver, path)), None if
+        # there is nothing to parse, or _FAILED
+        def locate(ver, _):
+            try:
+                source_type, path = self._dependencies_source(ver)
+                if source_type is None:
+                    return None
+                return (source_type, dependency_source_hash(
+                    source_type, path)), (ver, path)
+            except Exception as e:
+                logger.warning("%s %s: failed to get dependencies: %r",
+                               self.name, ver, e)
+                return _FAILED
+
+        sources = mapreduce.map(locate, dict.fromkeys(labels), n_workers)
+
+        distinct = {}  # distinct[(source type, hash)] = (ver, path)
+        for source in sources.values():
+            if source is not None and source is not _FAILED:
+                distinct.setdefault(*source)
+        logger.debug("%s: %d releases, %d distinct dependency sources",
+                     self.name, len(labels), len(distinct))
+
+        def parse(key, source):
+            (source_type, _), (ver, path) = key, source
+            try:
+                if (source_type == 'setup.py'
+                        and self.get_setup_params(path) is None):
+                    self._add_no_setup(ver, 'metadata', path)
+                return self._parse_dependencies(source_type, path)
+            except Exception as e:
+                logger.warning("%s %s: failed to parse dependencies: %r",
+                               self.name, ver, e)
+                return _FAILED
+
+        parsed = mapreduce.map(parse, distinct, n_workers)
+
+        history = collections.OrderedDict()
+        for label in labels:
+            source = sources.get(label, _FAILED)
+            if source is None:
+                history[label] = {}
+                continue
+            deps = _FAILED if source is _FAILED else parsed.get(source[0], _FAILED)
+            history[label] = None if deps is _FAILED else dict(deps)
+        return history
 
-        elif info_path.endswith(".egg-info"):
-            logger.debug("    .. egg package, parsing requires.txt")
-            fname = os.path.join(info_path, 'requires.txt')
-            if not os.path.isfile(fname):
-                return default
-            deps = []
-            for line in open(fname, 'r'):
-                if "[" in line:
-                    break
-                if line:
-                    deps.append(line)
-        else:
-            logger.debug("    ..generic package, running setup.py in a sandbox")
-            params = self.get_setup_params(extract_dir)
-            if params is None:
-                logger.debug("    .. looks to be a malformed package")
-                return default
-            deps = params.get('install_requires', [])
-
-        def dep_split(dependency):
-            match = re.match(r"[\w_.-]+", dependency)
-            if not match:  # invalid dependency
-                name = ""
-            else:
-                name = match.group(0)
-            version = dependency[len(name):].strip()
-            return name, version
+    @cached_method
+    @trace.traced('loc_size')
+    def loc_size(self, ver):
+        """ Get size of the release modules in LOC (code lines only)
 
-        return dict(dep_split(dep.strip()) for dep in deps if dep.strip())
+        Counts are stored in `loc_store()`, so a release is downloaded
+        and counted only once; unchanged files are not re-counted in other
+        releases. See `loc_history()` to get sizes of all releases.
 
-    @d.cached_method
-    def loc_size(self, ver):
-        """get size in LOC"""
-        return sum(python_loc_size(path) for path in self.module_paths(ver))
+        Lines are counted by `python_file_loc()`, not pylint, so values
+        are slightly lower than ones of versions using `python_loc_size()`.
+        """
+        return self._release_loc(ver, loc_store())
+
+    def _release_loc(self, ver, store, known=None):
+        # known is {version: loc} from store.releases(), to save a query
+        if known is None:
+            known = store.releases(self.name)
+        if ver in known:
+            return known[ver]
+        fnames = self._module_files(ver)
+        if fnames is None:  # nothing to download, don't store
+            return 0
+        loc = files_loc(fnames, store)
+        store.add_release(self.name, ver, loc)
+        return loc
+
+    def loc_history(self, include_unstable=True, include_backports=True,
+                    n_workers=None):
+        """ Get LOC size of all package releases in one call
+
+        Releases measured before (by this or previous runs) are not
+        downloaded again. Other releases are downloaded concurrently, and
+        only files with content not seen before in any release are counted;
+        see `stecosystems.fingerprints`.
+
+        Args:
+            include_unstable (bool): see `releases()`
+            include_backports (bool): see `releases()`
+            n_workers (Optional[int]): number of download threads
+
+        Returns:
+            OrderedDict[str, int]: LOC by release label, in order of
+                release date, same as `loc_size()` of every release
+        """
+        labels = [label for label, _ in
+                  self.releases(include_unstable, include_backports)]
+        store = loc_store()
+        known = store.releases(self.name)
+        missing = [label for label in labels if label not in known]
+        logger.debug("%s: %d releases, %d to measure",
+                     self.name, len(labels), len(missing))
+        if missing:
+            known.update(mapreduce.map(
+                lambda ver, _: self._release_loc(ver, store, known),
+                dict.fromkeys(missing), n_workers))
+        return collections.OrderedDict(
+            (label, known.get(label, 0)) for label in labels)
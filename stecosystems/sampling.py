@@ -0,0 +1,338 @@
+
+""" Reproducible stratified samples of packages, with confidence intervals
+
+Many questions about an ecosystem, like the median number of dependencies
+or the share of sdist-only packages, don't need a full pass. A sample of
+1% of packages takes minutes and tells whether a full run is needed:
+
+    sample = StratifiedSample(0.01, seed=1, stratum=release_count_stratum)
+    packages = sample.select(npm.Package.all('npm.json', compact=True))
+    deps = {p.name: len(p.dependencies()) for p in packages}
+    print(sample.mean(deps), sample.quantile(deps, 0.5))
+
+To avoid fetching metadata of all PyPI packages, sample names instead:
+`sample.select(pypi.Package.names(), name=str)`.
+
+Packages are selected by a hash of the seed and the package name, so
+the same seed and fraction give the same sample regardless of enumeration
+order, and a smaller fraction gives a subset of a larger one.
+
+With a stratum function, estimates are post-stratified: every stratum
+is weighted by its share of the population. If all packages get the same
+fraction, the stratum is only computed for the selected packages (e.g. it
+takes metadata of 1% of packages), and the shares are estimated from the
+sample. Per-stratum `fractions` (e.g. to oversample rare strata) require
+computing the stratum of every package, but give exact shares.
+
+Confidence intervals of means and shares use the normal approximation,
+intervals of quantiles are bootstrapped within strata. If the shares are
+estimated, the variance of means includes their error, see `mean()`.
+
+>>> sample = StratifiedSample(0.5, seed=4)
+>>> names = [str(i) for i in range(1000)]
+>>> selected = list(sample.select(names, name=str))
+>>> selected == list(StratifiedSample(0.5, seed=4).select(names, name=str))
+True
+>>> 450 < len(selected) < 550
+True
+>>> estimate = sample.mean({name: int(name) for name in selected})
+>>> estimate.low < 499.5 < estimate.high
+True
+"""
+
+import collections
+import hashlib
+import math
+import random
+
+import six
+
+# upper bounds of release count strata, see `release_count_stratum()`
+RELEASE_COUNT_BINS = (1, 4, 9, 19, 49)
+
+
+def sample_key(name, seed=0):
+    # type: (str, object) -> float
+    """ Pseudo-random number in [0, 1), determined by the seed and name """
+    digest = hashlib.md5(("%s:%s" % (seed, name)).encode('utf8')).hexdigest()
+    return int(digest[:13], 16) / float(16 ** 13)
+
+
+def release_count_stratum(package):
+    # type: (BasePackage) -> str
+    """ Number of releases, binned by `RELEASE_COUNT_BINS`, e.g. '5-9' """
+    count = len(package.releases(True, True))
+    if not count:
+        return '0'
+    lower = 0
+    for upper in RELEASE_COUNT_BINS:
+        if count <= upper:
+            return str(upper) if lower + 1 >= upper else \
+                "%d-%d" % (lower + 1, upper)
+        lower = upper
+    return "%d+" % (lower + 1)
+
+
+def first_release_year(package):
+    # type: (BasePackage) -> str
+    """ Year of the first release, 'unknown' if there are no dated ones """
+    dates = [date for _, date in package.releases(True, True) if date]
+    return min(dates)[:4] if dates else 'unknown'
+
+
+# stratum functions by name, e.g. for command line options
+STRATA = {
+    'releases': release_count_stratum,
+    'year': first_release_year,
+}
+
+
+def _z(confidence):
+    # type: (float) -> float
+    """ Two-sided standard normal quantile
+
+    >>> round(_z(0.95), 2)
+    1.96
+    """
+    lo, hi = 0.0, 10.0
+    for _ in range(60):  # bisection on the normal CDF
+        mid = (lo + hi) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def _weighted_quantile(pairs, q):
+    # type: (List[Tuple[float, float]], float) -> float
+    """ Quantile of (value, weight) pairs """
+    pairs = sorted(pairs)
+    total = sum(weight for _, weight in pairs)
+    cumulative = 0.0
+    for value, weight in pairs:
+        cumulative += weight
+        if cumulative >= q * total:
+            return value
+    return pairs[-1][0]
+
+
+Estimate = collections.namedtuple('Estimate', 'value low high n')
+
+
+class StratifiedSample(object):
+    """ Reproducible Bernoulli sample of packages, optionally stratified """
+    fraction = None
+    seed = None
+    stratum = None
+    fractions = None
+
+    def __init__(self, fraction, seed=0, stratum=None, fractions=None):
+        """
+        Args:
+            fraction (float): share of packages to select, in (0, 1]
+            seed (object): sample seed; the same seed and fraction select
+                the same packages
+            stratum (Optional[Callable]): function of the package returning
+                its stratum label, e.g. `release_count_stratum`
+            fractions (Optional[Dict[str, float]]): share of packages
+                to select by stratum, `fraction` for other strata
+        """
+        self.fraction = fraction
+        self.seed = seed
+        self.stratum = stratum
+        self.fractions = fractions or {}
+        self.strata = {}  # strata[name] = stratum of selected packages
+        self.population = collections.Counter()  # if fractions are given
+        self.sampled = collections.Counter()
+
+    def __repr__(self):
+        return "<StratifiedSample: %g, seed %s, %d selected>" % (
+            self.fraction, self.seed, len(self.strata))
+
+    def _fraction(self, stratum):
+        return self.fractions.get(stratum, self.fraction)
+
+    def select(self, packages, name=lambda package: package.name,
+               defer_strata=False):
+        # type: (Iterable, Callable, bool) -> Iterator
+        """ Iterate selected packages, e.g. from `Package.all()` or
+        package names with `name=str`. Can be called several times to
+        accumulate a sample from several sources
+
+        Args:
+            packages (Iterable): packages or whatever `name` accepts
+            name (Callable): function returning the package name
+            defer_strata (bool): don't compute strata of the selected
+                packages; the caller registers them with `add()` instead,
+                e.g. after computing strata in parallel. Not possible
+                with per-stratum fractions.
+        """
+        if defer_strata and self.fractions:
+            raise ValueError("Strata are needed to select packages "
+                             "with per-stratum fractions")
+        for package in packages:
+            key = sample_key(name(package), self.seed)
+            if self.fractions:
+                stratum = self.stratum(package)
+                self.population[stratum] += 1
+                if key >= self._fraction(stratum):
+                    continue
+            elif key >= self.fraction:
+                continue
+            elif defer_strata:
+                yield package
+                continue
+            else:
+                stratum = self.stratum(package) if self.stratum else 'all'
+            self.strata[name(package)] = stratum
+            self.sampled[stratum] += 1
+            yield package
+
+    def add(self, name, stratum='all'):
+        """ Register a selected package, e.g. from a sample saved by
+        the command line tool or selected with `defer_strata` """
+        self.strata[name] = stratum
+        self.sampled[stratum] += 1
+
+    def weights(self):
+        # type: () -> Dict[str, float]
+        """ Shares of strata in the population. Exact if the strata of all
+        packages are known, estimated from the sample otherwise """
+        if self.population:
+            sizes = self.population
+        else:
+            sizes = {stratum: count / self._fraction(stratum)
+                     for stratum, count in self.sampled.items()}
+        total = float(sum(sizes.values())) or 1.0
+        return {stratum: size / total for stratum, size in sizes.items()}
+
+    def _values(self, values):
+        # values of selected packages grouped by stratum;
+        # packages without a value (e.g. failed) are skipped
+        by_stratum = collections.defaultdict(list)
+        for name, value in six.iteritems(dict(values)):
+            if name in self.strata and value is not None:
+                by_stratum[self.strata[name]].append(float(value))
+        return by_stratum
+
+    def mean(self, values, confidence=0.95):
+        # type: (Dict[str, float], float) -> Estimate
+        """ Estimate the population mean of a per-package value
+
+        If shares of strata are known, it is the post-stratified mean.
+        Otherwise, shares are estimated from the sample, and it is the
+        ratio (Hajek) estimator: packages are weighted by the inverse of
+        their selection probability. The linearized variance of the latter
+        includes the error of the estimated shares, so differences between
+        strata widen the interval.
+
+        Args:
+            values (Dict[str, float]): values of selected packages by name;
+                booleans are fine, to estimate shares
+            confidence (float): confidence level of the interval
+
+        Returns:
+            Estimate: (value, low, high, n), n is the number of values used
+
+        >>> sample = StratifiedSample(0.5, stratum=lambda name: name[0])
+        >>> values = {name: 100 if name[0] == 'a' else 1 for name in
+        ...           sample.select(['a%d' % i for i in range(100)] +
+        ...                         ['b%d' % i for i in range(900)], name=str)}
+        >>> estimate = sample.mean(values)
+        >>> estimate.low < 10.9 < estimate.high
+        True
+        """
+        by_stratum = self._values(values)
+        if not self.population:
+            return self._ratio_mean(by_stratum, confidence)
+        weights = self.weights()
+        # strata without values are left out, other weights rescaled
+        total_weight = sum(weights[s] for s in by_stratum) or 1.0
+        mean = variance = 0.0
+        n = 0
+        for stratum, vals in by_stratum.items():
+            weight = weights[stratum] / total_weight
+            size = len(vals)
+            n += size
+            stratum_mean = sum(vals) / size
+            mean += weight * stratum_mean
+            if size > 1:  # a single value says nothing about the variance
+                s2 = sum((v - stratum_mean) ** 2 for v in vals) / (size - 1)
+                fpc = 1 - min(self._fraction(stratum), 1.0)
+                variance += weight ** 2 * s2 / size * fpc
+        if not n:
+            return Estimate(None, None, None, 0)
+        margin = _z(confidence) * math.sqrt(variance)
+        return Estimate(mean, mean - margin, mean + margin, n)
+
+    share = mean  # of boolean values
+
+    def _ratio_mean(self, by_stratum, confidence):
+        # mean with shares of strata estimated from the sample, see `mean()`
+        total = sum(len(vals) / self._fraction(stratum)
+                    for stratum, vals in by_stratum.items())
+        n = sum(len(vals) for vals in by_stratum.values())
+        if not n:
+            return Estimate(None, None, None, 0)
+        mean = sum(sum(vals) / self._fraction(stratum)
+                   for stratum, vals in by_stratum.items()) / total
+        # Bernoulli sampling: Var = sum (1 - p) / p^2 * (y - mean)^2 / N^2
+        variance = sum(
+            (1 - min(fraction, 1.0)) / fraction ** 2 *
+            sum((v - mean) ** 2 for v in vals)
+            for fraction, vals in ((self._fraction(stratum), vals)
+                                   for stratum, vals in by_stratum.items())
+        ) / total ** 2
+        margin = _z(confidence) * math.sqrt(variance)
+        return Estimate(mean, mean - margin, mean + margin, n)
+
+    def quantile(self, values, q=0.5, confidence=0.95, n_boot=1000):
+        # type: (Dict[str, float], float, float, int) -> Estimate
+        """ Estimate a population quantile of a per-package value, e.g.
+        the median. The interval is bootstrapped within strata, with
+        the sample seed, so it is reproducible too. """
+        by_stratum = self._values(values)
+        weights = self.weights()
+        n = sum(len(vals) for vals in by_stratum.values())
+        if not n:
+            return Estimate(None, None, None, 0)
+
+        def estimate(groups):
+            return _weighted_quantile(
+                [(v, weights[stratum] / len(vals))
+                 for stratum, vals in groups.items() for v in vals], q)
+
+        rnd = random.Random(self.seed)
+        boot = sorted(
+            estimate({stratum: [rnd.choice(vals) for _ in vals]
+                      for stratum, vals in by_stratum.items()})
+            for _ in range(n_boot))
+        tail = (1 - confidence) / 2
+        return Estimate(estimate(by_stratum),
+                        boot[int(tail * (n_boot - 1))],
+                        boot[int(round((1 - tail) * (n_boot - 1)))], n)
+
+    def report(self, values, confidence=0.95, statistics=('mean', 'median')):
+        # type: (Dict[str, Dict[str, float]], float, Iterable[str]) -> str
+        """ Text report of estimates
+
+        Args:
+            values (Dict[str, Dict[str, float]]): values[column][name]
+            confidence (float): confidence level of the intervals
+            statistics (Iterable[str]): 'mean' and/or 'median'
+        """
+        lines = ["%d packages sampled, %s" % (len(self.strata), ", ".join(
+            "%s: %d" % item for item in sorted(self.sampled.items())))]
+        lines.append("%-24s %-8s %12s %12s %12s %8s" % (
+            "column", "stat", "estimate", "low", "high", "n"))
+        for column in sorted(values):
+            for statistic in statistics:
+                if statistic == 'median':
+                    est = self.quantile(values[column], 0.5, confidence)
+                else:
+                    est = self.mean(values[column], confidence)
+                if est.n:
+                    lines.append("%-24s %-8s %12.4g %12.4g %12.4g %8d" % (
+                        (column, statistic) + est))
+        return "\n".join(lines)
@@ -0,0 +1,91 @@
+
+""" Persistent cache of sandboxed setup.py results
+
+Running setup.py in a Docker sandbox takes seconds, and the same setup.py
+(with the same files it reads) shows up in many releases and forks.
+This cache stores the sandbox output (setup() parameters, JSON) by a hash
+of its inputs, see `pypi.setup_cache_key()`, as one file per entry:
+
+    <path>/<first two hex digits of the key>/<key>.json
+
+Entries are written atomically, so several processes can share the cache.
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+
+import six
+
+_MISSING = object()
+
+
+class SetupCache(object):
+    """ JSON values by content hash, with hit-rate stats of this process """
+    path = None
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): cache directory, created on the first write
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<SetupCache: %s, %s>" % (self.path, self.stats())
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    def get(self, key, default=None):
+        """ Get the cached value, counting hits and misses.
+        Note that None is a valid value: a setup.py which failed
+        in the sandbox will fail again. """
+        try:
+            with io.open(self._entry_path(key), encoding='utf8') as fh:
+                value = json.load(fh)
+        except (IOError, OSError, ValueError):
+            value = _MISSING
+        with self._lock:
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        return os.path.isfile(self._entry_path(key))
+
+    def put(self, key, value):
+        # type: (str, object) -> None
+        """ Store a JSON-serializable value """
+        path = self._entry_path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # created concurrently
+                pass
+        # write to a temp file and rename, so that readers never see
+        # partially written entries
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with io.open(fd, 'w', encoding='utf8') as fh:
+            fh.write(six.text_type(json.dumps(value)))
+        os.rename(tmp_path, path)
+
+    def stats(self):
+        # type: () -> Dict[str, float]
+        """ Lookups of this process: hits, misses and hit_rate """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / total if total else 0.0}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
@@ -0,0 +1,233 @@
+
+""" Delta-encoded dependency timelines
+
+Storing full dependencies of every release, as `raw_dependencies` column of
+`deprecated.pypi_dependencies()` / `npm_dependencies()` does, repeats the
+same dependency sets over and over. A timeline stores only changes:
+
+    [name, [dep_name, ...], [[version, date, added, removed, changed], ...]]
+
+where dependency names are stored once per package and referenced by
+position, `added` and `changed` are lists of `[dep_id, constraint]` and
+`removed` is a list of dep_ids. The first release `added` list is its full
+dependency set. Files contain one timeline per line (JSON lines), and are
+gzip-compressed if the file name ends with `.gz`.
+
+>>> t = DependencyTimeline.from_history('foo', [
+...     ('0.1', '2018-01-01', {'six': ''}),
+...     ('0.2', '2018-02-01', {'six': '>=1.0', 'requests': ''}),
+...     ('0.3', '2018-03-01', {'requests': ''})])
+>>> t.dependencies('0.2') == {'six': '>=1.0', 'requests': ''}
+True
+>>> t.first_added('requests')
+('0.2', '2018-02-01')
+>>> t.to_json()
+['foo', ['six', 'requests'], [['0.1', '2018-01-01', [[0, '']], [], []], \
+['0.2', '2018-02-01', [[1, '']], [], [[0, '>=1.0']]], \
+['0.3', '2018-03-01', [], [0], []]]]
+"""
+
+import gzip
+import io
+import itertools
+import json
+
+import six
+
+# keep full snapshot of dependencies every N releases for random access
+CHECKPOINT_INTERVAL = 32
+
+
+class DependencyTimeline(object):
+    """ Dependencies of all releases of a single package """
+    name = None
+    names = None  # dependency names, position is used as id
+    releases = None  # list of (version, date, added, removed, changed)
+
+    def __init__(self, name):
+        self.name = name
+        self.names = []
+        self._ids = {}  # _ids[dependency name] = position in self.names
+        self.releases = []
+        self._index = {}  # _index[version] = position in self.releases
+        self._current = {}  # dep_id: constraint of the last release
+        self._checkpoints = {}  # _checkpoints[position] = {dep_id: constr}
+
+    def __repr__(self):
+        return "<DependencyTimeline: %s, %d releases>" % (
+            self.name, len(self.releases))
+
+    def __len__(self):
+        return len(self.releases)
+
+    def _id(self, dependency):
+        if dependency not in self._ids:
+            self._ids[dependency] = len(self.names)
+            self.names.append(dependency)
+        return self._ids[dependency]
+
+    def _apply(self, delta):
+        _, _, added, removed, changed = delta
+        self._current.update(added)
+        self._current.update(changed)
+        for dep_id in removed:
+            del self._current[dep_id]
+        position = len(self.releases)
+        self._index[delta[0]] = position
+        self.releases.append(delta)
+        if position % CHECKPOINT_INTERVAL == 0:
+            self._checkpoints[position] = dict(self._current)
+
+    def append(self, version, date, dependencies):
+        # type: (str, Optional[str], Dict[str, str]) -> None
+        """ Add the next release; only the difference with the previous
+        release is stored """
+        deps = {self._id(name): constraint or ""
+                for name, constraint in dependencies.items()}
+        added = [[dep_id, constraint]
+                 for dep_id, constraint in sorted(deps.items())
+                 if dep_id not in self._current]
+        changed = [[dep_id, constraint]
+                   for dep_id, constraint in sorted(deps.items())
+                   if dep_id in self._current
+                   and self._current[dep_id] != constraint]
+        removed = sorted(dep_id for dep_id in self._current
+                         if dep_id not in deps)
+        self._apply([version, date, added, removed, changed])
+
+    @classmethod
+    def from_history(cls, name, history):
+        # type: (str, Iterable[Tuple[str, str, Dict[str, str]]]) -> DependencyTimeline
+        """ Create timeline from (version, date, dependencies) tuples,
+        in the order of releases """
+        timeline = cls(name)
+        for version, date, dependencies in history:
+            timeline.append(version, date, dependencies)
+        return timeline
+
+    def versions(self):
+        return [release[0] for release in self.releases]
+
+    def _state(self, position):
+        # dependencies as {dep_id: constraint} at the given release position
+        checkpoint = position - position % CHECKPOINT_INTERVAL
+        state = dict(self._checkpoints[checkpoint])
+        for _, _, added, removed, changed in \
+                self.releases[checkpoint + 1:position + 1]:
+            state.update(added)
+            state.update(changed)
+            for dep_id in removed:
+                del state[dep_id]
+        return state
+
+    def dependencies(self, version):
+        # type: (str) -> Dict[str, str]
+        """ Get full dependencies of the release.
+        It takes at most CHECKPOINT_INTERVAL deltas to reconstruct.
+        """
+        state = self._state(self._index[version])
+        return {self.names[dep_id]: constraint
+                for dep_id, constraint in state.items()}
+
+    def __iter__(self):
+        """ Iterate (version, date, dependencies) in order of releases """
+        state = {}
+        for version, date, added, removed, changed in self.releases:
+            state.update(added)
+            state.update(changed)
+            for dep_id in removed:
+                del state[dep_id]
+            yield version, date, {self.names[dep_id]: constraint
+                                  for dep_id, constraint in state.items()}
+
+    def first_added(self, dependency):
+        # type: (str) -> Optional[Tuple[str, str]]
+        """ Get (version, date) of the release which first introduced the
+        dependency, or None. Only `added` lists are scanned. """
+        dep_id = self._ids.get(dependency)
+        if dep_id is None:
+            return None
+        for version, date, added, _, _ in self.releases:
+            if any(item[0] == dep_id for item in added):
+                return version, date
+        return None
+
+    def to_json(self):
+        return [self.name, self.names, self.releases]
+
+    @classmethod
+    def from_json(cls, item):
+        name, names, releases = item
+        timeline = cls(name)
+        timeline.names = names
+        timeline._ids = {dep: dep_id for dep_id, dep in enumerate(names)}
+        for version, date, added, removed, changed in releases:
+            timeline._apply([version, date,
+                             [tuple(pair) for pair in added], removed,
+                             [tuple(pair) for pair in changed]])
+        return timeline
+
+
+def from_rows(rows):
+    # type: (Iterable[Tuple[str, str, str, Dict[str, str]]]) -> Iterator[DependencyTimeline]
+    """ Convert (name, version, date, dependencies) rows into timelines.
+    Rows have to be grouped by package name and sorted by date, e.g.
+    `deprecated.pypi_dependencies()` output sorted by name and date, with
+    `raw_dependencies` parsed from JSON.
+    """
+    for name, releases in itertools.groupby(rows, key=lambda row: row[0]):
+        yield DependencyTimeline.from_history(
+            name, (row[1:] for row in releases))
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf8') \
+            if six.PY3 else gzip.open(path, mode + 'b')
+    return io.open(path, mode, encoding='utf8')
+
+
+def write(path, timelines):
+    # type: (str, Iterable[DependencyTimeline]) -> None
+    """ Save timelines to a JSON lines file, gzipped if path ends with .gz
+    """
+    with _open(path, 'w') as fh:
+        for timeline in timelines:
+            fh.write(six.text_type(json.dumps(
+                timeline.to_json(), separators=(',', ':'))) + u"\n")
+
+
+def read(path, dependency=None):
+    # type: (str, Optional[str]) -> Iterator[DependencyTimeline]
+    """ Iterate timelines stored in the file
+
+    Args:
+        path (str): file path
+        dependency (Optional[str]): only read packages which ever depended
+            on this one. Other lines are skipped without JSON parsing.
+    """
+    quoted = dependency and json.dumps(dependency)
+    with _open(path, 'r') as fh:
+        for line in fh:
+            if quoted and quoted not in line:
+                continue
+            timeline = DependencyTimeline.from_json(json.loads(line))
+            if dependency and dependency not in timeline._ids:
+                continue
+            yield timeline
+
+
+def dependents(path, dependency):
+    # type: (str, str) -> Dict[str, Tuple[str, str]]
+    """ Find when packages started to depend on the given one
+
+    Returns:
+        Dict[str, Tuple[str, str]]: {package: (version, date)} of the
+            release which first introduced the dependency
+    """
+    res = {}
+    for timeline in read(path, dependency):
+        first = timeline.first_added(dependency)
+        if first:
+            res[timeline.name] = first
+    return res
@@ -0,0 +1,280 @@
+
+""" Per-package trace spans
+
+A handful of packages (huge sdists, hanging setup.py, giant zips) take
+most of the crawl time. When tracing is enabled, every instrumented step
+of every package is written to a JSON-lines file:
+
+    {"package": "numpy", "version": "1.16.0", "stage": "download",
+     "parent": null, "start": 1547000000.0, "duration": 12.5,
+     "self": 2.1, "bytes": 15200000, "error": null, "pid": 123}
+
+`duration` is the wall time of the step, `self` excludes nested steps
+(e.g. extraction inside download). Tracing is enabled either by
+the `TRACE_PATH` config variable or explicitly:
+
+    trace.enable('/data/crawl.trace.jsonl')
+
+The file is appended to, so several processes can share it.
+To find the packages to blame:
+
+    python -m stecosystems.trace /data/crawl.trace.jsonl -n 20
+
+or, to skip them in the next crawl, `slow_packages(path, seconds)`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import functools
+import io
+import json
+import os
+import re
+import threading
+import time
+
+import six
+import stutils
+
+# trace file; tracing is disabled if not set
+TRACE_PATH = stutils.get_config('TRACE_PATH')
+
+_lock = threading.Lock()
+_file = None  # opened trace file, None if tracing is disabled
+_local = threading.local()  # stack of active spans of the thread
+
+
+def enable(path):
+    # type: (str) -> None
+    """ Start appending spans to the file """
+    global _file
+    disable()
+    # line buffered: every span is written with a single write() call,
+    # so lines from concurrent processes don't interleave
+    _file = io.open(path, 'a', buffering=1, encoding='utf8')
+
+
+def disable():
+    # type: () -> None
+    """ Stop tracing and close the trace file """
+    global _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        _file = None
+
+
+def enabled():
+    # type: () -> bool
+    return _file is not None
+
+
+class Span(object):
+    """ A single step of package processing, see `span()`.
+    Set `bytes` attribute to report the amount of processed data. """
+    __slots__ = ('package', 'version', 'stage', 'parent', 'start', 'bytes',
+                 'children')
+
+    def __init__(self, package, version, stage, parent):
+        self.package = package
+        self.version = version
+        self.stage = stage
+        self.parent = parent
+        self.start = time.time()
+        self.bytes = None
+        self.children = 0.0  # total duration of nested spans
+
+    def record(self, error=None):
+        duration = time.time() - self.start
+        line = json.dumps({
+            'package': self.package, 'version': self.version,
+            'stage': self.stage, 'parent': self.parent,
+            'start': round(self.start, 3), 'duration': round(duration, 4),
+            'self': round(duration - self.children, 4), 'bytes': self.bytes,
+            'error': error, 'pid': os.getpid()})
+        with _lock:
+            if _file is not None:
+                _file.write(six.text_type(line) + u"\n")
+        return duration
+
+
+class _NullSpan(object):
+    """ Returned by `span()` when tracing is disabled """
+    bytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _SpanContext(object):
+    def __init__(self, package, version, stage):
+        self.args = (package, version, stage)
+        self.span = None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        parent = stack[-1].stage if stack else None
+        self.span = Span(*(self.args + (parent,)))
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stack = _local.stack
+        stack.pop()
+        duration = self.span.record(exc_type and repr(exc_value))
+        if stack:
+            stack[-1].children += duration
+        return False
+
+
+def span(package, version, stage):
+    # type: (str, Optional[str], str) -> ContextManager[Span]
+    """ Context manager tracing a step of package processing
+
+        with trace.span('numpy', '1.16.0', 'extract') as s:
+            ...
+            s.bytes = archive_size
+
+    Exceptions are recorded and re-raised.
+    """
+    if _file is None:
+        return _NullSpan()
+    return _SpanContext(package, version, stage)
+
+
+def traced(stage):
+    """ Decorator to trace a Package method. Package name is taken from
+    `self.name` and version from the first argument, if any.
+    When used with `cached_method`, put it below, so that cache hits
+    are not traced. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            if _file is None:
+                return func(self, *args)
+            with _SpanContext(self.name, args[0] if args else None, stage):
+                return func(self, *args)
+        return wrapper
+    return decorator
+
+
+def read(path):
+    # type: (str) -> Iterator[dict]
+    """ Iterate spans recorded in the trace file """
+    with io.open(path, encoding='utf8') as fh:
+        for line in fh:
+            try:
+                yield json.loads(line)
+            except ValueError:  # e.g. truncated by a killed process
+                continue
+
+
+def _normalize(name):
+    # PEP 503; spans of a package might be recorded under the requested
+    # name and the name from its metadata, e.g. pyyaml and PyYAML
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def package_times(spans):
+    # type: (Iterable[dict]) -> Dict[str, float]
+    """ Total time spent on every package, in seconds.
+    Package names are normalized as per PEP 503. """
+    times = collections.defaultdict(float)
+    for s in spans:
+        times[_normalize(s['package'])] += s['self']
+    return dict(times)
+
+
+def stage_breakdown(spans):
+    # type: (Iterable[dict]) -> Dict[str, dict]
+    """ Time and bytes by stage
+
+    Returns:
+        Dict[str, dict]: stats[stage] = {'count', 'errors', 'time' (self
+            time, i.e. excluding nested stages), 'max', 'bytes'}
+    """
+    stats = {}
+    for s in spans:
+        stage = stats.setdefault(s['stage'], {
+            'count': 0, 'errors': 0, 'time': 0.0, 'max': 0.0, 'bytes': 0})
+        stage['count'] += 1
+        stage['errors'] += bool(s['error'])
+        stage['time'] += s['self']
+        stage['max'] = max(stage['max'], s['duration'])
+        stage['bytes'] += s['bytes'] or 0
+    return stats
+
+
+def slow_packages(path, seconds):
+    # type: (str, float) -> Set[str]
+    """ Normalized names of packages which took more than `seconds`
+    in total, e.g. to exclude them from the next crawl """
+    return {package for package, total in package_times(read(path)).items()
+            if total > seconds}
+
+
+def report(path, top=10):
+    # type: (str, int) -> str
+    """ Text report: the slowest packages and spans, and time by stage """
+    spans = list(read(path))
+    total = sum(s['self'] for s in spans) or 1.0
+    lines = []
+
+    lines.append("Slowest packages:")
+    times = package_times(spans)
+    for package, seconds in sorted(
+            times.items(), key=lambda item: -item[1])[:top]:
+        lines.append("  %-40s %10.2fs %5.1f%%" % (
+            package, seconds, 100 * seconds / total))
+
+    lines.append("")
+    lines.append("Slowest steps:")
+    for s in sorted(spans, key=lambda s: -s['duration'])[:top]:
+        lines.append("  %-40s %-16s %10.2fs %12s%s" % (
+            "%s %s" % (s['package'], s['version'] or ""), s['stage'],
+            s['duration'], s['bytes'] if s['bytes'] is not None else "",
+            "  " + s['error'] if s['error'] else ""))
+
+    lines.append("")
+    lines.append("Time by stage (excluding nested stages):")
+    lines.append("  %-16s %8s %7s %10s %6s %10s %14s" % (
+        "stage", "count", "errors", "time, s", "%", "max, s", "bytes"))
+    for stage, st in sorted(stage_breakdown(spans).items(),
+                            key=lambda item: -item[1]['time']):
+        lines.append("  %-16s %8d %7d %10.2f %6.1f %10.2f %14d" % (
+            stage, st['count'], st['errors'], st['time'],
+            100 * st['time'] / total, st['max'], st['bytes']))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m stecosystems.trace",
+        description="Report the slowest packages and stages of a crawl")
+    parser.add_argument('path', help="trace file")
+    parser.add_argument('-n', '--top', type=int, default=10,
+                        help="number of packages and steps to list")
+    parser.add_argument('--slower-than', type=float, metavar="SECONDS",
+                        help="only print names of packages which took "
+                             "longer than this, one per line")
+    args = parser.parse_args(args)
+
+    if args.slower_than is not None:
+        for package in sorted(slow_packages(args.path, args.slower_than)):
+            print(package)
+    else:
+        print(report(args.path, args.top))
+
+
+if TRACE_PATH:
+    enable(TRACE_PATH)
+
+if __name__ == '__main__':
+    main()
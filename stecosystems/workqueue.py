@@ -0,0 +1,570 @@
+
+""" Lease-based work queue for long-running crawls
+
+Crawling dependencies of every release takes about a week in a single
+process. This queue keeps (package, version, task) jobs in a SQLite
+database, so that any number of worker processes, on one or many nodes,
+can pull jobs from it:
+
+    queue = WorkQueue('/shared/crawl.db')
+    queue.add([('six', '1.12.0', 'pypi.dependencies'),
+               ('six', '1.11.0', 'pypi.dependencies')])
+
+and then, in every worker process:
+
+    work(WorkQueue('/shared/crawl.db'))
+
+or from the command line:
+
+    python -m stecosystems.workqueue /shared/crawl.db --processes 4
+
+A worker leases jobs for `lease_time` seconds and extends the lease while
+the job is running (heartbeat). If a worker dies, its lease expires and
+the job is handed to another worker; jobs failing `max_attempts` times are
+marked failed. Results are written once per job: if a job was completed
+twice, e.g. by a worker which lost its lease, the first result is kept.
+
+To keep the network busy while a worker parses releases, files of the
+leased jobs can be downloaded in background, see `prefetch`:
+
+    python -m stecosystems.workqueue /shared/crawl.db --batch 16 \\
+        --prefetch-bytes 1000000000
+
+Multi-node setups need a shared filesystem with working POSIX locks
+(most NFSv4 setups, but not SMB) and reasonably synchronized clocks.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+from .base import PackageDoesNotExist
+
+LEASE_TIME = 600  # seconds
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 10  # seconds between polls when all jobs are leased
+ADD_BATCH_SIZE = 1000  # jobs inserted in a single transaction by `add()`
+
+logger = logging.getLogger('stecosystems.workqueue')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    package TEXT NOT NULL,
+    version TEXT NOT NULL,  -- empty string for package-level tasks
+    task TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- leased, done, failed
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (package, version, task)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER PRIMARY KEY,
+    result TEXT,
+    worker TEXT,
+    finished REAL
+);
+"""
+
+Job = collections.namedtuple(
+    'Job', ('id', 'package', 'version', 'task', 'attempts'))
+
+
+def shard_of(package):
+    # type: (str) -> int
+    """ Stable (across processes and nodes) shard key of the package """
+    return zlib.crc32(package.encode('utf8')) & 0xffffffff
+
+
+def worker_id():
+    # type: () -> str
+    """ Default worker identifier, <hostname>:<pid> """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """ SQLite-backed queue of (package, version, task) jobs
+
+    Instances are safe to use from several threads and survive fork():
+    every thread and process opens its own connection.
+    """
+    path = None
+    lease_time = LEASE_TIME
+    max_attempts = MAX_ATTEMPTS
+
+    def __init__(self, path, lease_time=LEASE_TIME, max_attempts=MAX_ATTEMPTS):
+        """
+        Args:
+            path (str): database file, created if doesn't exist
+            lease_time (int): seconds a job is reserved for a worker
+                without a heartbeat
+            max_attempts (int): number of times a job is leased
+                before it is marked failed
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def __repr__(self):
+        return "<WorkQueue: %s>" % self.path
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # autocommit mode; transactions are started explicitly
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _execute(self, func):
+        """ Run func(connection) in a write transaction """
+        conn = self._connection()
+        # IMMEDIATE takes the write lock right away, so that two workers
+        # can't select the same jobs before either of them updated them
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def add(self, jobs, batch_size=ADD_BATCH_SIZE):
+        # type: (Iterable[Tuple[str, Optional[str], str]], int) -> int
+        """ Add (package, version, task) jobs; version can be None for
+        package-level tasks. Already existing jobs are ignored, so it is
+        safe to re-add the same jobs, e.g. on restart of an interrupted crawl.
+
+        Jobs are inserted in transactions of `batch_size` jobs, and the
+        database is not locked while the next batch is collected. So, jobs
+        can come from a slow generator while workers are processing them.
+
+        Returns:
+            int: number of new jobs
+        """
+        def insert(rows):
+            def func(conn):
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO jobs (package, version, task, "
+                    "  shard) VALUES (?, ?, ?, ?)", rows)
+                return conn.total_changes - before
+            return self._execute(func)
+
+        added = 0
+        rows = []
+        for package, version, task in jobs:
+            rows.append((package, version or "", task, shard_of(package)))
+            if len(rows) >= batch_size:
+                added += insert(rows)
+                rows = []
+        if rows:
+            added += insert(rows)
+        return added
+
+    def lease(self, worker=None, limit=1, shard=None):
+        # type: (Optional[str], int, Optional[Tuple[int, int]]) -> List[Job]
+        """ Reserve up to `limit` jobs for the worker
+
+        Args:
+            worker (Optional[str]): worker id, `worker_id()` by default
+            limit (int): max number of jobs
+            shard (Optional[Tuple[int, int]]): (i, n) to only lease jobs
+                of the i-th of n disjoint package subsets. Jobs of the same
+                package always belong to the same shard.
+
+        Returns:
+            List[Job]: leased jobs, empty if there is nothing to do now
+        """
+        worker = worker or worker_id()
+        now = time.time()
+        query = ("SELECT id, package, version, task, attempts FROM jobs "
+                 "WHERE (status = 'pending' "
+                 "       OR (status = 'leased' AND lease_until < ?)) "
+                 "  AND attempts < ?")
+        params = [now, self.max_attempts]
+        if shard is not None:
+            query += " AND shard % ? = ?"
+            params.extend((shard[1], shard[0]))
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+
+        def reserve(conn):
+            # expired leases of jobs which ran out of attempts
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', worker = NULL, "
+                "  error = 'lease expired' "
+                "WHERE status = 'leased' AND lease_until < ? "
+                "  AND attempts >= ?", (now, self.max_attempts))
+            rows = conn.execute(query, params).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'leased', worker = ?, "
+                "  lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                ((worker, now + self.lease_time, row[0]) for row in rows))
+            return [Job(job_id, package, version or None, task, attempts + 1)
+                    for job_id, package, version, task, attempts in rows]
+        return self._execute(reserve)
+
+    def heartbeat(self, jobs, worker=None):
+        # type: (Iterable[Job], Optional[str]) -> int
+        """ Extend leases of the jobs still held by the worker
+
+        Returns:
+            int: number of extended leases. Jobs not counted were taken
+                over by other workers after the lease expired.
+        """
+        worker = worker or worker_id()
+        lease_until = time.time() + self.lease_time
+
+        def extend(conn):
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE jobs SET lease_until = ? "
+                "WHERE id = ? AND status = 'leased' AND worker = ?",
+                ((lease_until, job.id, worker) for job in jobs))
+            return conn.total_changes - before
+        return self._execute(extend)
+
+    def complete(self, job, result, worker=None):
+        # type: (Job, object, Optional[str]) -> bool
+        """ Store the job result (any JSON-serializable object)
+
+        Result writes are idempotent: if the job is already completed,
+        the stored result is kept.
+
+        Returns:
+            bool: whether the result was stored
+        """
+        worker = worker or worker_id()
+        data = json.dumps(result)
+
+        def store(conn):
+            before = conn.total_changes
+            conn.execute(
+                "INSERT OR IGNORE INTO results (job_id, result, worker, "
+                "  finished) VALUES (?, ?, ?, ?)",
+                (job.id, data, worker, time.time()))
+            stored = conn.total_changes > before
+            conn.execute(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, "
+                "  error = NULL WHERE id = ?", (job.id,))
+            return stored
+        return self._execute(store)
+
+    def fail(self, job, error, worker=None, retry=True):
+        # type: (Job, str, Optional[str], bool) -> None
+        """ Release the job after an error
+
+        Args:
+            job (Job): leased job
+            error (str): error description, kept for diagnostics
+            worker (Optional[str]): worker id, `worker_id()` by default
+            retry (bool): return the job to the queue, unless it ran out
+                of attempts. Use False for permanent errors, e.g.
+                non-existent packages.
+        """
+        worker = worker or worker_id()
+        status = 'pending' if retry and job.attempts < self.max_attempts \
+            else 'failed'
+        self._execute(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, "
+            "  error = ? "
+            "WHERE id = ? AND status = 'leased' AND worker = ?",
+            (status, error, job.id, worker)))
+
+    def retry_failed(self, task=None):
+        # type: (Optional[str]) -> int
+        """ Return failed jobs to the queue, resetting their attempts """
+        query = ("UPDATE jobs SET status = 'pending', attempts = 0, "
+                 "  error = NULL WHERE status = 'failed'")
+        params = ()
+        if task is not None:
+            query += " AND task = ?"
+            params = (task,)
+
+        def reset(conn):
+            before = conn.total_changes
+            conn.execute(query, params)
+            return conn.total_changes - before
+        return self._execute(reset)
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """ Number of jobs by status: pending, leased, done, failed """
+        counts = dict.fromkeys(('pending', 'leased', 'done', 'failed'), 0)
+        counts.update(self._connection().execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return counts
+
+    def unfinished(self):
+        # type: () -> int
+        """ Number of jobs which are neither done nor failed """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')"
+        ).fetchone()[0]
+
+    def results(self, task=None):
+        # type: (Optional[str]) -> Iterator[Tuple[str, Optional[str], str, object]]
+        """ Iterate (package, version, task, result) of completed jobs """
+        query = ("SELECT package, version, task, result FROM jobs "
+                 "JOIN results ON results.job_id = jobs.id")
+        params = ()
+        if task is not None:
+            query += " WHERE task = ?"
+            params = (task,)
+        for package, version, task_name, result in \
+                self._connection().execute(query + " ORDER BY id", params):
+            yield package, version or None, task_name, json.loads(result)
+
+    def errors(self):
+        # type: () -> Iterator[Tuple[str, Optional[str], str, str]]
+        """ Iterate (package, version, task, error) of failed jobs """
+        for package, version, task, error in self._connection().execute(
+                "SELECT package, version, task, error FROM jobs "
+                "WHERE status = 'failed' ORDER BY id"):
+            yield package, version or None, task, error
+
+
+def _pypi_dependencies(package, version):
+    from . import pypi
+    return pypi.Package.get(package).dependencies(version)
+
+
+def _pypi_loc_size(package, version):
+    from . import pypi
+    return pypi.Package.get(package).loc_size(version)
+
+
+def _pypi_imports(package, version):
+    from . import pypi
+    return {kind: sorted(modules) for kind, modules
+            in pypi.Package.get(package).imports(version).items()}
+
+
+# handlers by task name: handler(package, version) -> JSON-serializable
+TASKS = {
+    'pypi.dependencies': _pypi_dependencies,
+    'pypi.loc_size': _pypi_loc_size,
+    'pypi.imports': _pypi_imports,
+}
+
+# download purposes of the release files used by tasks, to prefetch them
+PREFETCH_PURPOSES = {
+    'pypi.dependencies': ('metadata',),
+    'pypi.loc_size': ('source',),
+    'pypi.imports': ('source',),
+}
+
+
+def _prefetch_files(job):
+    # type: (Job) -> List[Tuple[str, int]]
+    """ (url, size) of the files the job will download """
+    purposes = PREFETCH_PURPOSES.get(job.task)
+    if not purposes or not job.version:
+        return []
+    from . import pypi
+    return pypi.Package.get(job.package).release_files(job.version, purposes)
+
+
+class _Heartbeat(threading.Thread):
+    """ Extend leases of the jobs in background until stopped """
+    def __init__(self, queue, jobs, worker, interval):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.jobs = jobs
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.jobs, self.worker)
+            except sqlite3.Error as e:
+                logger.warning("Heartbeat failed: %s", e)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.join()
+
+
+def work(queue, handlers=None, worker=None, batch=1, shard=None, wait=True,
+         max_jobs=None, prefetch=None):
+    # type: (WorkQueue, Optional[Dict[str, Callable]], Optional[str], int, Optional[Tuple[int, int]], bool, Optional[int], Optional[dict]) -> int
+    """ Process jobs from the queue until there is nothing left to do
+
+    Args:
+        queue (WorkQueue): the queue
+        handlers (Optional[Dict[str, Callable]]): handler(package, version)
+            by task name, `TASKS` by default
+        worker (Optional[str]): worker id, `worker_id()` by default
+        batch (int): number of jobs to lease at once
+        shard (Optional[Tuple[int, int]]): see `WorkQueue.lease()`
+        wait (bool): if all remaining jobs are leased by other workers,
+            wait for them in case their leases expire. Otherwise, return
+            as soon as there is nothing to lease.
+        max_jobs (Optional[int]): stop after processing this many jobs
+        prefetch (Optional[dict]): to download files of the leased jobs
+            in background, `prefetch.Prefetcher` arguments except
+            the package class, e.g. {'max_bytes': 10 ** 9}. The store
+            path defaults to `.prefetch` in `pypi.save_path()`. Only jobs
+            of the same batch are prefetched, so smaller batches are raised
+            to the prefetcher lookahead.
+
+    Returns:
+        int: number of processed jobs
+    """
+    if prefetch is not None:
+        from . import pypi
+        from .prefetch import Prefetcher
+        prefetch = dict(prefetch)
+        prefetch.setdefault(
+            'path', os.path.join(pypi.save_path(), '.prefetch'))
+        with Prefetcher(pypi.Package, **prefetch) as prefetcher:
+            if prefetcher.active and batch < prefetcher.lookahead:
+                logger.warning(
+                    "Prefetch only looks ahead within a leased batch, "
+                    "leasing %d jobs at once instead of %d",
+                    prefetcher.lookahead, batch)
+                batch = prefetcher.lookahead
+            return _work(queue, handlers, worker, batch, shard, wait,
+                         max_jobs, prefetcher)
+    return _work(queue, handlers, worker, batch, shard, wait, max_jobs)
+
+
+def _work(queue, handlers, worker, batch, shard, wait, max_jobs,
+          prefetcher=None):
+    handlers = TASKS if handlers is None else handlers
+    worker = worker or worker_id()
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        limit = batch if max_jobs is None else min(batch, max_jobs - processed)
+        jobs = queue.lease(worker, limit, shard)
+        if not jobs:
+            if not wait or not queue.unfinished():
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        with _Heartbeat(queue, jobs, worker, queue.lease_time / 3.0):
+            if prefetcher is not None:
+                # files of the next jobs download while this one is running
+                jobs = prefetcher.ahead(jobs, _prefetch_files)
+            for job in jobs:
+                processed += 1
+                handler = handlers.get(job.task)
+                if handler is None:
+                    queue.fail(job, "Unknown task: %s" % job.task, worker,
+                               retry=False)
+                    continue
+                logger.info("%s: %s %s %s", worker, job.task, job.package,
+                            job.version or "")
+                try:
+                    result = handler(job.package, job.version)
+                except PackageDoesNotExist as e:
+                    queue.fail(job, str(e), worker, retry=False)
+                except Exception as e:
+                    logger.warning("%s %s %s failed: %r", job.task,
+                                   job.package, job.version or "", e)
+                    queue.fail(job, repr(e), worker)
+                else:
+                    queue.complete(job, result, worker)
+    return processed
+
+
+def _work_process(args):
+    # entry point of worker processes started by run()
+    path, kwargs = args
+    return work(WorkQueue(path), **kwargs)
+
+
+def run(path, processes=None, **kwargs):
+    # type: (str, Optional[int], **Any) -> int
+    """ Run `work()` in several local processes
+
+    Args:
+        path (str): queue database file
+        processes (Optional[int]): number of worker processes,
+            number of CPUs by default
+        **kwargs: `work()` arguments, except queue and worker.
+            Handlers have to be picklable, i.e. module-level functions.
+
+    Returns:
+        int: total number of processed jobs
+    """
+    processes = processes or multiprocessing.cpu_count()
+    WorkQueue(path)  # create schema before workers compete for it
+    pool = multiprocessing.Pool(processes)
+    try:
+        return sum(pool.map(_work_process, [(path, kwargs)] * processes))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m stecosystems.workqueue",
+        description="Process jobs from a shared work queue")
+    parser.add_argument('path', help="queue database file")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="number of worker processes")
+    parser.add_argument('-b', '--batch', type=int, default=1,
+                        help="number of jobs to lease at once; with prefetch, "
+                             "at least the prefetch lookahead")
+    parser.add_argument('--shard', help="i/n, process only i-th of n shards")
+    parser.add_argument('--prefetch-bytes', type=int, metavar="BYTES",
+                        help="download files of leased jobs in background, "
+                             "keeping at most this many bytes per process")
+    parser.add_argument('--prefetch-workers', type=int,
+                        help="number of download threads per process")
+    parser.add_argument('--no-wait', action='store_true',
+                        help="exit as soon as there is nothing to lease")
+    parser.add_argument('--stats', action='store_true',
+                        help="print job counts by status and exit")
+    args = parser.parse_args(args)
+
+    if args.stats:
+        for status, count in WorkQueue(args.path).stats().items():
+            print("%-8s %d" % (status, count))
+        return
+
+    shard = args.shard and tuple(int(i) for i in args.shard.split("/"))
+    prefetch = None
+    if args.prefetch_bytes or args.prefetch_workers:
+        prefetch = {}
+        if args.prefetch_bytes:
+            prefetch['max_bytes'] = args.prefetch_bytes
+        if args.prefetch_workers:
+            prefetch['workers'] = args.prefetch_workers
+    processed = run(args.path, args.processes, batch=args.batch, shard=shard,
+                    wait=not args.no_wait, prefetch=prefetch)
+    logger.info("Processed %d jobs", processed)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
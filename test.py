@@ -0,0 +1,1886 @@
+
+import csv
+import gc
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+import six
+from six.moves import BaseHTTPServer
+
+from stecosystems import __main__ as cli
+from stecosystems import base
+from stecosystems import deprecated
+from stecosystems import dumpindex
+from stecosystems import fingerprints
+from stecosystems import mirror
+from stecosystems import modindex
+from stecosystems import negcache
+from stecosystems import npm
+from stecosystems import npmsync
+from stecosystems import pipeline
+from stecosystems import prefetch
+from stecosystems import pypi
+from stecosystems import sampling
+from stecosystems import timeline
+from stecosystems import trace
+from stecosystems import workqueue
+
+try:  # async crawler is Python 3 only
+    import aiohttp  # noqa: F401
+    from stecosystems import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+def _pypi_package(name, versions):
+    # a package object built from minimal info, without network requests
+    return pypi.Package(name, info={
+        'info': {'name': name, 'version': versions[-1]},
+        'releases': {version: [] for version in versions}})
+
+
+class TestDependencyHistory(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _metadata(self, version, deps):
+        path = os.path.join(self.path, version, 'METADATA')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write("Name: foo\nVersion: %s\n" % version)
+            fh.writelines("Requires-Dist: %s\n" % dep for dep in deps)
+            fh.write("\nfoo %s long description\n" % version)
+        return path
+
+    def test_dedupe(self):
+        sources = {
+            '1.0': self._metadata('1.0', ['six']),
+            '1.1': self._metadata('1.1', ['six']),
+            '2.0': self._metadata('2.0', ['six', 'requests (>=2.0)']),
+        }
+        package = _pypi_package('foo', sorted(sources))
+        package.releases = lambda *args: [(v, None) for v in sorted(sources)]
+        package._dependencies_source = lambda ver: ('METADATA', sources[ver])
+        parsed = []
+        lock = threading.Lock()
+
+        def parse(source_type, path):
+            with lock:
+                parsed.append(path)
+            return pypi.parse_dependencies(source_type, path)
+        package._parse_dependencies = parse
+
+        history = package.dependency_history()
+        # 1.0 and 1.1 differ only in version and description
+        self.assertEqual(len(parsed), 2)
+        self.assertEqual(list(history), ['1.0', '1.1', '2.0'])
+        self.assertEqual(history['1.0'], {'six': ''})
+        self.assertEqual(history['1.1'], {'six': ''})
+        self.assertEqual(history['2.0'], {'six': '', 'requests': '>=2.0'})
+
+    def _setup_dir(self, version, setup, files=None):
+        folder = os.path.join(self.path, 'foo-' + version)
+        for relpath, content in dict(files or {}, **{'setup.py': setup}
+                                     ).items():
+            path = os.path.join(folder, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write(content)
+        return folder
+
+    def test_setup_hash_version_pin(self):
+        setup = ("VERSION = '%s'\nsetup(name='foo', version=VERSION, "
+                 "install_requires=['foo-core==%%s' %% VERSION])")
+        self.assertNotEqual(
+            pypi.dependency_source_hash(
+                'setup.py', self._setup_dir('1.0', setup % '1.0')),
+            pypi.dependency_source_hash(
+                'setup.py', self._setup_dir('2.0', setup % '2.0')))
+
+    def test_setup_hash_nested_inputs(self):
+        setup = ("setup(name='foo', install_requires="
+                 "open('req/base.txt').read().split())")
+        self.assertNotEqual(
+            pypi.dependency_source_hash('setup.py', self._setup_dir(
+                '1.0', setup, {'req/base.txt': 'six'})),
+            pypi.dependency_source_hash('setup.py', self._setup_dir(
+                '2.0', setup, {'req/base.txt': 'requests'})))
+
+    def test_failed_releases(self):
+        sources = {'1.0': self._metadata('1.0', ['six']),
+                   '2.0': self._metadata('2.0', ['six'])}
+        package = _pypi_package('foo', ['1.0', '2.0', '3.0'])
+        package.releases = lambda *args: [(v, None) for v in
+                                          ('1.0', '2.0', '3.0')]
+
+        def source(ver):
+            if ver == '2.0':
+                raise IOError("download failed")
+            if ver == '3.0':  # nothing to parse
+                return None, None
+            return 'METADATA', sources[ver]
+        package._dependencies_source = source
+        history = package.dependency_history()
+        self.assertEqual(history, {'1.0': {'six': ''}, '2.0': None,
+                                   '3.0': {}})
+
+    def test_no_setup(self):
+        folder = self._setup_dir('1.0', "raise ValueError()")
+        package = _pypi_package('foo', ['1.0'])
+        package.releases = lambda *args: [('1.0', None)]
+        package._dependencies_source = lambda ver: ('setup.py', folder)
+        package.get_setup_params = lambda extract_dir: None
+        no_setup = []
+        package._add_no_setup = lambda *args: no_setup.append(args)
+        self.assertEqual(package.dependency_history(), {'1.0': {}})
+        self.assertEqual(no_setup, [('1.0', 'metadata', folder)])
+
+
+class TestPythonFileLoc(unittest.TestCase):
+    def assertLoc(self, source, code=0, docstring=0, comment=0, empty=0):
+        self.assertEqual(pypi.python_file_loc(source), {
+            'code': code, 'docstring': docstring, 'comment': comment,
+            'empty': empty})
+
+    def test_blocks(self):
+        self.assertLoc(b"def f():\n    pass\n", code=2)
+        # trailing dedents at the end of file
+        self.assertLoc(b"def f():\n    if x:\n        pass\n", code=3)
+        self.assertLoc(b"def f():\n    if x:\n        pass", code=3)
+        self.assertLoc(b"class A:\n    def f(self):\n        pass\n\n"
+                       b"    x = 1\n", code=4, empty=1)
+
+    def test_docstrings(self):
+        self.assertLoc(b'"""doc\nstring"""\n', docstring=2)
+        # a docstring after a dedent
+        self.assertLoc(b"def f():\n    pass\n'doc'\n", code=2, docstring=1)
+        self.assertLoc(b'def f():\n    """doc"""\n    return 1\n',
+                       code=2, docstring=1)
+
+    def test_comments(self):
+        self.assertLoc(b"# comment\nx = 1  # comment\n\n", code=1,
+                       comment=1, empty=1)
+        self.assertLoc(b"if x:\n    pass\n# comment\n", code=2, comment=1)
+
+    def test_multiline(self):
+        self.assertLoc(b"x = [\n    1,\n    2,\n]\n", code=4)
+
+    def test_not_tokenizable(self):
+        # falls back to line-by-line counting
+        self.assertLoc(b"x = (\n# comment\n", code=1, comment=1)
+
+
+class TestFingerprintStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = fingerprints.FingerprintStore(
+            os.path.join(self.path, 'loc.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        counts = {'code': 3, 'docstring': 1, 'comment': 0, 'empty': 2}
+        self.store.add_files({'abc': counts})
+        self.assertEqual(self.store.files(['abc', 'def']), {'abc': counts})
+        self.store.add_release('foo', '1.0', 3)
+        self.assertEqual(self.store.releases('foo'), {'1.0': 3})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork()")
+    def test_forked_connection(self):
+        conn = self.store._connection()
+        pid = os.fork()
+        if not pid:  # child process
+            status = 1
+            try:
+                if self.store._connection() is not conn:
+                    self.store.add_release('foo', '1.0', 3)
+                    status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(self.store._connection(), conn)
+        self.assertEqual(self.store.releases('foo'), {'1.0': 3})
+
+
+class TestJsLineCounter(unittest.TestCase):
+    def count(self, *lines):
+        counter = npm.JsLineCounter()
+        for line in lines:
+            counter.feed(line)
+        return counter.counts
+
+    def assertCounts(self, lines, code=0, comment=0, empty=0):
+        self.assertEqual(self.count(*lines), {
+            'code': code, 'docstring': 0, 'comment': comment,
+            'empty': empty})
+
+    def test_basic(self):
+        self.assertCounts([b"var a = 1;", b"", b"  ", b"// comment"],
+                          code=1, comment=1, empty=2)
+
+    def test_block_comments(self):
+        self.assertCounts([b"/**", b" * doc", b"", b" */"], comment=4)
+        self.assertCounts([b"/* a */ var a; /* b", b"*/ var b;"], code=2)
+        self.assertCounts([b"/* a */ /* b */"], comment=1)
+
+    def test_strings(self):
+        self.assertCounts([b"var s = '/* not a comment';", b"// comment"],
+                          code=1, comment=1)
+        self.assertCounts([b'var s = "// not a comment \\" still";'], code=1)
+
+    def test_template_literals(self):
+        # lines inside template literals are code, even if they look empty
+        # or like comments
+        self.assertCounts([b"var t = `", b"", b"// text", b"`;",
+                           b"// comment"], code=4, comment=1)
+
+    def test_continued(self):
+        counter = npm.JsLineCounter()
+        counter.feed(b"/* comment */")
+        counter.feed(b" var a = 1;", continued=True)
+        counter.feed(b"    ")
+        counter.feed(b"// comment", continued=True)
+        self.assertEqual(counter.counts, {
+            'code': 1, 'docstring': 0, 'comment': 1, 'empty': 0})
+
+    def test_tarball(self):
+        files = {
+            'package/index.js': b"// main\nvar a = 1;\n\nmodule.exports = a;\n",
+            'package/lib/min.js': b"var b=1;" * 20000 + b"\n",
+            'package/README.md': b"# not counted\n",
+            'package/node_modules/dep/index.js': b"var c = 1;\n",
+        }
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        buf.seek(0)
+        stats = npm.tarball_loc(buf)
+        self.assertEqual(
+            (stats['code'], stats['comment'], stats['empty'], stats['files']),
+            (3, 1, 1, 2))
+        self.assertEqual(stats['bytes'], len(buf.getvalue()))
+        self.assertEqual(stats['unpacked_bytes'],
+                         sum(len(content) for content in files.values()))
+
+
+class _ChangesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in of the registry CouchDB database """
+    def do_GET(self):
+        url = six.moves.urllib.parse.urlparse(self.path)
+        query = dict(six.moves.urllib.parse.parse_qsl(url.query))
+        changes = self.server.changes
+        self.server.requests.append(url.path)
+        if url.path == '/registry':
+            res = {'update_seq': len(changes)}
+        elif url.path == '/registry/_changes':
+            since = int(query.get('since', 0))
+            rows = changes[since:since + int(query['limit'])]
+            res = {'results': rows, 'last_seq': since + len(rows)}
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(res).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNpmSync(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), _ChangesHandler)
+        self.server.changes = []
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.sync = npmsync.NpmSync(
+            self.path, 'http://127.0.0.1:%d/registry' % self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def change(self, name, version=None):
+        seq = len(self.server.changes) + 1
+        row = {'seq': seq, 'id': name}
+        if version is None:
+            row['deleted'] = True
+        else:
+            row['doc'] = {'_id': name, 'name': name,
+                          'versions': {version: {}}}
+        self.server.changes.append(row)
+
+    def test_sync(self):
+        self.change('a', '1.0.0')
+        self.assertEqual(self.sync.bootstrap(), 1)
+        self.assertEqual(self.sync.sync(), [])
+
+        self.change('b', '1.0.0')
+        self.change('@scope/c', '1.0.0')
+        self.change('_design/app', '1')  # not a package
+        self.change('b', '1.1.0')
+        self.change('d', '1.0.0')
+        self.change('d')  # deleted
+        del self.server.requests[:]
+        self.assertEqual(self.sync.sync(batch_size=2),
+                         ['@scope/c', 'b', 'd'])
+        self.assertEqual(self.sync.seq, 7)
+        # three full batches and an empty one
+        self.assertEqual(self.server.requests.count('/registry/_changes'), 4)
+        self.assertEqual(self.sync.get('a'), None)  # before bootstrap
+        self.assertEqual(list(self.sync.get('b')['versions']), ['1.1.0'])
+        self.assertEqual(self.sync.get('@scope/c')['name'], '@scope/c')
+        self.assertEqual(self.sync.get('d'), None)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, '_design', 'app', 'index.json')))
+        packages = list(self.sync.packages(['b', 'd']))
+        self.assertEqual([p.name for p in packages], ['b'])
+
+    def test_resume(self):
+        self.sync.bootstrap(0)
+        for i in range(5):
+            self.change('p%d' % i, '1.0.0')
+        self.assertEqual(self.sync.sync(batch_size=2, max_batches=1),
+                         ['p0', 'p1'])
+        self.assertEqual(self.sync.seq, 2)
+        resumed = npmsync.NpmSync(self.path, self.sync.registry)
+        self.assertEqual(resumed.sync(batch_size=2), ['p2', 'p3', 'p4'])
+
+    def test_not_bootstrapped(self):
+        self.assertRaises(ValueError, self.sync.sync)
+
+    def test_import_packages(self):
+        doc = {'_id': 'e', 'name': 'e', 'versions': {'1.0.0': {}}}
+        package = npm.Package('e', info=doc)
+        self.assertEqual(self.sync.import_packages([package]), 1)
+        self.assertEqual(self.sync.get('e'), doc)
+        # documents of compact packages are not kept
+        compact = npm.Package('e', info=doc, compact=True)
+        self.assertRaises(ValueError, self.sync.import_packages, [compact])
+        self.assertEqual(self.server.requests, [])
+
+
+def _tarball(path, files):
+    """ Write a .tar.gz archive, {member name: content} """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), _RegistryHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.mirror = mirror.PypiMirror(self.path)
+
+        class Package(pypi.Package):
+            base_url = 'http://127.0.0.1:%d' % self.server.server_port
+            mirror = self.mirror
+        self.package_class = Package
+        self._negative_cache = pypi._negative_cache
+        pypi._negative_cache = negcache.NegativeCache(
+            os.path.join(self.path, 'negative.sqlite'))
+
+    def tearDown(self):
+        pypi._negative_cache = self._negative_cache
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def _write(self, relpath, content):
+        path = os.path.join(self.path, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def _info(self, name, url=None):
+        files = url and [{'url': url, 'packagetype': 'sdist', 'size': 100,
+                          'filename': url.rsplit('/', 1)[-1],
+                          'upload_time': '2019-01-01T00:00:00'}]
+        return {'info': {'name': name, 'version': '1.0'},
+                'releases': {'1.0': files or []}}
+
+    def test_metadata(self):
+        # both bandersnatch layouts
+        self._write('web/json/Foo.Bar', json.dumps(
+            self._info('Foo.Bar')).encode('utf8'))
+        self._write('web/pypi/baz-qux/json', json.dumps(
+            self._info('baz_qux')).encode('utf8'))
+        self._write('web/json/broken', b'{')
+        self.assertEqual(self.mirror.metadata('Foo.Bar')['info']['name'],
+                         'Foo.Bar')
+        self.assertEqual(self.mirror.metadata('Baz_Qux')['info']['name'],
+                         'baz_qux')
+        self.assertIsNone(self.mirror.metadata('broken'))
+        self.assertIsNone(self.mirror.metadata('missing'))
+
+    def test_file_path(self):
+        url = 'https://files.pythonhosted.org/packages/aa/bb/cc/foo-1.0.tar.gz'
+        self.assertIsNone(self.mirror.file_path(url))
+        path = self._write('web/packages/aa/bb/cc/foo-1.0.tar.gz', b'')
+        self.assertEqual(self.mirror.file_path(url), path)
+        self.assertIsNone(self.mirror.file_relpath(
+            'https://example.com/foo-1.0.tar.gz'))
+
+    def test_fallback(self):
+        self._write('web/json/mirrored', json.dumps(
+            self._info('mirrored')).encode('utf8'))
+        self.assertEqual(self.package_class('mirrored').latest_ver, '1.0')
+        self.assertEqual(self.server.requests, [])
+        # a miss goes to the registry
+        self.assertEqual(self.package_class('remote').latest_ver, '1.0')
+        self.assertEqual(self.server.requests, ['/pypi/remote/json'])
+
+        self.mirror.fallback = False
+        self.assertRaises(pypi.PackageDoesNotExist,
+                          self.package_class, 'remote')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_download(self):
+        name = 'foo-%d' % os.getpid()
+        url = ('https://files.pythonhosted.org/packages/aa/bb/%s-1.0.tar.gz'
+               % name)
+        archive = os.path.join(self.path, 'web', 'packages', 'aa', 'bb',
+                               name + '-1.0.tar.gz')
+        _tarball(archive, {name + '-1.0/foo/__init__.py': b"x = 1\n"})
+        calls = []
+        saved = pypi.urlretrieve
+        pypi.urlretrieve = lambda *args: calls.append(args)
+        try:
+            package = self.package_class(name, info=self._info(name, url))
+            path = package.download('1.0')
+            self.assertTrue(os.path.isfile(
+                os.path.join(path, 'foo', '__init__.py')))
+            # extracted right from the mirror, without copying
+            self.assertFalse(any(fname.endswith('.tar.gz') for fname in
+                                 os.listdir(os.path.dirname(path))))
+            del package
+
+            os.remove(archive)
+            self.mirror.fallback = False
+            package = self.package_class(name, info=self._info(name, url))
+            self.assertIsNone(package.download('1.0'))
+            del package
+        finally:
+            pypi.urlretrieve = saved
+        self.assertEqual(calls, [])
+
+    def test_npm(self):
+        npm_mirror = mirror.NpmMirror(self.path, fallback=False)
+        url = 'https://registry.npmjs.org/@scope/foo/-/foo-1.0.0.tgz'
+        self._write('@scope/foo/index.json', json.dumps({
+            '_id': '@scope/foo', 'name': '@scope/foo',
+            'versions': {'1.0.0': {'dist': {'tarball': url}}}}).encode('utf8'))
+        _tarball(os.path.join(self.path, '@scope', 'foo', '-',
+                              'foo-1.0.0.tgz'),
+                 {'package/index.js': b"// comment\nvar x = 1;\n"})
+
+        class Package(npm.Package):
+            base_url = self.package_class.base_url + '/npm/'
+            mirror = npm_mirror
+            dump = {}
+
+        package = Package('@scope/foo')
+        self.assertEqual(package.loc_size('1.0.0'), 1)
+        self.assertRaises(npm.PackageDoesNotExist, Package, 'missing')
+        self.assertEqual(self.server.requests, [])
+
+
+class _SimpleIndexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in of the PyPI simple index, HTML or JSON (PEP 691) """
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        names = self.server.names
+        if self.server.json:
+            content_type = pypi.SIMPLE_JSON
+            data = json.dumps({'meta': {'api-version': '1.0'}, 'projects': [
+                {'name': name} for name in names]})
+        else:
+            content_type = 'text/html; charset=utf-8'
+            data = "<html><body>\n%s\n</body></html>" % "\n".join(
+                '<a href="/simple/%s/">%s</a>' % (name, name)
+                for name in names)
+        data = data.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPypiNames(unittest.TestCase):
+    # in the order of the index, not sorted
+    names = ['Zope', 'six', 'Foo.Bar', 'aaa', 'python-dateutil', 'numpy']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.path, 'names.txt')
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), _SimpleIndexHandler)
+        self.server.names = self.names
+        self.server.json = False
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        class Package(pypi.Package):
+            base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.package_class = Package
+        self._chunk_size = pypi.SIMPLE_CHUNK_SIZE
+        # anchors are split between chunks
+        pypi.SIMPLE_CHUNK_SIZE = 7
+
+    def tearDown(self):
+        pypi.SIMPLE_CHUNK_SIZE = self._chunk_size
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def canonical(self, names):
+        return [pypi.canonical_name(name) for name in names]
+
+    def test_stream(self):
+        for json_api in (False, True):
+            self.server.json = json_api
+            self.assertEqual(list(self.package_class.names()),
+                             self.canonical(self.names))
+            # not sorted, so all names are checked
+            self.assertEqual(list(self.package_class.names('Python_')),
+                             ['zope', 'six', 'python-dateutil'])
+
+    def test_cache_file(self):
+        names = self.package_class.names(cache_file=self.cache_file)
+        next(names)
+        names.close()
+        # an interrupted index is not saved
+        self.assertFalse(os.path.exists(self.cache_file))
+        self.assertEqual(list(self.package_class.names(
+            cache_file=self.cache_file)), self.canonical(self.names))
+        self.assertEqual(len(self.server.requests), 2)
+
+        expected = sorted(self.canonical(self.names))
+        self.assertEqual(list(self.package_class.names(
+            cache_file=self.cache_file)), expected)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_resume(self):
+        self.server.names = ['p%03d' % i for i in range(300)]
+        list(self.package_class.names(cache_file=self.cache_file))
+        for start, first in (('p000', 'p000'), ('a', 'p000'),
+                             ('p150', 'p150'), ('p1505', 'p151'),
+                             ('P150', 'p150'), ('p299', 'p299'),
+                             ('p2990', None),
+                             ('q', None)):
+            names = list(self.package_class.names(start, self.cache_file))
+            self.assertEqual(names[:1], [first] if first else [])
+            self.assertEqual(names, sorted(
+                name for name in self.server.names
+                if name >= pypi.canonical_name(start)))
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class _RegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in of the PyPI JSON API, responding by package name:
+    `missing` 404, `down` 500, `limited` 429, `flaky` 503 once, then OK """
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        name = self.path.split('/')[2]
+        status = {'missing': 404, 'down': 500, 'limited': 429,
+                  'forbidden': 403}.get(name, 200)
+        if name == 'flaky' and self.server.requests.count(self.path) == 1:
+            status = 503
+        if status != 200:
+            self.send_error(status)
+            return
+        data = json.dumps({'info': {'name': name, 'version': '1.0'},
+                           'releases': {'1.0': []}}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(aio is None, "async crawler requires Python 3 and aiohttp")
+class TestCrawl(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), _RegistryHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%d' % self.server.server_port
+
+        class Package(pypi.Package):
+            base_url = url
+            mirror = None
+
+        class NpmPackage(npm.Package):
+            base_url = url + '/npm/'
+            mirror = None
+            dump = {'dumped': {'name': 'dumped', 'versions': {}}}
+
+        self.package_class = Package
+        self.npm_package_class = NpmPackage
+        self._negative_cache = pypi._negative_cache
+        pypi._negative_cache = negcache.NegativeCache(
+            os.path.join(self.path, 'negative.sqlite'))
+        self._retry_delay = aio.RETRY_DELAY
+        aio.RETRY_DELAY = 0
+
+    def tearDown(self):
+        aio.RETRY_DELAY = self._retry_delay
+        pypi._negative_cache = self._negative_cache
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def crawl(self, names, package_class=None):
+        return sorted(package.name for package in aio.crawl_sync(
+            names, package_class=package_class or self.package_class,
+            concurrency=2))
+
+    def test_crawl(self):
+        self.assertEqual(self.crawl(['a', 'missing', 'flaky', 'b']),
+                         ['a', 'b', 'flaky'])
+        # the 503 was retried
+        self.assertEqual(self.server.requests.count('/pypi/flaky/json'), 2)
+
+    def test_negative_cache(self):
+        self.assertEqual(self.crawl(['missing']), [])
+        self.assertTrue(pypi.negative_cache().get('missing', 'missing'))
+        # neither the next crawl nor the sync path ask the registry again
+        self.assertEqual(self.crawl(['missing']), [])
+        self.assertRaises(pypi.PackageDoesNotExist,
+                          self.package_class, 'missing')
+        self.assertEqual(self.server.requests, ['/pypi/missing/json'])
+
+    def test_errors(self):
+        # unlike 404, server errors and rate limiting are not skipped
+        for name in ('down', 'limited', 'forbidden'):
+            self.assertRaises(IOError, self.crawl, [name])
+            self.assertFalse(pypi.negative_cache().get('missing', name))
+        self.assertEqual(self.server.requests.count('/pypi/down/json'),
+                         aio.ATTEMPTS)
+        self.assertEqual(self.server.requests.count('/pypi/forbidden/json'),
+                         1)
+
+    def test_npm_dump(self):
+        self.assertEqual(self.crawl(['dumped'], self.npm_package_class),
+                         ['dumped'])
+        self.assertEqual(self.server.requests, [])
+
+
+class TestDumpIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dump = os.path.join(self.path, 'npm.json')
+        with open(self.dump, 'wb') as fh:
+            fh.write(b'{"total_rows":2,"offset":0,"rows":[\r\n'
+                     b'{"id":"b","doc":{"_id":"b","name":"b"}},\r\n'
+                     b'{"id":"a","doc":{"_id":"a","name":"a",'
+                     b'"description":"dumped"}}\r\n]}')
+        dumpindex.DumpIndex(self.dump).build()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _run(self, code):
+        # a fresh interpreter, to import the module with the dump configured
+        env = dict(os.environ, NPM_DUMP_PATH=self.dump)
+        return subprocess.check_output(
+            [sys.executable, '-c', 'from stecosystems import npm; ' + code],
+            env=env, stderr=subprocess.STDOUT).decode('utf8')
+
+    def test_lazy(self):
+        # the index is not opened on import
+        self.assertEqual(self._run('print(npm._dump_index)').split(),
+                         ['None'])
+        self.assertEqual(self._run(
+            'print(npm.Package("a").meta["description"])').split(),
+            ['dumped'])
+
+    def test_outdated(self):
+        with open(self.dump, 'ab') as fh:
+            fh.write(b'\n')
+        self.assertRaises(ValueError, dumpindex.DumpIndex, self.dump)
+        # neither the import nor lookups fail, the index is just not used
+        output = self._run('print(npm.dump_index())')
+        self.assertIn("Not using the dump index", output)
+        self.assertEqual(output.split()[-1], 'None')
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = negcache.NegativeCache(
+            os.path.join(self.path, 'negative.sqlite'))
+        self.now = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def add(self, kind, key, age):
+        self.cache.add(kind, key, "reason", timestamp=self.now - age)
+
+    def test_default_ttl(self):
+        day = 24 * 3600
+        self.add('missing', 'fresh', 6 * day)
+        self.add('missing', 'expired', 8 * day)
+        self.add('broken_link', 'fresh', 29 * day)
+        self.add('broken_link', 'expired', 31 * day)
+        self.add('no_setup', 'fresh', 364 * day)
+        self.add('no_setup', 'expired', 366 * day)
+        self.add('other', 'fresh', day - 60)
+        self.add('other', 'expired', day + 60)
+        for kind in ('missing', 'broken_link', 'no_setup', 'other'):
+            self.assertEqual(self.cache.get(kind, 'fresh'), "reason")
+            self.assertIsNone(self.cache.get(kind, 'expired'))
+        self.assertIsNone(self.cache.get('missing', 'unknown'))
+
+    def test_ttl_override(self):
+        cache = negcache.NegativeCache(self.cache.path,
+                                       {'missing': 10, 'no_setup': None})
+        self.add('missing', 'a', 20)
+        self.add('no_setup', 'b', 10 ** 9)  # kept forever
+        self.assertIsNone(cache.get('missing', 'a'))
+        self.assertEqual(cache.get('no_setup', 'b'), "reason")
+        # other kinds keep defaults
+        self.assertEqual(cache.ttl['broken_link'],
+                         negcache.DEFAULT_TTL['broken_link'])
+
+    def test_replace(self):
+        self.add('missing', 'a', 10 ** 8)
+        self.assertIsNone(self.cache.get('missing', 'a'))
+        self.cache.add('missing', 'a', "again")
+        self.assertEqual(self.cache.get('missing', 'a'), "again")
+
+    def test_purge_and_remove(self):
+        self.add('missing', 'a', 10 ** 8)
+        self.add('missing', 'b', 0)
+        self.add('broken_link', 'c', 0)
+        self.assertEqual(self.cache.counts(), {'missing': 2, 'broken_link': 1})
+        self.assertEqual(self.cache.purge(), 1)
+        self.assertEqual(self.cache.counts(), {'missing': 1, 'broken_link': 1})
+        self.assertEqual(self.cache.remove('broken_link'), 1)
+        self.assertEqual(self.cache.remove(), 1)
+        self.assertEqual(self.cache.counts(), {})
+
+    def test_stats(self):
+        self.add('missing', 'a', 0)
+        self.cache.get('missing', 'a')
+        self.cache.get('missing', 'b')
+        self.cache.get('missing', 'c')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 1.0 / 3)
+
+
+class _Obj(object):
+    pass
+
+
+class TestInstanceRegistry(unittest.TestCase):
+    def test_lru(self):
+        registry = base.InstanceRegistry(size=2)
+        objs = [_Obj() for _ in range(3)]
+        for i, obj in enumerate(objs):
+            registry.add(i, obj)
+        registry.get(0)  # 0 is used more recently than 1
+        registry.add(3, _Obj())  # evicts 1
+        self.assertEqual(list(registry._recent), [0, 3])
+        self.assertIs(registry.get(2), objs[2])  # evicts 0
+        self.assertEqual(list(registry._recent), [3, 2])
+
+    def test_weak_references(self):
+        registry = base.InstanceRegistry(size=1)
+        obj = _Obj()
+        registry.add('a', obj)
+        registry.add('b', _Obj())  # 'a' is not recently used anymore
+        # but it is still registered while referenced elsewhere
+        self.assertIs(registry.get('a'), obj)
+        registry.add('b', _Obj())
+        del obj
+        gc.collect()
+        self.assertIsNone(registry.get('a'))
+
+    def test_package_key(self):
+        registry = pypi.Package._registry
+        pypi.Package._registry = base.InstanceRegistry(4)
+        try:
+            info = {'info': {'name': 'foo', 'version': '1.0'},
+                    'releases': {'1.0': []}}
+            package = pypi.Package.get('Foo', info=info)
+            # names are normalized, info is only used to create the package
+            self.assertIs(pypi.Package.get('foo', info={}), package)
+            compact = pypi.Package.get('foo', info=info, compact=True)
+            self.assertIsNot(compact, package)
+            self.assertTrue(compact.compact)
+            self.assertIs(pypi.Package.get('foo', compact=True), compact)
+        finally:
+            pypi.Package._registry = registry
+
+
+class _Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    @base.cached_method
+    def slow(self, x):
+        self.calls += 1
+        time.sleep(0.1)
+        return x * 2
+
+
+class TestThreadSafety(unittest.TestCase):
+    def _threads(self, *targets):
+        threads = [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_cached_method(self):
+        counter = _Counter()
+        results = []
+        self._threads(*[lambda: results.append(counter.slow(2))] * 4)
+        self.assertEqual(results, [4] * 4)
+        self.assertEqual(counter.calls, 1)
+        self.assertEqual(counter.slow(3), 6)
+        self.assertEqual(counter.calls, 2)
+
+    def test_download(self):
+        name = 'foo-%d' % os.getpid()
+        url = ('https://files.pythonhosted.org/packages/aa/bb/%s-1.0.tar.gz'
+               % name)
+        calls = []
+
+        def urlretrieve(download_url, fname):
+            calls.append(download_url)
+            time.sleep(0.1)
+            with tarfile.open(fname, 'w:gz') as tar:
+                info = tarfile.TarInfo('%s-1.0/foo/__init__.py' % name)
+                info.size = 6
+                tar.addfile(info, io.BytesIO(b"x = 1\n"))
+
+        # all purposes use the only file, extracted into the same folder
+        package = pypi.Package(name, info={
+            'info': {'name': name, 'version': '1.0'},
+            'releases': {'1.0': [{
+                'url': url, 'packagetype': 'sdist', 'size': 100,
+                'filename': url.rsplit('/', 1)[-1],
+                'upload_time': '2019-01-01T00:00:00'}]}})
+        saved = pypi.urlretrieve
+        pypi.urlretrieve = urlretrieve
+        try:
+            paths = []
+            self._threads(*[
+                lambda purpose=purpose: paths.append(
+                    package.download('1.0', purpose))
+                for purpose in pypi.PURPOSES * 2])
+        finally:
+            pypi.urlretrieve = saved
+        self.assertEqual(calls, [url])
+        self.assertEqual(len(set(paths)), 1)
+        self.assertTrue(
+            os.path.isfile(os.path.join(paths[0], 'foo', '__init__.py')))
+        del package
+
+
+class TestRepository(unittest.TestCase):
+    infos = [
+        {'name': 'foo', 'home_page': 'https://github.com/user/foo-home'},
+        {'name': 'foo', 'description': 'Fork of github.com/user/bar,\n'
+                                       'see https://github.com/user/foo.git'},
+        {'name': 'Foo_Bar', 'description': 'github.com/user/foo_bar'},
+        {'name': 'foo', 'home_page': 'https://foo.org',
+         'project_urls': {'Docs': 'https://foo.readthedocs.io'},
+         'description': 'Based on github.com/user/bar'},
+    ]
+
+    def _package(self, info, compact):
+        return pypi.Package(info['name'], compact=compact, info={
+            'info': dict(info, version='1.0'), 'releases': {'1.0': []}})
+
+    def test_compact(self):
+        for info in self.infos:
+            full = self._package(info, compact=False)
+            compact = self._package(info, compact=True)
+            self.assertNotIn('description', compact.meta)
+            self.assertEqual(
+                pypi.find_repositories([(full.name, full.meta)]),
+                pypi.find_repositories([(compact.name, compact.meta)]))
+
+    def test_repository(self):
+        # found in metadata, so package content is not checked
+        for info, url in zip(self.infos[:3], ('github.com/user/foo-home',
+                                              'github.com/user/foo',
+                                              'github.com/user/foo_bar')):
+            self.assertEqual(self._package(info, False).repository, url)
+            self.assertEqual(self._package(info, True).repository, url)
+
+
+class TestSetupCacheKey(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self._write('setup.py', "setup(version='1.0', long_description="
+                                "open('README.rst').read())")
+        self._write('README.rst', "foo")
+        self._write('foo/__init__.py', "")
+        self._write('foo/bar.py', "")
+        self._write('tests/test_bar.py', "")
+        self.key = pypi.setup_cache_key(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, relpath, content):
+        path = os.path.join(self.path, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    def test_unrelated_files(self):
+        self._write('tests/test_baz.py', "")
+        self._write('foo/baz.py', "")
+        self._write('foo/data/file.txt', "")
+        self.assertEqual(pypi.setup_cache_key(self.path), self.key)
+
+    def test_layout(self):
+        # find_packages() would find one more package
+        self._write('foo/baz/__init__.py', "")
+        self.assertNotEqual(pypi.setup_cache_key(self.path), self.key)
+
+    def test_top_level(self):
+        self._write('requirements.txt', "six")
+        self.assertNotEqual(pypi.setup_cache_key(self.path), self.key)
+
+    def test_setup_inputs(self):
+        self._write('README.rst', "bar")
+        self.assertNotEqual(pypi.setup_cache_key(self.path), self.key)
+
+
+class TestModulePaths(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _package(self, files, params=None):
+        for relpath, content in files.items():
+            path = os.path.join(self.path, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write(content)
+        package = _pypi_package('foo', ['1.0'])
+        # release files are "downloaded" already
+        package.download = lambda ver=None, purpose='source': self.path
+        package.get_setup_params = lambda extract_dir=None: params
+        return package
+
+    def test_src_layout(self):
+        package = self._package({
+            'setup.py': "setup()\n",
+            'src/foo/__init__.py': "import os\n",
+            'src/foo/bar.py': "import requests\nx = 1\n",
+            'src/single.py': "y = 2\n",
+            'tests/test_foo.py': "import pytest\n",
+        }, {'packages': ['foo'], 'py_modules': ['single'],
+            'package_dir': {'': 'src'}})
+        self.assertEqual(package.module_paths('1.0'),
+                         [os.path.join('src', 'foo'),
+                          os.path.join('src', 'single.py')])
+        self.assertEqual(package.imports('1.0'),
+                         {'stdlib': ['os'], 'third_party': ['requests']})
+
+    def test_wheel_layout(self):
+        package = self._package({
+            'foo-1.0.dist-info/top_level.txt': "foo\n",
+            'foo/__init__.py': "import six\n",
+        })
+        self.assertEqual(package.module_paths('1.0'), ['foo'])
+        self.assertEqual(package.imports('1.0'),
+                         {'stdlib': [], 'third_party': ['six']})
+
+
+class _ModulesPackage(object):
+    # a pypi.Package stand-in for ModuleIndex.add_packages()
+    def __init__(self, name, modules):
+        self.name = name
+        self._modules = modules
+
+    def modules(self, version):
+        return self._modules[version]
+
+
+class TestModuleIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.path, 'modules.idx')
+        self.index = modindex.ModuleIndex(self.index_path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.path)
+
+    def test_empty(self):
+        # no file until the first update
+        self.assertFalse(os.path.exists(self.index_path))
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.lookup('six'), [])
+        self.assertEqual(list(self.index), [])
+        self.index.update([])
+        self.assertFalse(os.path.exists(self.index_path))
+
+    def test_update(self):
+        self.index.update([('yaml', 'PyYAML', '5.1'), ('six', 'six', '1.0')])
+        self.index.update([('yaml', 'PyYAML', '5.1'),  # a duplicate
+                           ('yaml', 'PyYAML', '3.13'), ('yam', 'yam', '1'),
+                           (u'caf\xe9', u'caf\xe9', '1.0')])
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.lookup('yaml'),
+                         [('PyYAML', '3.13'), ('PyYAML', '5.1')])
+        # lookups match whole names only
+        self.assertEqual(self.index.lookup('ya'), [])
+        self.assertEqual(self.index.lookup('yam'), [('yam', '1')])
+        self.assertEqual(self.index.lookup(u'caf\xe9'), [(u'caf\xe9', '1.0')])
+        self.assertEqual([record[0] for record in self.index],
+                         [u'caf\xe9', 'six', 'yam', 'yaml', 'yaml'])
+        self.assertEqual(self.index.releases(), {
+            ('PyYAML', '5.1'), ('PyYAML', '3.13'), ('six', '1.0'),
+            ('yam', '1'), (u'caf\xe9', '1.0')})
+
+    def test_shared(self):
+        self.index.update([('six', 'six', '1.0')])
+        reader = modindex.ModuleIndex(self.index_path)
+        self.assertEqual(reader.lookup('six'), [('six', '1.0')])
+        self.index.update([('yaml', 'PyYAML', '5.1')])
+        # readers keep using the old copy until reload()
+        self.assertNotIn('yaml', reader)
+        reader.reload()
+        self.assertIn('yaml', reader)
+        self.assertEqual(len(reader), 2)
+        reader.close()
+        self.assertEqual(len(reader), 0)
+
+    def test_not_an_index(self):
+        with open(self.index_path, 'wb') as fh:
+            fh.write(b'\0' * modindex.HEADER.size)
+        self.assertRaises(ValueError, self.index.reload)
+
+    def test_add_packages(self):
+        package = _ModulesPackage('PyYAML', {
+            '5.1': ['yaml', 'yaml.constructor', '_yaml'], '3.13': ['yaml']})
+        self.index.add_packages([(package, '5.1'), (package, '3.13')])
+        self.assertEqual(self.index.lookup('yaml'),
+                         [('PyYAML', '3.13'), ('PyYAML', '5.1')])
+        self.assertEqual(self.index.lookup('_yaml'), [('PyYAML', '5.1')])
+        self.assertNotIn('yaml.constructor', self.index)
+
+
+class TestStratifiedSample(unittest.TestCase):
+    # stratum 'a' is 10% of the population, with very different values
+    names = ['a%d' % i for i in range(2000)] + ['b%d' % i for i in range(18000)]
+
+    @staticmethod
+    def _value(name):
+        return 100 if name[0] == 'a' else 1
+
+    def test_estimated_weights_interval(self):
+        sample = sampling.StratifiedSample(
+            0.05, seed=1, stratum=lambda name: name[0])
+        values = {name: self._value(name)
+                  for name in sample.select(self.names, name=str)}
+        self.assertFalse(sample.population)
+        estimate = sample.mean(values)
+        self.assertLess(estimate.low, estimate.high)
+        self.assertLess(estimate.low, 10.9)
+        self.assertLess(10.9, estimate.high)
+
+    def test_defer_strata(self):
+        def stratum(name):
+            raise AssertionError("stratum computed by select()")
+        sample = sampling.StratifiedSample(0.05, seed=1, stratum=stratum)
+        selected = list(sample.select(self.names, name=str,
+                                      defer_strata=True))
+        self.assertFalse(sample.sampled)
+        for name in selected:
+            sample.add(name, name[0])
+        self.assertEqual(sum(sample.sampled.values()), len(selected))
+        eager = sampling.StratifiedSample(
+            0.05, seed=1, stratum=lambda name: name[0])
+        self.assertEqual(list(eager.select(self.names, name=str)), selected)
+        self.assertEqual(eager.sampled, sample.sampled)
+
+    def test_defer_strata_with_fractions(self):
+        sample = sampling.StratifiedSample(
+            0.01, stratum=lambda name: name[0], fractions={'a': 0.5})
+        with self.assertRaises(ValueError):
+            list(sample.select(self.names, name=str, defer_strata=True))
+
+
+def _npm_dump(path, releases):
+    """ Write an npm `_all_docs` dump, {package name: number of releases} """
+    rows = []
+    for name, count in sorted(releases.items()):
+        versions = ['1.0.%d' % i for i in range(count)]
+        rows.append({'id': name, 'doc': {
+            '_id': name, 'name': name,
+            'versions': {v: {'dependencies': {}} for v in versions},
+            'time': {v: '2015-01-%02d' % (i + 1)
+                     for i, v in enumerate(versions)}}})
+    with open(path, 'w') as fh:
+        json.dump({'total_rows': len(rows), 'offset': 0, 'rows': rows}, fh)
+
+
+class TestDependencyTimeline(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # every release changes something: a dependency is added, removed,
+        # re-added or its constraint changes
+        self.history = []
+        for i in range(100):
+            deps = {'dep%d' % j: '>=%d' % (i // 10) for j in range(i % 7)}
+            if i % 3:
+                deps['six'] = None if i % 2 else ''
+            self.history.append(('1.%d' % i, '2018-01-%02d' % (i % 28 + 1),
+                                 deps))
+        self._interval = timeline.CHECKPOINT_INTERVAL
+
+    def tearDown(self):
+        timeline.CHECKPOINT_INTERVAL = self._interval
+        shutil.rmtree(self.path)
+
+    def expected(self):
+        # constraints are normalized to strings
+        return [(version, date, {dep: constraint or ''
+                                 for dep, constraint in deps.items()})
+                for version, date, deps in self.history]
+
+    def test_random_access(self):
+        for interval in (1, 4, self._interval, 1000):
+            timeline.CHECKPOINT_INTERVAL = interval
+            t = timeline.DependencyTimeline.from_history('foo', self.history)
+            self.assertEqual(len(t), len(self.history))
+            self.assertEqual(list(t), self.expected())
+            for version, _, deps in reversed(self.expected()):
+                self.assertEqual(t.dependencies(version), deps)
+
+    def test_json(self):
+        t = timeline.DependencyTimeline.from_history('foo', self.history)
+        restored = timeline.DependencyTimeline.from_json(
+            json.loads(json.dumps(t.to_json())))
+        self.assertEqual(json.dumps(restored.to_json()),
+                         json.dumps(t.to_json()))
+        self.assertEqual(list(restored), self.expected())
+        self.assertEqual(restored.dependencies('1.50'),
+                         self.expected()[50][2])
+        # the set of names is stored once per package
+        self.assertEqual(len(restored.names), 7)
+
+    def test_first_added(self):
+        t = timeline.DependencyTimeline.from_history('foo', [
+            ('1.0', '2018-01-01', {}),
+            ('1.1', '2018-02-01', {'six': ''}),
+            ('1.2', '2018-03-01', {}),
+            ('1.3', '2018-04-01', {'six': '>=1.0'})])
+        self.assertEqual(t.first_added('six'), ('1.1', '2018-02-01'))
+        self.assertIsNone(t.first_added('requests'))
+
+    def test_files(self):
+        rows = [('foo', version, date, deps)
+                for version, date, deps in self.history]
+        rows.append(('bar', '1.0', None, {'requests': ''}))
+        rows.append(('sixer', '1.0', None, {'pytest': ''}))
+        for fname in ('timelines.jsonl', 'timelines.jsonl.gz'):
+            path = os.path.join(self.path, fname)
+            timeline.write(path, timeline.from_rows(rows))
+            timelines = list(timeline.read(path))
+            self.assertEqual([t.name for t in timelines],
+                             ['foo', 'bar', 'sixer'])
+            self.assertEqual(list(timelines[0]), self.expected())
+            self.assertEqual(list(timelines[1]),
+                             [('1.0', None, {'requests': ''})])
+            # 'sixer' contains "six", but doesn't depend on it
+            self.assertEqual([t.name for t in timeline.read(path, 'six')],
+                             ['foo'])
+            self.assertEqual(timeline.dependents(path, 'six'),
+                             {'foo': ('1.1', '2018-01-02')})
+            self.assertEqual(timeline.dependents(path, 'numpy'), {})
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(2), b'\x1f\x8b')  # gzip magic
+
+
+class _Clock(object):
+    # a stand-in of the time module, to get exact span durations
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class _Traced(object):
+    name = 'foo'
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    @trace.traced('loc')
+    def loc(self, ver):
+        with trace.span(self.name, ver, 'download') as span:
+            self.clock.now += 2
+            span.bytes = 100
+        self.clock.now += 1
+        return 42
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.path, 'crawl.trace.jsonl')
+        self.clock = _Clock()
+        self._time = trace.time
+        trace.time = self.clock
+
+    def tearDown(self):
+        trace.disable()
+        trace.time = self._time
+        shutil.rmtree(self.path)
+
+    def test_disabled(self):
+        self.assertFalse(trace.enabled())
+        with trace.span('foo', '1.0', 'download') as span:
+            span.bytes = 100
+        self.assertEqual(_Traced(self.clock).loc('1.0'), 42)
+        self.assertFalse(os.path.exists(self.trace_path))
+
+    def test_spans(self):
+        trace.enable(self.trace_path)
+        self.assertTrue(trace.enabled())
+        self.assertEqual(_Traced(self.clock).loc('1.0'), 42)
+        with self.assertRaises(ValueError):
+            with trace.span('Foo', None, 'init'):
+                self.clock.now += 0.5
+                raise ValueError("broken")
+        trace.disable()
+
+        spans = list(trace.read(self.trace_path))
+        # nested spans are recorded first
+        self.assertEqual(
+            [(s['package'], s['version'], s['stage'], s['parent'],
+              s['duration'], s['self'], s['bytes'], s['error']) for s in spans],
+            [('foo', '1.0', 'download', 'loc', 2, 2, 100, None),
+             ('foo', '1.0', 'loc', None, 3, 1, None, None),
+             ('Foo', None, 'init', None, 0.5, 0.5, None,
+              repr(ValueError("broken")))])
+        self.assertEqual(spans[0]['pid'], os.getpid())
+
+    def test_threads(self):
+        # every thread has its own stack of spans
+        trace.enable(self.trace_path)
+        started = threading.Event()
+        resume = threading.Event()
+
+        def worker():
+            with trace.span('bar', None, 'download'):
+                started.set()
+                resume.wait()
+
+        with trace.span('foo', None, 'init'):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            started.wait()
+            with trace.span('foo', None, 'download'):
+                resume.set()
+                thread.join()
+        trace.disable()
+        parents = {(s['package'], s['stage']): s['parent']
+                   for s in trace.read(self.trace_path)}
+        self.assertEqual(parents, {('bar', 'download'): None,
+                                   ('foo', 'download'): 'init',
+                                   ('foo', 'init'): None})
+
+    def _write(self, spans):
+        with open(self.trace_path, 'w') as fh:
+            for package, stage, duration, own, size, error in spans:
+                fh.write(json.dumps({
+                    'package': package, 'version': '1.0', 'stage': stage,
+                    'parent': None, 'start': 0, 'duration': duration,
+                    'self': own, 'bytes': size, 'error': error,
+                    'pid': 1}) + "\n")
+            fh.write('{"package": "trunc')  # killed in the middle
+
+    def test_report(self):
+        self._write([('PyYAML', 'download', 10, 4, 1000, None),
+                     ('pyyaml', 'extract', 6, 6, 5000, None),
+                     ('six', 'download', 3, 3, None, 'IOError()'),
+                     ('numpy', 'download', 1, 1, 10, None)])
+        spans = list(trace.read(self.trace_path))
+        self.assertEqual(len(spans), 4)
+        # names are normalized, nested time is not counted twice
+        self.assertEqual(trace.package_times(spans),
+                         {'pyyaml': 10, 'six': 3, 'numpy': 1})
+        self.assertEqual(trace.stage_breakdown(spans)['download'], {
+            'count': 3, 'errors': 1, 'time': 8, 'max': 10, 'bytes': 1010})
+        self.assertEqual(trace.slow_packages(self.trace_path, 2),
+                         {'pyyaml', 'six'})
+
+        lines = trace.report(self.trace_path, top=2).splitlines()
+        self.assertEqual(lines[0], "Slowest packages:")
+        self.assertEqual([line.split()[0] for line in lines[1:3]],
+                         ['pyyaml', 'six'])
+        self.assertEqual(lines[3:5], ["", "Slowest steps:"])
+        self.assertEqual([line.split()[:3] for line in lines[5:7]],
+                         [['PyYAML', '1.0', 'download'],
+                          ['pyyaml', '1.0', 'extract']])
+
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            trace.main([self.trace_path, '--slower-than', '2'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output.split(), ['pyyaml', 'six'])
+
+
+class TestSampleResume(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dump = os.path.join(self.path, 'npm.json')
+        _npm_dump(self.dump, {'p%02d' % i: 1 + i % 7 for i in range(60)})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _run(self, name, *options):
+        # returns the estimates report, without warnings logged before it
+        stderr = sys.stderr
+        sys.stderr = six.StringIO()
+        try:
+            cli.main(['metadata', 'npm', '--dump', self.dump,
+                      '--sample', '0.5', '--seed', '1', '--strata', 'releases',
+                      '-o', os.path.join(self.path, name + '.csv'),
+                      '--resume', os.path.join(self.path, name + '.done'),
+                      '-w', '2'] + list(options))
+            output = sys.stderr.getvalue()
+            return output[output.rfind("\n", 0, output.index(
+                " packages sampled")) + 1:]
+        finally:
+            sys.stderr = stderr
+
+    def test_resume(self):
+        report = self._run('full')
+        self._run('resumed', '--limit', '10')
+        resumed = self._run('resumed')
+        # finished packages are neither counted twice nor left out
+        self.assertEqual(resumed, report)
+        self.assertEqual(self._run('resumed'), report)
+
+
+class TestNpmPackage(unittest.TestCase):
+    doc = {
+        '_id': 'foo', 'name': 'foo', 'license': 'MIT',
+        'repository': {'type': 'git',
+                       'url': 'git+https://github.com/user/foo.git'},
+        'homepage': 'https://github.com/user/foo-home',
+        'time': {'1.0.0': '2015-01-01T00:00:00.000Z',
+                 '2.0.0-beta': '2015-02-01T00:00:00.000Z',
+                 '2.0.0': '2015-03-01T00:00:00.000Z',
+                 '1.0.1': '2015-04-01T00:00:00.000Z'},
+        'versions': {
+            '1.0.0': {'dependencies': ['six', 'left-pad']},
+            '2.0.0-beta': {'dependencies': {'left-pad': '^1.0.0'}},
+            '2.0.0': {'dependencies': {'left-pad': '^1.1.0',
+                                       'lodash': '4.x'}},
+            # a backport, and a date from the version itself
+            '1.0.1': {}}}
+
+    def packages(self):
+        # both modes should give the same results
+        return [npm.Package('foo', info=self.doc),
+                npm.Package('foo', info=self.doc, compact=True)]
+
+    def test_releases(self):
+        for package in self.packages():
+            self.assertEqual(package.releases(), [
+                ('1.0.0', '2015-01-01'), ('2.0.0', '2015-03-01')])
+            self.assertEqual(package.releases(True, True), [
+                ('1.0.0', '2015-01-01'), ('2.0.0-beta', '2015-02-01'),
+                ('2.0.0', '2015-03-01'), ('1.0.1', '2015-04-01')])
+            self.assertEqual(package.latest_ver, '2.0.0')
+
+    def test_dependencies(self):
+        for package in self.packages():
+            self.assertEqual(package.dependencies(),
+                             {'left-pad': '^1.1.0', 'lodash': '4.x'})
+            # old packages list names only
+            self.assertEqual(package.dependencies('1.0.0'),
+                             {'six': None, 'left-pad': None})
+            self.assertEqual(package.dependencies('1.0.1'), {})
+        empty = npm.Package('bar', info={'name': 'bar', 'versions': {}})
+        self.assertIsNone(empty.latest_ver)
+        self.assertEqual(empty.dependencies(), {})
+
+    def test_repository(self):
+        for package in self.packages():
+            # the first field with a repository URL is used
+            self.assertEqual(package.repository, 'github.com/user/foo.git')
+        for doc, url in (
+                ({'repository': 'github.com/user/bar'}, 'github.com/user/bar'),
+                ({'repository': {'url': 'https://example.com/bar'},
+                  'homepage': 'https://gitlab.com/user/bar'},
+                 'gitlab.com/user/bar'),
+                ({'bugs': {'url': 'https://github.com/user/bar/issues'}},
+                 'github.com/user/bar'),
+                ({'homepage': 'https://bar.js.org'}, None)):
+            doc = dict(doc, name='bar', versions={})
+            self.assertEqual(npm.Package('bar', info=doc).repository, url)
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dump = os.path.join(self.path, 'npm.json')
+        self.output = os.path.join(self.path, 'output')
+        self.names = ['c', '@scope/a', 'b', 'd', 'e']  # in the dump order
+        rows = []
+        for i, name in enumerate(self.names):
+            rows.append({'id': name, 'doc': {
+                '_id': name, 'name': name, 'license': 'MIT',
+                'repository': 'https://github.com/user/%s'
+                              % name.rsplit('/', 1)[-1],
+                'time': {'1.0.0': '2015-01-01', '1.1.0': '2015-02-01'},
+                'versions': {
+                    '1.0.0': {'dependencies': {}},
+                    '1.1.0': {'dependencies': {'dep%d' % j: '^1.0.0'
+                                               for j in range(i)}}}}})
+        with open(self.dump, 'w') as fh:
+            json.dump({'total_rows': len(rows), 'offset': 0, 'rows': rows},
+                      fh)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_cli(self, command, *options):
+        cli.main([command, 'npm', '--dump', self.dump, '-o', self.output,
+                  '-w', '3'] + list(options))
+
+    def csv_rows(self):
+        with io.open(self.output, encoding='utf8', newline='') as fh:
+            return list(csv.reader(fh))
+
+    def test_enumerate(self):
+        self.run_cli('enumerate')
+        # in the input order, regardless of the number of workers
+        self.assertEqual(self.csv_rows(),
+                         [['name']] + [[name] for name in self.names])
+        self.run_cli('enumerate', '--filter', '^[a-c]$')
+        self.assertEqual(self.csv_rows(), [['name'], ['c'], ['b']])
+        self.run_cli('enumerate', '--start', 'b', '--stop', 'd')
+        self.assertEqual(self.csv_rows(), [['name'], ['c'], ['b']])
+        self.run_cli('enumerate', '--limit', '2')
+        self.assertEqual(self.csv_rows(), [['name'], ['c'], ['@scope/a']])
+
+    def test_metadata(self):
+        self.run_cli('metadata', '-f', 'jsonl')
+        with io.open(self.output, encoding='utf8') as fh:
+            rows = [json.loads(line) for line in fh]
+        self.assertEqual(rows[1], {
+            'name': '@scope/a', 'version': '1.1.0', 'releases': 2,
+            'license': 'MIT', 'repository': 'github.com/user/a'})
+        self.assertEqual([row['name'] for row in rows], self.names)
+
+    def test_deps(self):
+        self.run_cli('deps')
+        rows = self.csv_rows()
+        self.assertEqual(tuple(rows[0]), cli.COLUMNS['deps'])
+        self.assertEqual(len(rows), 1 + 2 * len(self.names))
+        self.assertEqual(rows[1:3], [
+            ['c', '1.0.0', '2015-01-01', '', '{}'],
+            ['c', '1.1.0', '2015-02-01', '', '{}']])
+        self.assertEqual(rows[6], [
+            'b', '1.1.0', '2015-02-01', 'dep0,dep1',
+            '{"dep0": "^1.0.0", "dep1": "^1.0.0"}'])
+
+    def test_resume(self):
+        checkpoint = os.path.join(self.path, 'done.txt')
+        self.run_cli('repos', '--resume', checkpoint, '--limit', '2')
+        self.assertEqual(len(self.csv_rows()), 3)
+        self.run_cli('repos', '--resume', checkpoint)
+        self.run_cli('repos', '--resume', checkpoint)  # nothing left
+        rows = self.csv_rows()
+        # the header is written once, every package once
+        self.assertEqual(rows[0], ['name', 'repository'])
+        self.assertEqual([row[0] for row in rows[1:]], self.names)
+        with io.open(checkpoint, encoding='utf8') as fh:
+            self.assertEqual(fh.read().split(), self.names)
+
+
+class _FakeMirror(object):
+    def __init__(self, path):
+        self.path = path
+
+    def file_relpath(self, url):
+        return url.rsplit('/', 1)[-1]
+
+
+class _FakePackage(object):
+    mirror = None
+    mirror_class = _FakeMirror
+
+
+class TestPrefetcher(unittest.TestCase):
+    max_bytes = 1000
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.sizes = {}  # sizes[url]
+        self.fetched = []
+        self._urlretrieve = prefetch.urlretrieve
+        prefetch.urlretrieve = self._fake_urlretrieve
+
+    def tearDown(self):
+        prefetch.urlretrieve = self._urlretrieve
+        shutil.rmtree(self.path)
+
+    def _fake_urlretrieve(self, url, path):
+        folder = os.path.dirname(path)
+        stored = sum(os.path.getsize(os.path.join(folder, name))
+                     for name in os.listdir(folder))
+        # files of consumed items are removed before new ones are fetched
+        self.assertLessEqual(stored + self.sizes[url], self.max_bytes)
+        time.sleep(0.01)
+        with open(path, 'wb') as fh:
+            fh.write(b'x' * self.sizes[url])
+        self.fetched.append(url)
+
+    def _files(self, item):
+        files = [('https://example.com/%d.tgz' % item, 300)]
+        if item == 3:  # larger than the budget
+            files.append(('https://example.com/huge.tgz', self.max_bytes + 1))
+        for url, size in files:
+            self.sizes[url] = size
+        return files
+
+    def test_ahead(self):
+        prefetcher = prefetch.Prefetcher(
+            _FakePackage, self.path, max_bytes=self.max_bytes, workers=3)
+        with prefetcher:
+            self.assertIs(_FakePackage.mirror, prefetcher.mirror)
+            previous = None
+            items = []
+            for item in prefetcher.ahead(range(10), self._files):
+                items.append(item)
+                path = os.path.join(prefetcher.path, '%d.tgz' % item)
+                self.assertTrue(os.path.isfile(path))
+                if previous is not None:
+                    self.assertFalse(os.path.exists(previous))
+                previous = path
+        self.assertEqual(items, list(range(10)))
+        self.assertIsNone(_FakePackage.mirror)
+        self.assertEqual(len(self.fetched), 10)
+        self.assertNotIn('https://example.com/huge.tgz', self.fetched)
+        self.assertEqual(prefetcher.stats['skipped'], 1)
+        self.assertFalse(os.path.exists(prefetcher.path))
+
+    def test_early_exit(self):
+        prefetcher = prefetch.Prefetcher(
+            _FakePackage, self.path, max_bytes=self.max_bytes, workers=3)
+        with prefetcher:
+            for item in prefetcher.ahead(range(10), self._files):
+                if item == 2:
+                    break
+            self.assertEqual(prefetcher._reserved, 0)
+        self.assertFalse(os.path.exists(prefetcher.path))
+
+
+def _square(x):
+    if x == 3:
+        raise ValueError("no threes")
+    return x * x
+
+
+def _sleep_first(x):
+    time.sleep(0.5 if x == 0 else 0.01)
+    return x
+
+
+def _unpicklable(x):
+    return threading.Lock() if x == 1 else x
+
+
+class TestPipeline(unittest.TestCase):
+    def test_ordered(self):
+        self.assertEqual(
+            list(pipeline.pipeline(range(20), [
+                pipeline.Stage(_sleep_first, 4),
+                pipeline.Stage(abs, 2, processes=True)])),
+            list(range(20)))
+
+    def test_unordered(self):
+        res = list(pipeline.pipeline(
+            range(8), [pipeline.Stage(_sleep_first, 4)], ordered=False))
+        self.assertEqual(sorted(res), list(range(8)))
+        # the slow item doesn't hold back the rest
+        self.assertNotEqual(res[0], 0)
+
+    def test_errors(self):
+        for processes in (False, True):
+            with self.assertRaises(ValueError):
+                list(pipeline.pipeline(range(6), [
+                    pipeline.Stage(_square, 2, processes=processes)]))
+            self.assertEqual(list(pipeline.pipeline(range(6), [
+                pipeline.Stage(_square, 2, processes=processes,
+                               skip_errors=True)])), [0, 1, 4, 16, 25])
+
+    def test_pickling_errors(self):
+        # unpicklable results and inputs don't hang the pipeline
+        stage = pipeline.Stage(_unpicklable, 2, processes=True,
+                               skip_errors=True)
+        self.assertEqual(list(pipeline.pipeline(range(4), [stage])),
+                         [0, 2, 3])
+        items = [1, threading.Lock(), 3]
+        stage = pipeline.Stage(abs, 2, processes=True, skip_errors=True)
+        self.assertEqual(list(pipeline.pipeline(items, [stage])), [1, 3])
+        with self.assertRaises(Exception):
+            list(pipeline.pipeline(range(4), [pipeline.Stage(
+                _unpicklable, 2, processes=True)]))
+
+
+class TestPypiDependenciesQueued(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.path, 'deps.cache')
+        self.handled = []
+        self._patched = []
+        package = _pypi_package('foo', ['1.0', '1.1'])
+        package.releases = lambda *args: [('1.0', '2010-01-01'),
+                                          ('1.1', '2011-01-01')]
+        self._patch(deprecated, 'pypi_packages_info',
+                    lambda: deprecated.pd.DataFrame(index=['foo']))
+        self._patch(deprecated.fs_cache, 'get_cache_fname',
+                    lambda fname: self.cache_file)
+        self._patch(pypi.Package, 'get',
+                    classmethod(lambda cls, name, **kwargs: package))
+        self._patch(workqueue, 'run', self._run)
+
+    def tearDown(self):
+        for obj, attr, value in reversed(self._patched):
+            if value is None:  # an instance attribute
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, value)
+        shutil.rmtree(self.path)
+
+    def _patch(self, obj, attr, value):
+        self._patched.append((obj, attr, vars(obj).get(attr)))
+        setattr(obj, attr, value)
+
+    def _run(self, path, processes=None, **kwargs):
+        def handler(package, version):
+            self.handled.append((package, version))
+            return {'six': '>=1.0'}
+        return workqueue.work(workqueue.WorkQueue(path),
+                              {'pypi.dependencies': handler}, wait=False)
+
+    def test_shared_cache(self):
+        with open(self.cache_file, 'w') as fh:
+            fh.write("name,version,date,deps,raw_dependencies\n"
+                     "foo,1.0,2010-01-01,,{}\n")
+        df = deprecated.pypi_dependencies(
+            queue_path=os.path.join(self.path, 'q.db'))
+        self.assertEqual(self.handled, [('foo', '1.1')])
+        self.assertEqual(list(df.index), [('foo', '1.0'), ('foo', '1.1')])
+        self.assertEqual(df.loc[('foo', '1.1'), 'date'], '2011-01-01')
+        self.assertEqual(df.loc[('foo', '1.1'), 'deps'], 'six')
+        # the local path reuses results of the queue
+        self.assertEqual(
+            list(deprecated._read_dependencies_cache(self.cache_file)),
+            [('foo', '1.0'), ('foo', '1.1')])
+
+
+def _logged_handler(package, version):
+    # module-level, so that it can be passed to worker processes;
+    # every call is logged to count how many times a job ran
+    with open(os.environ['STECOSYSTEMS_TEST_LOG'], 'a') as fh:
+        fh.write("%s %s\n" % (package, version))
+    return {'package': package, 'version': version}
+
+
+def _failing_handler(package, version):
+    raise ValueError("failed")
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = workqueue.WorkQueue(os.path.join(self.path, 'q.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_add(self):
+        jobs = [('a', '1.0', 'task'), ('a', '1.1', 'task'), ('b', None, 'task')]
+        self.assertEqual(self.queue.add(jobs, batch_size=2), 3)
+        # re-adding the same jobs is a no-op
+        self.assertEqual(self.queue.add(jobs, batch_size=2), 0)
+        self.assertEqual(self.queue.stats()['pending'], 3)
+
+    def test_prefetch_raises_batch(self):
+        self.queue.add([('a', str(i), 'task') for i in range(20)])
+        limits = []
+        lease = self.queue.lease
+
+        def recording_lease(worker, limit=1, shard=None):
+            limits.append(limit)
+            return lease(worker, limit, shard)
+        self.queue.lease = recording_lease
+        processed = workqueue.work(
+            self.queue, {'task': lambda package, version: None}, wait=False,
+            prefetch={'path': os.path.join(self.path, 'prefetch'),
+                      'workers': 2})
+        self.assertEqual(processed, 20)
+        self.assertEqual(limits[0], 8)  # lookahead of two download threads
+
+    def test_add_doesnt_lock_between_batches(self):
+        other = workqueue.WorkQueue(self.queue.path)
+        leased = []
+
+        def jobs():
+            for i in range(4):
+                if i == 2:
+                    # the first batch is committed, and the database
+                    # is not locked while the generator runs
+                    leased.extend(other.lease('other', limit=10))
+                yield 'a', str(i), 'task'
+        self.assertEqual(self.queue.add(jobs(), batch_size=2), 4)
+        self.assertEqual([job.version for job in leased], ['0', '1'])
+
+    def test_lease_expiry(self):
+        queue = workqueue.WorkQueue(self.queue.path, lease_time=0.2)
+        queue.add([('a', '1.0', 'task')])
+        job, = queue.lease('first')
+        self.assertEqual(queue.lease('second'), [])
+        time.sleep(0.3)
+        job2, = queue.lease('second')
+        self.assertEqual((job2.id, job2.attempts), (job.id, 2))
+        # the first worker lost its lease
+        self.assertEqual(queue.heartbeat([job], 'first'), 0)
+        self.assertEqual(queue.heartbeat([job2], 'second'), 1)
+
+    def test_max_attempts(self):
+        queue = workqueue.WorkQueue(self.queue.path, max_attempts=2)
+        queue.add([('a', '1.0', 'task')])
+        for _ in range(2):
+            job, = queue.lease('worker')
+            queue.fail(job, "error", 'worker')
+        self.assertEqual(queue.lease('worker'), [])
+        self.assertEqual(queue.stats()['failed'], 1)
+        self.assertEqual(list(queue.errors()),
+                         [('a', '1.0', 'task', "error")])
+        self.assertEqual(queue.retry_failed(), 1)
+        self.assertEqual(len(queue.lease('worker')), 1)
+
+    def test_expired_lease_out_of_attempts(self):
+        queue = workqueue.WorkQueue(self.queue.path, lease_time=0.1,
+                                    max_attempts=1)
+        queue.add([('a', '1.0', 'task')])
+        self.assertEqual(len(queue.lease('worker')), 1)
+        time.sleep(0.2)
+        self.assertEqual(queue.lease('other'), [])
+        self.assertEqual(queue.stats()['failed'], 1)
+
+    def test_complete_twice(self):
+        queue = workqueue.WorkQueue(self.queue.path, lease_time=0.1)
+        queue.add([('a', '1.0', 'task')])
+        job, = queue.lease('first')
+        time.sleep(0.2)
+        job2, = queue.lease('second')
+        self.assertTrue(queue.complete(job2, 'second result', 'second'))
+        # the first worker finishes late; its result is not stored
+        self.assertFalse(queue.complete(job, 'first result', 'first'))
+        self.assertEqual(list(queue.results()),
+                         [('a', '1.0', 'task', 'second result')])
+        self.assertEqual(queue.unfinished(), 0)
+
+    def test_work_failures(self):
+        self.queue.add([('a', '1.0', 'fails'), ('a', '1.0', 'unknown')])
+        processed = workqueue.work(
+            self.queue, {'fails': _failing_handler}, wait=False)
+        # a failing job is retried max_attempts times
+        self.assertEqual(processed, workqueue.MAX_ATTEMPTS + 1)
+        self.assertEqual(self.queue.stats()['failed'], 2)
+
+    def test_several_processes(self):
+        log_path = os.path.join(self.path, 'calls.log')
+        os.environ['STECOSYSTEMS_TEST_LOG'] = log_path
+        jobs = [('package%d' % (i % 7), str(i), 'task') for i in range(60)]
+        self.queue.add(jobs)
+        processed = workqueue.run(
+            self.queue.path, 3, handlers={'task': _logged_handler},
+            batch=4, wait=False)
+        self.assertEqual(processed, len(jobs))
+        with open(log_path) as fh:
+            calls = sorted(line.split() for line in fh)
+        # every job ran exactly once
+        self.assertEqual(calls, sorted([p, v] for p, v, _ in jobs))
+        self.assertEqual(self.queue.stats()['done'], len(jobs))
+        self.assertEqual(
+            sorted((p, v) for p, v, _, _ in self.queue.results()),
+            sorted((p, v) for p, v, _ in jobs))
+
+
+if __name__ == "__main__":
+    unittest.main()